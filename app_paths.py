@@ -0,0 +1,32 @@
+import os
+import sys
+
+# Where the editor keeps its own files. Follows the XDG base directory spec on Linux and the usual
+# equivalents on Windows and macOS.
+
+APP_DIRECTORY_NAME = "tavernai_character_editor"
+
+# Returns (and creates if needed) a directory under the user's cache directory
+def cache_directory(*parts):
+    if sys.platform == "win32":
+        root = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~\\AppData\\Local")
+    elif sys.platform == "darwin":
+        root = os.path.expanduser("~/Library/Caches")
+    else:
+        root = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    path = os.path.join(root, APP_DIRECTORY_NAME, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+# Returns (and creates if needed) a directory under the user's data directory, for files that mustn't
+# be cleared out like a cache can be
+def data_directory(*parts):
+    if sys.platform == "win32":
+        root = os.environ.get("APPDATA") or os.path.expanduser("~\\AppData\\Roaming")
+    elif sys.platform == "darwin":
+        root = os.path.expanduser("~/Library/Application Support")
+    else:
+        root = os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share")
+    path = os.path.join(root, APP_DIRECTORY_NAME, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
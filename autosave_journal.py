@@ -0,0 +1,260 @@
+import json
+import os
+import threading
+import time
+
+from app_paths import data_directory
+
+# Keeps unsaved edits safe between saves. Every change the editor makes to a card's fields is appended
+# to a journal file as a small record, the same span-of-changes the undo history holds rather than the
+# whole card, so journaling costs next to nothing even on huge cards. Records are gathered in memory and
+# written together by flush(), which the editor calls every few seconds on a background thread, and the
+# file is only fsynced every JOURNAL_FSYNC_INTERVAL seconds. When a card is saved (or its edits are all
+# undone) its records are dropped and the journal is compacted. Whatever is left in the journal when the
+# editor next starts is edits that were never saved, which can be replayed onto the cards. Nothing in here
+# depends on Qt.
+#
+# Each line is a card's absolute path as JSON, a tab, and a record as a JSON list:
+#   ["base", [mtime_ns, size]]                        the card file the following records apply to
+#   ["splice", field, start, removedLength, inserted] value[start:start + removedLength] = inserted
+#   ["replace", field, value]                         the field's whole new value
+#   ["data", data]                                    the card's whole data was replaced, by an import
+#   ["clear"]                                         the card was saved, earlier records are void
+
+JOURNAL_FILENAME = "autosave.journal"
+# Seconds between fsyncs of the journal. Writes reach the OS straight away so they survive the editor
+# crashing, the fsync is only needed to survive the whole system going down.
+JOURNAL_FSYNC_INTERVAL = 10.0
+
+def journal_path():
+    return os.path.join(data_directory(), JOURNAL_FILENAME)
+
+# What the card file looks like now, so replaying can tell whether it was changed by something else since
+def _fileState(card):
+    try:
+        stat = os.stat(card)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+def _line(card, record):
+    return (json.dumps(card) + "\t" + json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8", "surrogatepass")
+
+# A field's value after a "splice" or "replace" record
+def apply_record(value, record):
+    if record[0] == "splice":
+        _kind, _field, start, removedLength, inserted = record
+        return value[:start] + inserted + value[start + removedLength:]
+    return record[2]
+
+# True if the card file isn't the one a card's records were made against
+def changed_on_disk(card, records):
+    return not records or records[0][0] != "base" or records[0][1] is None or records[0][1] != _fileState(card)
+
+class AutosaveJournal:
+    def __init__(self, path=None):
+        self.path = path or journal_path()
+        self.lock = threading.Lock() # guards pending, cards and written, which the GUI thread changes
+        self.writeLock = threading.Lock() # one flush at a time
+        self.pending = [] # (card, record, encoded line or None) not written yet
+        self.cards = set() # cards recorded this session since they were last cleared or released
+        self.written = set() # cards with records in the file since they were last cleared, from any session
+        self.compactionNeeded = False
+        self.file = None
+        self.unsynced = False
+        self.lastSync = time.monotonic()
+        with self.writeLock:
+            self._compact()
+            self.written.update(self._read())
+
+    # The records in the journal file for each card since it was last cleared, only for cards in
+    # directory, or only for card, if it's given. Records of other cards aren't decoded.
+    def _read(self, directory=None, card=None):
+        cards = {}
+        try:
+            with open(self.path, "rb") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return cards
+        for line in lines:
+            if not line.endswith(b"\n"):
+                break # cut off by a crash part way through a write
+            try:
+                cardJSON, _tab, recordJSON = line.decode("utf-8", "surrogatepass").partition("\t")
+                lineCard = json.loads(cardJSON)
+                if directory is not None and os.path.dirname(lineCard) != directory and not recordJSON.startswith('["clear"'):
+                    continue
+                if card is not None and lineCard != card:
+                    continue
+                record = json.loads(recordJSON)
+            except ValueError:
+                continue
+            if record[0] == "clear":
+                cards.pop(lineCard, None)
+            else:
+                cards.setdefault(lineCard, []).append(record)
+        return cards
+
+    # Cards in directory with edits in the journal that no editor is recording any more, left over from an
+    # earlier run or from an editor that was released, card: records from the base record on. Flushes
+    # first, so this belongs on the thread that flushes rather than the GUI thread.
+    def restorableIn(self, directory):
+        self.flush()
+        with self.writeLock:
+            cards = self._read(os.path.abspath(directory))
+        with self.lock:
+            return {card: records for card, records in cards.items() if card not in self.cards}
+
+    # The edits a card has in the journal that no editor is recording, from its base record on, or None.
+    # For an editor that's about to start recording the card: it has to apply them, through record() like
+    # any other edit, or clear() them, since whatever it records starts the card over from its base.
+    # Records still waiting to be written are taken over rather than written, so nothing is fsynced here.
+    def unsavedRecords(self, card):
+        card = os.path.abspath(card)
+        with self.lock:
+            if card in self.cards or (card not in self.written and not any(item[0] == card for item in self.pending)):
+                return None
+        # a flush under way has already taken its records out of pending, they're read back once it's done
+        with self.writeLock:
+            with self.lock:
+                onDisk = card in self.written
+                taken = [record for itemCard, record, _line in self.pending if itemCard == card and record[0] != "clear"]
+                self.pending = [item for item in self.pending if item[0] != card or item[1][0] == "clear"]
+            records = self._read(card=card).get(card, []) if onDisk else []
+        return records + taken or None
+
+    # Must be called with lock held. The first record a session makes for a card after it was cleared or
+    # released says what file the records apply to. Records the journal still has for the card from before
+    # are cleared first rather than mixed up with the new ones, the editor has already applied them
+    # through unsavedRecords() or chosen to drop them.
+    def _start(self, card):
+        if card not in self.cards:
+            if card in self.written:
+                self.written.discard(card)
+                self.pending.append((card, ["clear"], None))
+                self.compactionNeeded = True
+            self.cards.add(card)
+            self.pending.append((card, ["base", _fileState(card)], None))
+
+    # Records a change as made by undo_history.diff
+    def record(self, card, field, change):
+        card = os.path.abspath(card)
+        if change[0] == "splice":
+            _kind, start, removed, inserted = change
+            record = ["splice", field, start, len(removed), inserted]
+        else:
+            record = ["replace", field, change[2]]
+        with self.lock:
+            self._start(card)
+            last = self.pending[-1] if self.pending else None
+            if last is not None and last[0] == card and last[2] is None and last[1][0] == record[0] and last[1][1] == field:
+                # typing at the end of what was typed just before, or replacing a value again, is folded
+                # into the record that's still waiting to be written
+                if record[0] == "replace":
+                    last[1][2] = record[2]
+                    return
+                if isinstance(inserted, str) and not removed and start == last[1][2] + len(last[1][4]):
+                    last[1][4] += inserted
+                    return
+            self.pending.append((card, record, None))
+
+    # Records that the card's whole data was replaced. data is encoded straight away since the editor
+    # goes on changing it.
+    def recordData(self, card, data):
+        card = os.path.abspath(card)
+        record = ["data", data]
+        with self.lock:
+            self._start(card)
+            self.pending.append((card, record, _line(card, record)))
+
+    # Drops a card's records, because it was saved, its edits were undone or they were restored or discarded
+    def clear(self, card):
+        card = os.path.abspath(card)
+        with self.lock:
+            if card in self.cards:
+                self.cards.discard(card)
+                self.pending = [item for item in self.pending if item[0] != card]
+            if card in self.written:
+                self.written.discard(card)
+                self.pending.append((card, ["clear"], None))
+                self.compactionNeeded = True
+
+    # Stops recording a card without dropping its records, because its editor was closed with the edits
+    # unsaved. They can be restored later through restorableIn.
+    def release(self, card):
+        with self.lock:
+            self.cards.discard(os.path.abspath(card))
+
+    # True if there's anything for flush() to do
+    def needsFlush(self):
+        return bool(self.pending) or self.unsynced
+
+    # Writes the pending records in one go, then compacts the journal if a card was cleared, or fsyncs it
+    # if it's been long enough. Safe to call from any thread.
+    def flush(self, sync=False):
+        with self.writeLock:
+            with self.lock:
+                pending, self.pending = self.pending, []
+                compact, self.compactionNeeded = self.compactionNeeded, False
+                # clear() has already taken cleared cards out of written
+                self.written.update(card for card, record, line in pending if record[0] != "clear")
+            if pending:
+                # records still pending were folded into while on the GUI thread, once they've been
+                # swapped out here nothing touches them any more
+                data = b"".join(line or _line(card, record) for card, record, line in pending)
+                if self.file is None:
+                    self.file = open(self.path, "ab")
+                self.file.write(data)
+                self.file.flush()
+                self.unsynced = True
+            if compact:
+                self._compact()
+            elif self.unsynced and (sync or time.monotonic() - self.lastSync >= JOURNAL_FSYNC_INTERVAL):
+                os.fsync(self.file.fileno())
+                self.unsynced = False
+                self.lastSync = time.monotonic()
+
+    # Must be called with writeLock held. Rewrites the journal with only the records of cards that haven't
+    # been cleared since, or removes it if there are none.
+    def _compact(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        kept = {} # card: lines, in the order cards first appear
+        try:
+            with open(self.path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    cardJSON, _tab, recordJSON = line.partition(b"\t")
+                    try:
+                        card = json.loads(cardJSON)
+                    except ValueError:
+                        continue
+                    if recordJSON.startswith(b'["clear"'):
+                        kept.pop(card, None)
+                    else:
+                        kept.setdefault(card, []).append(line)
+        except FileNotFoundError:
+            pass
+        if kept:
+            temporaryPath = self.path + ".tmp"
+            with open(temporaryPath, "wb") as f:
+                for lines in kept.values():
+                    f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporaryPath, self.path)
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+        self.unsynced = False
+        self.lastSync = time.monotonic()
+
+    # Writes and fsyncs everything, for when the editor closes. Edits to cards that weren't saved stay in
+    # the journal to be offered next time.
+    def close(self):
+        self.flush(sync=True)
+        with self.writeLock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,440 @@
+import argparse
+import base64
+import gc
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+from png_chunks import PNG_SIGNATURE, build_text_chunk
+from character_card import base
+
+# Benchmarks for reading, scanning, opening, saving and exporting cards, run against synthetic card
+# directories that are generated the same way every time from a seed. Each case runs in a fresh
+# process so its peak memory use isn't muddied by the cases before it. The GUI paths run on Qt's
+# offscreen platform and are skipped if PyQt5 isn't installed.
+#
+#   python benchmark.py run --preset quick --output before.json
+#   python benchmark.py run --cards 100,50000 --entries 0 --output after.json
+#   python benchmark.py compare before.json after.json
+#   python benchmark.py generate --cards 1000 --entries 500 corpus/
+
+BENCHMARK_FORMAT_VERSION = 1
+DEFAULT_SEED = 1
+# How many cards the per-card operations are timed over. Scans always cover the whole directory.
+DEFAULT_SAMPLE = 100
+GUI_SCAN_TIMEOUT = 600 # seconds
+
+# Each preset is a baseline case and the values to try for each axis. Axes are swept one at a time
+# with the others held at the baseline, a full cross product of the large values would take days.
+PRESETS = {
+    "quick": ({"cards": 100, "entries": 10, "size": 256, "format": "v2"},
+              {"cards": [100, 1000], "entries": [0, 1000], "size": [256, 512], "format": ["v1", "v2"]}),
+    "standard": ({"cards": 500, "entries": 100, "size": 512, "format": "v2"},
+                 {"cards": [100, 1000, 10000], "entries": [0, 100, 1000, 5000], "size": [256, 512, 1024], "format": ["v1", "v2"]}),
+    "full": ({"cards": 1000, "entries": 100, "size": 512, "format": "v2"},
+             {"cards": [100, 1000, 10000, 50000], "entries": [0, 100, 1000, 10000], "size": [256, 512, 1024, 2048], "format": ["v1", "v2"]}),
+}
+
+WORDS = ("the", "a", "old", "castle", "river", "sword", "quiet", "merchant", "storm", "lantern", "north", "village",
+         "secret", "guild", "dragon", "tavern", "she", "he", "they", "walks", "remembers", "hides", "sings", "carefully",
+         "never", "always", "beneath", "across", "silver", "ember", "winter", "oath", "forgotten", "library", "ship")
+
+def sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+def paragraph(rng, words):
+    sentences = []
+    while words > 0:
+        length = min(words, rng.randint(6, 16))
+        sentences.append(sentence(rng, length))
+        words -= length
+    return " ".join(sentences)
+
+def synthetic_entry(rng, number):
+    return {
+        "keys": ["%s%d" % (rng.choice(WORDS), number), rng.choice(WORDS)],
+        "content": paragraph(rng, rng.randint(20, 120)),
+        "extensions": {},
+        "enabled": rng.random() > 0.1,
+        "insertion_order": number,
+        "name": "Entry %d" % number,
+        "secondary_keys": [],
+    }
+
+# A character dict in the given format. V1 cards have no character book, so entries only applies to V2.
+def synthetic_character(rng, number, entries, spec):
+    fields = {
+        "name": "Synthetic %d" % number,
+        "description": paragraph(rng, 200),
+        "personality": paragraph(rng, 40),
+        "scenario": paragraph(rng, 60),
+        "first_mes": paragraph(rng, 80),
+        "mes_example": paragraph(rng, 150),
+    }
+    if spec == "v1":
+        return fields
+    data = json.loads(json.dumps(base))
+    data["data"].update(fields)
+    data["data"]["tags"] = sorted(set(rng.choice(WORDS) for _ in range(4)))
+    data["data"]["alternate_greetings"] = [paragraph(rng, 40) for _ in range(2)]
+    data["data"]["creator"] = "benchmark"
+    if entries:
+        data["data"]["character_book"] = {"name": "Lore %d" % number, "entries": [synthetic_entry(rng, i) for i in range(entries)], "extensions": {}}
+    return data
+
+def _chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+# The IHDR and IDAT chunks of a size x size RGB image. Rows are made of short runs of random colours
+# so the data compresses about as well as a real picture would, instead of not at all (noise) or
+# completely (a flat colour). All cards of one size share the same image.
+def synthetic_image_chunks(size, seed):
+    rng = random.Random(seed)
+    rows = []
+    for _ in range(16):
+        row = bytearray(b'\x00') # no filter
+        while len(row) < 1 + size * 3:
+            row += rng.randbytes(3) * rng.randint(2, 12)
+        rows.append(bytes(row[:1 + size * 3]))
+    pixels = b''.join(rows[rng.randrange(len(rows))] for _ in range(size))
+    header = _chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0))
+    return header, _chunk(b'IDAT', zlib.compress(pixels, 6))
+
+# Writes a directory of synthetic cards. Returns the card paths.
+def generate_corpus(directory, cards, entries, size, spec, seed=DEFAULT_SEED):
+    os.makedirs(directory, exist_ok=True)
+    header, imageData = synthetic_image_chunks(size, seed)
+    end = _chunk(b'IEND', b'')
+    paths = []
+    for number in range(cards):
+        rng = random.Random("%d-%d" % (seed, number))
+        character = synthetic_character(rng, number, entries, spec)
+        text = base64.b64encode(json.dumps(character).encode('utf-8')).decode('utf-8')
+        path = os.path.join(directory, "card%06d.png" % number)
+        with open(path, "wb") as f:
+            f.write(PNG_SIGNATURE + header + build_text_chunk('chara', text) + imageData + end)
+        paths.append(path)
+    return paths
+
+def case_key(case):
+    return "cards=%(cards)d entries=%(entries)d size=%(size)d format=%(format)s" % case
+
+# The cases for a preset, with any axes the user gave on the command line replacing the preset's
+def build_cases(preset, axes):
+    baseline, presetAxes = PRESETS[preset]
+    presetAxes = dict(presetAxes, **{axis: values for axis, values in axes.items() if values})
+    cases = []
+    for axis, values in presetAxes.items():
+        for value in values:
+            case = dict(baseline, **{axis: value})
+            if case["format"] == "v1":
+                case["entries"] = 0
+            if case not in cases:
+                cases.append(case)
+    return cases
+
+# Highest resident set size of this process so far, None where it can't be measured
+def peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def measure(results, name, count, function):
+    gc.collect()
+    started = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - started
+    results[name] = {
+        "seconds": round(seconds, 6),
+        "cards": count,
+        "cards_per_second": round(count / seconds, 3) if seconds > 0 else None,
+        # a high-water mark for the whole case, so it includes the operations that ran before this one
+        "peak_rss_bytes": peak_rss_bytes(),
+    }
+
+# Imports the GUI script, which can't be imported by name because of the spaces in its filename.
+# Returns None if PyQt5 isn't available.
+def load_editor_module():
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    try:
+        import PyQt5
+    except ImportError:
+        return None
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tavernAI character editor.py")
+    spec = importlib.util.spec_from_file_location("tavernai_character_editor", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# Points the editor's caches, and its data files like the autosave journal, at a directory of their
+# own so that every case starts cold and the user's own files are left alone
+def isolate_caches(directory):
+    os.environ["XDG_CACHE_HOME"] = directory
+    os.environ["LOCALAPPDATA"] = directory
+    os.environ["XDG_DATA_HOME"] = directory
+    os.environ["APPDATA"] = directory
+    if sys.platform == "darwin":
+        os.environ["HOME"] = directory
+
+def run_core_benchmarks(results, corpus, paths, sample, work):
+    from card_index import CardIndex
+    from character_card import read_character, write_character
+
+    indexPath = os.path.join(work, "index.sqlite3")
+    def scan():
+        index = CardIndex(corpus, indexPath)
+        index.refresh()
+        index.close()
+    measure(results, "scan_cold", len(paths), scan)
+    measure(results, "scan_warm", len(paths), scan)
+
+    characters = []
+    measure(results, "read", len(sample), lambda: characters.extend(read_character(path) for path in sample))
+
+    def save():
+        for path, data in zip(sample, characters):
+            data["data"]["name"] = "Saved " + os.path.basename(path)
+            write_character(path, data)
+    measure(results, "save", len(sample), save)
+
+    exportDirectory = os.path.join(work, "export")
+    os.makedirs(exportDirectory, exist_ok=True)
+    def export():
+        for path, data in zip(sample, characters):
+            with open(os.path.join(exportDirectory, os.path.basename(path)[:-3] + "json"), "w", encoding="utf-8") as f:
+                json.dump(data, f)
+    measure(results, "export", len(sample), export)
+
+def run_gui_benchmarks(results, editorModule, corpus, paths, sample, work):
+    app = editorModule.QApplication.instance() or editorModule.QApplication([])
+
+    def settle(condition=lambda: True, timeout=GUI_SCAN_TIMEOUT):
+        deadline = time.perf_counter() + timeout
+        app.processEvents()
+        while not condition():
+            if time.perf_counter() > deadline:
+                raise TimeoutError("GUI didn't finish in %d seconds" % timeout)
+            time.sleep(0.001)
+            app.processEvents()
+
+    # MainWindow starts out showing the working directory
+    previousDirectory = os.getcwd()
+    os.chdir(corpus)
+    try:
+        windows = []
+        def scan():
+            # the default pool size rather than whatever the user's settings say, so runs compare
+            window = editorModule.MainWindow(editorModule.EDITOR_POOL_SIZE)
+            window.show()
+            windows.append(window)
+            settle(lambda: window.imageList.progressBar.isHidden())
+        measure(results, "gui_scan", len(paths), scan)
+        window = windows[0]
+        imageList = window.imageList
+
+        # the card list and the editor pool key cards by the directory as the window has it joined with
+        # the filename, which is what a click on the list passes
+        def openCards():
+            for path in sample:
+                imageList.showImage(os.path.join(imageList.cardIndex.directory, os.path.basename(path)))
+                settle()
+        measure(results, "editor_open", len(sample), openCards)
+        editors = list(imageList.editors.values())
+
+        def toggleView():
+            for editor in editors:
+                checkbox = editor.characterBookEdit.view_checkbox
+                checkbox.setChecked(False)
+                settle()
+                checkbox.setChecked(True)
+                settle()
+        measure(results, "editor_toggle_view", len(editors), toggleView)
+
+        def save():
+            for editor in editors:
+                editor.nameEdit.setText("Edited " + os.path.basename(editor.filePath))
+                editor.saveClicked()
+            settle()
+        measure(results, "editor_save", len(editors), save)
+
+        exportDirectory = os.path.join(work, "gui_export")
+        os.makedirs(exportDirectory, exist_ok=True)
+        # exportClicked asks for a filename, so this does what it does after the dialog
+        def export():
+            for editor in editors:
+                editor.updateDataFromUI()
+                with open(os.path.join(exportDirectory, os.path.basename(editor.filePath)[:-3] + "json"), "w", encoding="utf-8") as f:
+                    f.write(editor.encoder.encode(editor.fullData))
+        measure(results, "editor_export", len(editors), export)
+        window.close()
+        settle()
+    finally:
+        os.chdir(previousDirectory)
+
+# Runs in a worker process of its own
+def run_case(case, options):
+    work = tempfile.mkdtemp(prefix="card_benchmark_")
+    try:
+        isolate_caches(os.path.join(work, "cache"))
+        if options.get("corpus_dir"):
+            corpus = os.path.join(options["corpus_dir"], case_key(case).replace(" ", "_"))
+        else:
+            corpus = os.path.join(work, "corpus")
+        started = time.perf_counter()
+        if os.path.isdir(corpus) and len(os.listdir(corpus)) == case["cards"]:
+            paths = sorted(os.path.join(corpus, name) for name in os.listdir(corpus))
+        else:
+            shutil.rmtree(corpus, ignore_errors=True)
+            paths = generate_corpus(corpus, case["cards"], case["entries"], case["size"], case["format"], options["seed"])
+        generateSeconds = time.perf_counter() - started
+        step = max(1, len(paths) // options["sample"])
+        sample = paths[::step][:options["sample"]]
+
+        results = {}
+        run_core_benchmarks(results, corpus, paths, sample, work)
+        skipped = None
+        if options.get("gui"):
+            editorModule = load_editor_module()
+            if editorModule is None:
+                skipped = "PyQt5 is not installed"
+            else:
+                run_gui_benchmarks(results, editorModule, corpus, paths, sample, work)
+        else:
+            skipped = "--no-gui"
+        return {
+            "case": case,
+            "key": case_key(case),
+            "corpus_bytes": sum(os.path.getsize(path) for path in paths),
+            "generate_seconds": round(generateSeconds, 3),
+            "gui_skipped": skipped,
+            "results": results,
+        }
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    axes = {"cards": parse_list(args.cards, int), "entries": parse_list(args.entries, int),
+            "size": parse_list(args.size, int), "format": parse_list(args.format, str)}
+    options = {"seed": args.seed, "sample": max(args.sample, 1), "gui": not args.no_gui, "corpus_dir": args.corpus_dir}
+    report = {
+        "format_version": BENCHMARK_FORMAT_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "preset": args.preset,
+        "seed": args.seed,
+        "sample": options["sample"],
+        "cases": [],
+    }
+    context = multiprocessing.get_context("spawn")
+    for case in build_cases(args.preset, axes):
+        if not args.quiet:
+            print("running %s" % case_key(case), file=sys.stderr)
+        # a new process per case, so peak RSS is the case's own
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            report["cases"].append(executor.submit(run_case, case, options).result())
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    return 0
+
+# Prints how each operation's time changed between two reports. Returns 1 if anything got slower
+# by more than the threshold.
+def compare(args):
+    with open(args.before, "r", encoding="utf-8") as f:
+        before = json.load(f)
+    with open(args.after, "r", encoding="utf-8") as f:
+        after = json.load(f)
+    beforeCases = {case["key"]: case for case in before["cases"]}
+    regressed = False
+    for case in after["cases"]:
+        old = beforeCases.get(case["key"])
+        if old is None:
+            continue
+        for name, result in case["results"].items():
+            oldResult = old["results"].get(name)
+            if oldResult is None or not oldResult["seconds"]:
+                continue
+            ratio = result["seconds"] / oldResult["seconds"]
+            flag = ""
+            if args.threshold and ratio > args.threshold:
+                flag = " REGRESSION"
+                regressed = True
+            print("%-55s %-20s %10.4fs %10.4fs %6.2fx%s" % (case["key"], name, oldResult["seconds"], result["seconds"], ratio, flag))
+    return 1 if regressed else 0
+
+def generate(args):
+    paths = generate_corpus(args.directory, args.cards, args.entries, args.size, args.format, args.seed)
+    print("wrote %d cards to %s" % (len(paths), args.directory))
+    return 0
+
+def parse_list(text, kind):
+    if not text:
+        return None
+    return [kind(item) for item in text.split(",") if item.strip()]
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmarks for the character editor on synthetic card directories.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    runParser = commands.add_parser("run", help="run the benchmarks and write a JSON report")
+    runParser.add_argument("--preset", choices=sorted(PRESETS), default="quick")
+    runParser.add_argument("--cards", help="comma-separated card counts, replaces the preset's")
+    runParser.add_argument("--entries", help="comma-separated character book sizes, replaces the preset's")
+    runParser.add_argument("--size", help="comma-separated image sizes in pixels, replaces the preset's")
+    runParser.add_argument("--format", help="comma-separated card formats (v1, v2), replaces the preset's")
+    runParser.add_argument("--sample", type=int, default=DEFAULT_SAMPLE, help="number of cards the per-card operations are timed over")
+    runParser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    runParser.add_argument("--corpus-dir", help="keep generated corpora here and reuse them on later runs")
+    runParser.add_argument("--no-gui", action="store_true", help="skip the Qt benchmarks")
+    runParser.add_argument("--output", "-o", help="write the report to this file instead of standard output")
+    runParser.add_argument("--quiet", "-q", action="store_true")
+    runParser.set_defaults(function=run)
+
+    compareParser = commands.add_parser("compare", help="compare two reports")
+    compareParser.add_argument("before")
+    compareParser.add_argument("after")
+    compareParser.add_argument("--threshold", type=float, help="exit with status 1 if an operation got slower by more than this factor")
+    compareParser.set_defaults(function=compare)
+
+    generateParser = commands.add_parser("generate", help="write a synthetic card directory")
+    generateParser.add_argument("directory")
+    generateParser.add_argument("--cards", type=int, default=100)
+    generateParser.add_argument("--entries", type=int, default=10)
+    generateParser.add_argument("--size", type=int, default=512)
+    generateParser.add_argument("--format", choices=("v1", "v2"), default="v2")
+    generateParser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    generateParser.set_defaults(function=generate)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.function(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
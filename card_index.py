@@ -0,0 +1,301 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+from app_paths import cache_directory
+from profiling import timed
+from character_card import find_character_text, decode_character_text, character_spec_version, normalize_character
+
+# A per-directory SQLite index of card summaries, so the thumbnail list can be filled without parsing
+# every card. Cards are only re-read when their size or mtime no longer match what's stored.
+
+INDEX_SCHEMA_VERSION = 3
+
+# The card fields that go into the full-text search index, besides the character book entries
+SEARCH_FIELDS = ("name", "description", "personality", "scenario", "first_mes", "mes_example", "alternate_greetings")
+SEARCH_RESULT_LIMIT = 200
+# Search rows get rowids of (card id << SEARCH_ROWID_SHIFT) + row number, so that all of a card's rows
+# can be deleted with a cheap rowid range rather than a scan of the whole search table
+SEARCH_ROWID_SHIFT = 24
+
+SUMMARY_FIELDS = ("filename", "name", "creator", "tags", "character_version", "entry_count", "spec_version",
+                  "byte_size", "mtime_ns", "content_hash", "chara_offset", "chara_length")
+
+# What the card list keeps about every card in the directory. The full character data is only decoded
+# when a card is opened, so browsing a big library holds a small fixed set of fields per card rather
+# than every card's greetings, examples and lorebook. chara_offset and chara_length locate the card's
+# 'chara' chunk in the file, so opening it doesn't have to look for the chunk again. They're -1 and 0
+# for images without one.
+class CardSummary:
+    __slots__ = SUMMARY_FIELDS
+
+    def __init__(self, filename, name, creator, tags, character_version, entry_count, spec_version,
+                 byte_size, mtime_ns, content_hash, chara_offset=-1, chara_length=0):
+        self.filename = filename
+        self.name = name
+        self.creator = creator
+        self.tags = tuple(tags)
+        self.character_version = character_version
+        self.entry_count = entry_count
+        self.spec_version = spec_version
+        self.byte_size = byte_size
+        self.mtime_ns = mtime_ns
+        self.content_hash = content_hash
+        self.chara_offset = chara_offset
+        self.chara_length = chara_length
+
+    # The (offset, length) that read_character takes, None if the image has no character data
+    def charaLocation(self):
+        if self.chara_offset < 0:
+            return None
+        return self.chara_offset, self.chara_length
+
+    def __eq__(self, other):
+        return isinstance(other, CardSummary) and all(getattr(self, field) == getattr(other, field) for field in SUMMARY_FIELDS)
+
+    def __repr__(self):
+        return "CardSummary(%s)" % ", ".join("%s=%r" % (field, getattr(self, field)) for field in SUMMARY_FIELDS)
+
+# Builds the summary stored in the index from a normalized (V2) character dict
+def summarize_character(filename, data, specVersion, stat, contentHash, charaOffset=-1, charaLength=0):
+    data = data["data"]
+    tags = data.get("tags", [])
+    return CardSummary(
+        filename=filename,
+        name=str(data.get("name") or ""),
+        creator=str(data.get("creator") or ""),
+        tags=[str(tag) for tag in tags] if isinstance(tags, list) else [],
+        character_version=str(data.get("character_version") or ""),
+        entry_count=len(data.get("character_book", {}).get("entries", [])),
+        spec_version=specVersion,
+        byte_size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+        content_hash=contentHash,
+        chara_offset=charaOffset,
+        chara_length=charaLength,
+    )
+
+# Reads a card and returns (summary, data), where data is the full normalized character dict
+@timed("read_summary")
+def read_summary(path, stat=None):
+    if stat is None:
+        stat = os.stat(path)
+    found = find_character_text(path)
+    offset, length, text = found if found is not None else (-1, 0, None)
+    raw = decode_character_text(text)
+    specVersion = character_spec_version(raw) if text is not None else ""
+    contentHash = hashlib.sha1(text.encode("utf-8")).hexdigest() if text is not None else ""
+    data = normalize_character(raw)
+    return summarize_character(os.path.basename(path), data, specVersion, stat, contentHash, offset, length), data
+
+# Yields (number, entry, field, text) rows for the search index. number is unique within the card,
+# entry is the character book entry's position, or -1 for the card's own fields.
+def search_rows(data):
+    data = data["data"]
+    for number, field in enumerate(SEARCH_FIELDS):
+        value = data.get(field)
+        if isinstance(value, list):
+            value = "\n".join(str(item) for item in value)
+        if value:
+            yield number, -1, field, str(value)
+    characterBook = data.get("character_book")
+    if not isinstance(characterBook, dict):
+        return
+    for position, entry in enumerate(characterBook.get("entries", [])):
+        if not isinstance(entry, dict):
+            continue
+        keys = []
+        for field in ("keys", "secondary_keys"):
+            value = entry.get(field)
+            if isinstance(value, list):
+                keys += [str(key) for key in value]
+        text = ", ".join(keys) + "\n" + str(entry.get("content") or "")
+        yield len(SEARCH_FIELDS) + position, position, "entry", text
+
+# Turns what the user typed into an FTS5 query: every word must appear, and the last one may be a
+# prefix so results show up while typing
+def fts_query(text):
+    words = text.split()
+    if not words:
+        return None
+    terms = ['"%s"' % word.replace('"', '""') for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+# Where the index for a directory lives. Indexes go in the user's cache directory rather than next to
+# the cards so read-only and shared card directories work too.
+def index_path_for_directory(directory):
+    key = hashlib.sha1(os.path.abspath(directory).encode("utf-8")).hexdigest()
+    return os.path.join(cache_directory("index"), key + ".sqlite3")
+
+class CardIndex:
+    # The connection is shared between the scan's worker threads, guarded by self.lock
+    def __init__(self, directory, indexPath=None):
+        self.directory = directory
+        self.indexPath = indexPath or index_path_for_directory(directory)
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(self.indexPath, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] != INDEX_SCHEMA_VERSION:
+            self.connection.execute("DROP TABLE IF EXISTS cards")
+            self.connection.execute("DROP TABLE IF EXISTS search")
+            self.connection.execute("PRAGMA user_version=%d" % INDEX_SCHEMA_VERSION)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS cards (
+            id INTEGER PRIMARY KEY,
+            filename TEXT NOT NULL UNIQUE,
+            name TEXT NOT NULL,
+            creator TEXT NOT NULL,
+            tags TEXT NOT NULL,
+            character_version TEXT NOT NULL,
+            entry_count INTEGER NOT NULL,
+            spec_version TEXT NOT NULL,
+            byte_size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            content_hash TEXT NOT NULL,
+            chara_offset INTEGER NOT NULL,
+            chara_length INTEGER NOT NULL)""")
+        # Full-text search over the cards' text. Older SQLite builds may lack FTS5, in which case
+        # searching just isn't available.
+        try:
+            self.connection.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(
+                entry UNINDEXED, field UNINDEXED, text)""")
+            self.searchAvailable = True
+        except sqlite3.OperationalError:
+            self.searchAvailable = False
+        self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+    def commit(self):
+        with self.lock:
+            self.connection.commit()
+
+    # Stats every PNG in the directory, returns {filename: os.stat_result}
+    def statDirectory(self):
+        stats = {}
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".png") and entry.is_file():
+                    stats[entry.name] = entry.stat()
+        return stats
+
+    def _rowToSummary(self, row):
+        values = list(row)
+        values[SUMMARY_FIELDS.index("tags")] = json.loads(values[SUMMARY_FIELDS.index("tags")])
+        return CardSummary(*values)
+
+    def summaries(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT %s FROM cards ORDER BY filename" % ", ".join(SUMMARY_FIELDS)).fetchall()
+        return [self._rowToSummary(row) for row in rows]
+
+    def summary(self, filename):
+        with self.lock:
+            row = self.connection.execute("SELECT %s FROM cards WHERE filename = ?" % ", ".join(SUMMARY_FIELDS), (filename,)).fetchone()
+        return self._rowToSummary(row) if row else None
+
+    # Compares the directory against the index. Returns (unchanged, changed) where unchanged maps
+    # filenames to their stored summaries and changed is a list of filenames that need to be re-read.
+    # Rows for files that no longer exist are deleted.
+    def diff(self, stats=None):
+        if stats is None:
+            stats = self.statDirectory()
+        with self.lock:
+            rows = self.connection.execute("SELECT %s FROM cards" % ", ".join(SUMMARY_FIELDS)).fetchall()
+            known = {row[0]: row for row in rows}
+            deleted = [filename for filename in known if filename not in stats]
+            for filename in deleted:
+                self.remove(filename)
+            if deleted:
+                self.connection.commit()
+        unchanged = {}
+        changed = []
+        for filename, stat in stats.items():
+            row = known.get(filename)
+            if row is not None and row[7] == stat.st_size and row[8] == stat.st_mtime_ns:
+                unchanged[filename] = self._rowToSummary(row)
+            else:
+                changed.append(filename)
+        return unchanged, changed
+
+    # Stores a summary. Changes aren't committed until commit() is called, so a scan's worth of
+    # updates goes in as one transaction.
+    # Existing rows are updated in place so the card keeps its id.
+    def store(self, summary):
+        values = [getattr(summary, field) for field in SUMMARY_FIELDS]
+        values[SUMMARY_FIELDS.index("tags")] = json.dumps(list(summary.tags))
+        with self.lock:
+            self.connection.execute("INSERT INTO cards (%s) VALUES (%s) ON CONFLICT(filename) DO UPDATE SET %s" % (
+                ", ".join(SUMMARY_FIELDS), ", ".join("?" * len(SUMMARY_FIELDS)),
+                ", ".join("%s = excluded.%s" % (field, field) for field in SUMMARY_FIELDS[1:])), values)
+
+    def _cardId(self, filename):
+        row = self.connection.execute("SELECT id FROM cards WHERE filename = ?", (filename,)).fetchone()
+        return row[0] if row else None
+
+    def _deleteText(self, cardId):
+        self.connection.execute("DELETE FROM search WHERE rowid >= ? AND rowid < ?",
+                                (cardId << SEARCH_ROWID_SHIFT, (cardId + 1) << SEARCH_ROWID_SHIFT))
+
+    # Replaces the card's rows in the search index. The card's summary must already be stored.
+    def storeText(self, filename, data):
+        if not self.searchAvailable:
+            return
+        with self.lock:
+            cardId = self._cardId(filename)
+            self._deleteText(cardId)
+            rows = [((cardId << SEARCH_ROWID_SHIFT) + number, entry, field, text) for number, entry, field, text in search_rows(data)]
+            self.connection.executemany("INSERT INTO search (rowid, entry, field, text) VALUES (?, ?, ?, ?)", rows)
+
+    def remove(self, filename):
+        with self.lock:
+            cardId = self._cardId(filename)
+            if cardId is None:
+                return
+            if self.searchAvailable:
+                self._deleteText(cardId)
+            self.connection.execute("DELETE FROM cards WHERE id = ?", (cardId,))
+
+    # Re-reads one card and stores its summary and text, returns (summary, data). If the card can't be
+    # read any more its rows are deleted before the error is raised, so it doesn't keep turning up in
+    # searches as it was.
+    def update(self, filename):
+        try:
+            summary, data = read_summary(os.path.join(self.directory, filename))
+        except Exception:
+            self.remove(filename)
+            raise
+        with self.lock:
+            self.store(summary)
+            self.storeText(filename, data)
+        return summary, data
+
+    # Returns the best matches for the query, best first, as dicts with the card's filename and name,
+    # the entry position (-1 for the card's own fields), the field and a snippet of the matching text
+    def search(self, text, limit=SEARCH_RESULT_LIMIT):
+        query = fts_query(text)
+        if query is None or not self.searchAvailable:
+            return []
+        with self.lock:
+            rows = self.connection.execute("""SELECT cards.filename, cards.name, search.entry, search.field,
+                snippet(search, 2, '[', ']', '...', 12) FROM search JOIN cards ON cards.id = (search.rowid >> %d)
+                WHERE search MATCH ? ORDER BY search.rank LIMIT ?""" % SEARCH_ROWID_SHIFT, (query, limit)).fetchall()
+        return [{"filename": row[0], "name": row[1], "entry": row[2], "field": row[3], "snippet": row[4]} for row in rows]
+
+    # Brings the whole index up to date in one go and returns every summary, sorted by filename. The
+    # GUI does this progressively with diff() and update() instead.
+    def refresh(self):
+        unchanged, changed = self.diff()
+        for filename in changed:
+            try:
+                self.update(filename)
+            except Exception:
+                continue # unreadable card, update() has taken it out of the index
+        self.commit()
+        return self.summaries()
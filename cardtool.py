@@ -0,0 +1,282 @@
+import argparse
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from character_card import read_character, write_character, load_worldbook, validate_character, \
+    read_character_text, decode_character_text, character_spec_version, normalize_character, merge_worldbooks_into_card, \
+    DUPLICATE_POLICIES, DUPLICATES_SKIP
+from tokenizer import default_counter
+from duplicates import find_duplicates
+
+# Command-line batch processing of character card directories, for running without a display. Every
+# card is handled in a separate worker process and the results are written out as one JSON summary.
+#
+#   python cardtool.py stats cards/
+#   python cardtool.py validate --jobs 16 cards/ more_cards/
+#   python cardtool.py export-json --output-dir exported/ cards/
+#   python cardtool.py merge-worldbook --worldbook setting.json --dry-run cards/
+#   python cardtool.py tokens --tokenizer tokenizer.json --top 50 cards/
+#   python cardtool.py duplicates cards/ more_cards/
+
+# How many cards each worker process may have queued up at once. Keeps memory flat on huge directories.
+TASKS_PER_WORKER = 4
+# How many of the heaviest cards the tokens command lists by default
+HEAVIEST_CARD_COUNT = 20
+
+# Lists the PNG cards in the given directories, sorted so runs are reproducible
+def find_cards(directories, recursive=False):
+    paths = []
+    for directory in directories:
+        if os.path.isfile(directory):
+            paths.append(directory)
+            continue
+        if recursive:
+            for root, _dirs, files in os.walk(directory):
+                paths += [os.path.join(root, file) for file in files if file.endswith(".png")]
+        else:
+            paths += [os.path.join(directory, file) for file in os.listdir(directory) if file.endswith(".png")]
+    return sorted(paths)
+
+# Where a card's JSON goes for export-json and comes from for import-json
+def json_path(cardPath, directory=None):
+    jsonPath = cardPath[:-3] + "json"
+    if directory is not None:
+        jsonPath = os.path.join(directory, os.path.basename(jsonPath))
+    return jsonPath
+
+# The per-card tasks. They run in worker processes, so they're module level functions that take plain
+# arguments, and each returns a dict of results for the summary.
+
+def export_json_task(path, options):
+    data = read_character(path)
+    jsonPath = json_path(path, options.get("output_dir"))
+    with open(jsonPath, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    return {"json": jsonPath}
+
+def import_json_task(path, options):
+    jsonPath = json_path(path, options.get("input_dir"))
+    if not os.path.exists(jsonPath):
+        return {"skipped": "no %s" % jsonPath}
+    with open(jsonPath, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if not options.get("dry_run"):
+        write_character(path, data)
+    return {"json": jsonPath}
+
+def validate_task(path, options):
+    text = read_character_text(path)
+    if text is None:
+        return {"problems": ["no character data"]}
+    data = decode_character_text(text)
+    return {"problems": validate_character(data)}
+
+def stats_task(path, options):
+    text = read_character_text(path)
+    decoded = decode_character_text(text)
+    # the version has to be read before normalizing upgrades the card to V2
+    specVersion = character_spec_version(decoded) if text is not None else ""
+    data = normalize_character(decoded)
+    characterBook = data["data"].get("character_book") or {}
+    entries = characterBook.get("entries", [])
+    return {
+        "name": data["data"].get("name", ""),
+        "spec_version": specVersion,
+        "byte_size": os.path.getsize(path),
+        "chara_size": len(text) if text is not None else 0,
+        "entry_count": len(entries),
+        "alternate_greeting_count": len(data["data"].get("alternate_greetings", [])),
+        "tags": data["data"].get("tags", []),
+    }
+
+def merge_worldbook_task(path, options):
+    before, added, skipped, updated = merge_worldbooks_into_card(path, options["worldbooks"], options.get("dry_run"),
+                                                                 options.get("duplicates", DUPLICATES_SKIP))
+    return {"entries_before": before, "entries_added": added, "entries_skipped": skipped, "entries_updated": updated}
+
+def tokens_task(path, options):
+    data = read_character(path)
+    counts = default_counter(options.get("tokenizer") or "").count_card(data)
+    counts["name"] = data["data"].get("name", "")
+    return counts
+
+TASKS = {
+    "export-json": export_json_task,
+    "import-json": import_json_task,
+    "validate": validate_task,
+    "stats": stats_task,
+    "merge-worldbook": merge_worldbook_task,
+    "tokens": tokens_task,
+}
+
+# The options of the run, set once in each worker process so that big ones like merge-worldbook's parsed
+# worldbooks aren't sent along with every card
+_workerOptions = None
+
+def _initWorker(options):
+    global _workerOptions
+    _workerOptions = options
+
+def run_task(command, path, options=None):
+    if options is None:
+        options = _workerOptions
+    started = time.perf_counter()
+    try:
+        result = TASKS[command](path, options)
+        result["ok"] = True
+    except Exception as e:
+        result = {"ok": False, "error": "%s: %s" % (type(e).__name__, e), "traceback": traceback.format_exc()}
+    result["file"] = path
+    result["seconds"] = round(time.perf_counter() - started, 6)
+    return result
+
+# Runs the command over every card with at most jobs worker processes, yielding results as they
+# complete. Only a bounded number of tasks are submitted ahead of the workers.
+def run_parallel(command, paths, options, jobs):
+    if jobs <= 1:
+        for path in paths:
+            yield run_task(command, path, options)
+        return
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_initWorker, initargs=(options,)) as executor:
+        pending = set()
+        remaining = iter(paths)
+        for path in remaining:
+            pending.add(executor.submit(run_task, command, path))
+            if len(pending) >= jobs * TASKS_PER_WORKER:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in pending:
+            yield future.result()
+
+def summarize(command, results, seconds, top=HEAVIEST_CARD_COUNT):
+    failed = [result for result in results if not result["ok"]]
+    summary = {
+        "command": command,
+        "cards": len(results),
+        "succeeded": len(results) - len(failed),
+        "failed": len(failed),
+        "seconds": round(seconds, 3),
+        "results": sorted(results, key=lambda result: result["file"]),
+    }
+    if command == "validate":
+        summary["invalid"] = sum(1 for result in results if result.get("problems"))
+    elif command == "stats":
+        ok = [result for result in results if result["ok"]]
+        summary["totals"] = {
+            "byte_size": sum(result["byte_size"] for result in ok),
+            "chara_size": sum(result["chara_size"] for result in ok),
+            "entry_count": sum(result["entry_count"] for result in ok),
+            "spec_versions": {version: sum(1 for result in ok if result["spec_version"] == version)
+                              for version in sorted(set(result["spec_version"] for result in ok))},
+        }
+    elif command == "merge-worldbook":
+        for count in ("entries_added", "entries_skipped", "entries_updated"):
+            summary[count] = sum(result.get(count, 0) for result in results)
+    elif command == "tokens":
+        ok = [result for result in results if result["ok"]]
+        summary["total_tokens"] = sum(result["total"] for result in ok)
+        heaviest = sorted(ok, key=lambda result: (-result["total"], result["file"]))[:top]
+        summary["heaviest"] = [{"file": result["file"], "name": result["name"], "total": result["total"],
+                                "entries": result["entries"]} for result in heaviest]
+    return summary
+
+# The duplicates command compares the cards of each directory with each other rather than handling cards
+# one at a time. Cards whose signatures aren't cached yet are read in the worker processes.
+def run_duplicates(directories, jobs):
+    def findAll(mapper):
+        reports = []
+        for directory in directories:
+            report = find_duplicates(directory, mapper=mapper)
+            report["directory"] = directory
+            reports.append(report)
+        return reports
+    if jobs <= 1:
+        return findAll(None)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return findAll(lambda function, *iterables: executor.map(function, *iterables, chunksize=TASKS_PER_WORKER))
+
+def write_summary(summary, path=None):
+    if path:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=1)
+    else:
+        json.dump(summary, sys.stdout, indent=1)
+        print()
+
+def load_worldbooks(paths):
+    worldBooks = []
+    for path in paths:
+        worldBook = load_worldbook(path)
+        if worldBook is None:
+            raise ValueError("%s is not a worldbook" % path)
+        worldBooks.append(worldBook)
+    return worldBooks
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Batch processing for TavernAI character card directories.")
+    parser.add_argument("command", choices=sorted(list(TASKS) + ["duplicates"]))
+    parser.add_argument("directories", nargs="+", help="directories of PNG cards, or individual cards (except for duplicates)")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count() or 1, help="number of worker processes")
+    parser.add_argument("--recursive", "-r", action="store_true", help="include cards in subdirectories")
+    parser.add_argument("--summary", help="write the JSON summary to this file instead of standard output")
+    parser.add_argument("--output-dir", help="export-json: write JSON files here instead of next to the cards")
+    parser.add_argument("--input-dir", help="import-json: read JSON files from here instead of next to the cards")
+    parser.add_argument("--worldbook", action="append", default=[], help="merge-worldbook: worldbook JSON file, may be repeated")
+    parser.add_argument("--duplicates", choices=DUPLICATE_POLICIES, default=DUPLICATES_SKIP,
+                        help="merge-worldbook: what to do with entries the character book already has")
+    parser.add_argument("--dry-run", action="store_true", help="import-json and merge-worldbook: report without writing cards")
+    parser.add_argument("--tokenizer", help="tokens: tokenizer.json or SentencePiece .model file, the default is an approximate count")
+    parser.add_argument("--top", type=int, default=HEAVIEST_CARD_COUNT, help="tokens: how many of the heaviest cards to list")
+    parser.add_argument("--quiet", "-q", action="store_true", help="don't report failures on standard error as they happen")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == "duplicates":
+        notDirectories = [directory for directory in args.directories if not os.path.isdir(directory)]
+        if notDirectories:
+            print("duplicates needs directories: %s" % ", ".join(notDirectories), file=sys.stderr)
+            return 2
+        started = time.perf_counter()
+        reports = run_duplicates(args.directories, max(args.jobs, 1))
+        errors = [error for report in reports for error in report["errors"]]
+        if not args.quiet:
+            for error in errors:
+                print("%s: %s" % (error["file"], error["error"]), file=sys.stderr)
+        write_summary({"command": args.command, "directories": len(reports), "seconds": round(time.perf_counter() - started, 3),
+                       "failed": len(errors), "results": reports}, args.summary)
+        return 1 if errors else 0
+    options = {"output_dir": args.output_dir, "input_dir": args.input_dir, "dry_run": args.dry_run, "tokenizer": args.tokenizer,
+               "duplicates": args.duplicates}
+    if args.command == "merge-worldbook":
+        if not args.worldbook:
+            print("merge-worldbook needs at least one --worldbook", file=sys.stderr)
+            return 2
+        options["worldbooks"] = load_worldbooks(args.worldbook)
+    if args.command == "tokens":
+        # fails here rather than once per card in the workers
+        try:
+            default_counter(args.tokenizer or "")
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 2
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    started = time.perf_counter()
+    paths = find_cards(args.directories, args.recursive)
+    results = []
+    for result in run_parallel(args.command, paths, options, max(args.jobs, 1)):
+        if not result["ok"] and not args.quiet:
+            print("%s: %s" % (result["file"], result["error"]), file=sys.stderr)
+        results.append(result)
+    summary = summarize(args.command, results, time.perf_counter() - started, args.top)
+    write_summary(summary, args.summary)
+    return 1 if summary["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,382 @@
+import base64
+import hashlib
+import json
+
+from json_stream import JSONItemStream
+from png_chunks import find_text_chunk, read_text_chunk, read_text_chunk_at, write_text_chunk
+from profiling import timed, span
+
+# Reading and writing TavernAI character cards. Nothing in here depends on Qt.
+
+base = {
+    'spec': 'chara_card_v2',
+    'spec_version': '2.0',
+    'data': {
+        'name': '',
+        'description': "",
+        'personality': '',
+        'scenario': "",
+        'first_mes': '',
+        'mes_example': '',
+        'creator_notes': '',
+        'system_prompt': '',
+        'post_history_instructions': '',
+        'alternate_greetings': [],
+        'tags': [],
+        'creator': '',
+        'character_version': '',
+        'extensions': {}
+    }
+}
+
+# Extract JSON character data from an image. Handles both V1 and V2 TavernAI format, returns V2.
+# Creates a new character data dict if the image doesn't have one.
+# Only the PNG's chunk headers and the 'chara' chunk itself are read, the image data is skipped.
+# location is the (offset, length) of the 'chara' chunk from find_character_text, if it's known.
+@timed("read_character")
+def read_character(path, location=None):
+    return normalize_character(decode_character_text(read_character_text(path, location)))
+
+# The raw base64 'chara' text of an image, or None if it doesn't have any. When the chunk's location
+# is given it's read straight from there, unless the file has changed and it's no longer there.
+@timed("read_character_text")
+def read_character_text(path, location=None):
+    if location is not None:
+        text = read_text_chunk_at(path, location[0], location[1], 'chara')
+        if text is not None:
+            return text
+    return read_text_chunk(path, 'chara')
+
+# Returns (offset, length, text) of the image's 'chara' chunk, or None if it doesn't have one
+def find_character_text(path):
+    return find_text_chunk(path, 'chara')
+
+# Decodes the base64 'chara' text into whatever JSON it holds, V1 or V2
+@timed("decode_character_text")
+def decode_character_text(user_comment):
+    if user_comment == None:
+        return json.loads(json.dumps(base)) # deep copy of an empty character dictionary
+    base64_bytes = user_comment.encode('utf-8')  # Convert the base64 string to bytes
+    json_bytes = base64.b64decode(base64_bytes)  # Decode the base64 bytes to JSON bytes
+    json_str = json_bytes.decode('utf-8')  # Convert the JSON bytes to a string
+    return json.loads(json_str)  # Convert the string to JSON data
+
+# The card spec version of decoded character JSON, before normalize_character upgrades it
+def character_spec_version(data):
+    if data.get('spec') != 'chara_card_v2':
+        return '1.0'
+    return str(data.get('spec_version', '2.0'))
+
+# Upgrades decoded character JSON to V2 and fixes up malformed list fields
+def normalize_character(data):
+    if data.get('spec') != 'chara_card_v2':
+        newData = json.loads(json.dumps(base)) # deep copy of an empty character dictionary
+        newData["data"] = data
+        data = newData
+    if not isinstance(data["data"].get("tags", []), list):
+        data["data"]["tags"] = []
+    if not isinstance(data["data"].get("alternate_greetings", []), list):
+        data["data"]["alternate_greetings"] = []
+    if "character_book" in data["data"] and "entries" in data["data"]["character_book"]:
+        for entry in data["data"]["character_book"]["entries"]:
+            if not isinstance(entry.get("secondary_keys"), list):
+                entry["secondary_keys"] = []
+    return data
+
+# Turns character dicts into the same JSON text as json.dumps, but keeps the JSON of each field and of
+# each character book entry between calls. Re-encoding a card after a small edit then only encodes the
+# parts that changed, which matters for cards with thousands of lorebook entries.
+# Cached values are recognised by identity, so once a value has been encoded it must be replaced rather
+# than modified in place. Only the containers listed in WALKED are looked inside, and may be modified.
+class CharacterEncoder:
+    WALKED = ((), ('data',), ('data', 'character_book'), ('data', 'character_book', 'entries'))
+
+    def __init__(self):
+        # id(value): (value, json) for values in walked dicts, the value is kept so its id can't be
+        # reused. Walked lists are kept by their path as (item ids, items, item json, json).
+        self.cache = {}
+
+    def encode(self, data):
+        parts = []
+        used = {}
+        self._encode(data, (), parts, used)
+        self.cache = used # anything not used this time has been replaced, so it's dropped
+        # joined once at the end, building up the text level by level would copy it at every level
+        return ''.join(parts)
+
+    def _encode(self, value, path, parts, used):
+        if path in self.WALKED:
+            if isinstance(value, dict):
+                parts.append('{')
+                for position, (key, item) in enumerate(value.items()):
+                    parts.append('%s%s: ' % (', ' if position else '', json.dumps(key)))
+                    self._encode(item, path + (key,), parts, used)
+                parts.append('}')
+                return
+            if isinstance(value, list):
+                parts.append(self._encodeList(value, path, used))
+                return
+        cached = self.cache.get(id(value))
+        if cached is None or cached[0] is not value:
+            cached = (value, json.dumps(value))
+        used[id(value)] = cached
+        parts.append(cached[1])
+
+    # Lists are cached as a whole, so one whose items are all the same objects as last time costs no
+    # more than comparing their ids
+    def _encodeList(self, value, path, used):
+        ids = tuple(map(id, value))
+        cached = self.cache.get(path)
+        if cached is not None and cached[0] == ids:
+            used[path] = cached
+            return cached[3]
+        # the previous items are still referenced by cached, so a matching id means the same object
+        previous = dict(zip(cached[0], cached[2])) if cached is not None else {}
+        texts = [previous.get(itemId) or json.dumps(item) for itemId, item in zip(ids, value)]
+        text = '[' + ', '.join(texts) + ']'
+        used[path] = (ids, list(value), texts, text)
+        return text
+
+#Writes character data back to the image. Only the 'chara' chunk is replaced, the rest of the PNG is
+#copied over unchanged and the file is swapped in atomically. Pass the same CharacterEncoder each time
+#a card is saved to avoid re-encoding the parts of it that haven't changed.
+@timed("write_character")
+def write_character(path, data, encoder=None):
+    with span("write_character.encode"):
+        json_str = encoder.encode(data) if encoder is not None else json.dumps(data)
+        base64_str = base64.b64encode(json_str.encode('utf-8')).decode('utf-8')
+    with span("write_character.write_text_chunk"):
+        write_text_chunk(path, 'chara', base64_str)
+
+#ensures that agnai, sillytavern, and tavernai characterbooks all come out in the same
+#format, ready for insertion into a tavernai character
+@timed("process_worldbook")
+def process_worldbook(data):
+    if not isinstance(data, dict):
+        return None
+    if not "entries" in data:
+        if "spec" in data and data["spec"] =='chara_card_v2' and "data" in data and "character_book" in data["data"]:
+            return data["data"]["character_book"]        
+        return None
+    if isinstance(data["entries"], dict):
+        entries = list(data["entries"].values())
+        data["entries"] = entries
+    for entry in data["entries"]:
+        process_worldbook_entry(entry)
+    return data
+
+#the part of process_worldbook done to each entry
+def process_worldbook_entry(entry):
+    if isinstance(entry, dict) and "entry" in entry and entry.get("content") == entry.get("entry"):
+        del entry["entry"]
+        #The agnai worldbooks I've looked at have duplicte contents, I'm making an executive decision here
+        #to pare that down since the spec for tavernai characters would ignore this data anyway
+    return entry
+
+#Where the entries are in the JSON files process_worldbook accepts: worldbooks and exported characters
+WORLDBOOK_ENTRY_PATHS = (("entries",), ("data", "character_book", "entries"))
+WORLDBOOK_BATCH_SIZE = 1000
+
+#Reads a worldbook file a batch of entries at a time, for files too big to load all at once. Entries are
+#run through process_worldbook_entry as they're read.
+class WorldbookStream:
+    def __init__(self, path):
+        self.stream = JSONItemStream(path, WORLDBOOK_ENTRY_PATHS)
+
+    def batches(self, size):
+        for batch in self.stream.batches(size):
+            yield [process_worldbook_entry(entry) for entry in batch]
+
+    def progress(self):
+        return self.stream.progress()
+
+    #Once the batches have all been read, the rest of the worldbook (name, description, extensions and an
+    #empty entries list), or None if the file wasn't a worldbook
+    def worldbook(self):
+        if self.stream.itemPath == ("entries",):
+            return self.stream.document
+        if self.stream.itemPath is not None and self.stream.document.get("spec") == "chara_card_v2":
+            return self.stream.document["data"]["character_book"]
+        return None
+
+
+#reads a worldbook JSON file and runs it through process_worldbook, returns None if it isn't a worldbook.
+#The file is streamed, so the whole text is never held in memory alongside the parsed entries.
+def load_worldbook(path):
+    stream = WorldbookStream(path)
+    entries = [entry for batch in stream.batches(WORLDBOOK_BATCH_SIZE) for entry in batch]
+    worldBook = stream.worldbook()
+    if worldBook is not None:
+        worldBook["entries"] = entries
+    return worldBook
+
+#What import_worldbook does with a worldbook entry that matches one already in the character book (or
+#earlier in the worldbook): leave the existing one, overwrite it with the new one, or add it anyway
+DUPLICATES_SKIP = "skip"
+DUPLICATES_REPLACE = "replace"
+DUPLICATES_KEEP_BOTH = "keep-both"
+DUPLICATE_POLICIES = (DUPLICATES_SKIP, DUPLICATES_REPLACE, DUPLICATES_KEEP_BOTH)
+
+#Entries count as the same if they have the same keys, secondary keys and content, ignoring the order
+#and case of keys and differences in whitespace. Returns a hash of those, or None if it isn't an entry.
+def entry_identity(entry):
+    if not isinstance(entry, dict):
+        return None
+    identity = []
+    for field in ("keys", "secondary_keys"):
+        keys = entry.get(field) or []
+        if not isinstance(keys, list):
+            keys = [keys]
+        identity.append(sorted(set(str(key).strip().casefold() for key in keys) - {""}))
+    identity.append(" ".join(str(entry.get("content") or "").split()))
+    return hashlib.sha1(json.dumps(identity).encode("utf-8", "surrogatepass")).digest()
+
+#Merges worldbook entries into a character book, any number of batches at a time. Entries matching one
+#that's already there are handled according to duplicates, one of DUPLICATE_POLICIES, which takes a single
+#pass over each book however many entries there are. With copyEntries the entries added are copies, so
+#the same worldbook can be merged into other books too.
+class WorldbookMerger:
+    def __init__(self, characterBook, duplicates=DUPLICATES_SKIP, copyEntries=False):
+        if duplicates not in DUPLICATE_POLICIES:
+            raise ValueError("unknown duplicates policy %r" % duplicates)
+        self.characterBook = characterBook
+        self.duplicates = duplicates
+        self.copyEntries = copyEntries
+        self.entries = characterBook["entries"] = characterBook.get("entries", [])
+        self.start = len(self.entries)
+        self.replaced = {} # position: the entry that was there before, for rollback
+        self.added = self.skipped = self.updated = 0
+        self.positions = {} # entry identity: position in entries
+        if duplicates != DUPLICATES_KEEP_BOTH:
+            for position, entry in enumerate(self.entries):
+                self.positions.setdefault(entry_identity(entry), position)
+
+    #Merges a batch of entries. Those added are appended to the book's entries, returns the positions of
+    #the ones that were replaced. Replacing an entry with an identical one counts as skipping it.
+    def add(self, entries):
+        replacedPositions = []
+        for entry in entries:
+            position = self.positions.get(entry_identity(entry)) if self.duplicates != DUPLICATES_KEEP_BOTH else None
+            if position is not None and (self.duplicates == DUPLICATES_SKIP or self.entries[position] == entry):
+                self.skipped += 1
+                continue
+            if self.copyEntries:
+                entry = json.loads(json.dumps(entry))
+            if position is not None:
+                # the replacement keeps the id of the entry it replaces, in case anything refers to it
+                if isinstance(self.entries[position], dict) and "id" in self.entries[position]:
+                    entry["id"] = self.entries[position]["id"]
+                if position >= self.start:
+                    # the worldbook has the entry twice, the later copy takes the place of the one added
+                    # earlier in this import and nothing that was in the book changes
+                    self.skipped += 1
+                else:
+                    self.replaced.setdefault(position, self.entries[position])
+                    self.updated += 1
+                self.entries[position] = entry
+                replacedPositions.append(position)
+            else:
+                if self.duplicates != DUPLICATES_KEEP_BOTH:
+                    self.positions[entry_identity(entry)] = len(self.entries)
+                self.entries.append(entry)
+                self.added += 1
+        return replacedPositions
+
+    #Merges the worldbook's own fields, once its entries have been added
+    def finish(self, worldBook):
+        desc = worldBook.get("description", "")
+        if desc != "" and self.characterBook.get("description", "") == "":
+            self.characterBook["description"] = desc
+        name = worldBook.get("name", "")
+        if name != "" and self.characterBook.get("name", "") == "":
+            self.characterBook["name"] = name
+        worldExtensions = worldBook.get("extensions", {})
+        characterExtensions = self.characterBook.get("extensions", {})
+        self.characterBook["extensions"] = characterExtensions | worldExtensions
+
+    #Puts the book's entries back the way they were, for when an import is cancelled part way
+    def rollback(self):
+        del self.entries[self.start:]
+        for position, entry in self.replaced.items():
+            if position < self.start:
+                self.entries[position] = entry
+        self.replaced = {}
+        self.added = self.updated = 0
+
+    def counts(self):
+        return self.added, self.skipped, self.updated
+
+#merges worldBook into characterBook, see WorldbookMerger. Returns (entries added, entries skipped, entries updated).
+def import_worldbook(characterBook, worldBook, duplicates=DUPLICATES_SKIP, copyEntries=False):
+    merger = WorldbookMerger(characterBook, duplicates, copyEntries)
+    merger.add(worldBook["entries"])
+    merger.finish(worldBook)
+    return merger.counts()
+
+#Merges already processed worldbooks into a card's character book and saves it, unless dryRun is set or
+#nothing changed. Returns (entries before, entries added, entries skipped, entries updated).
+def merge_worldbooks_into_card(path, worldBooks, dryRun=False, duplicates=DUPLICATES_SKIP):
+    data = read_character(path)
+    characterBook = data["data"].get("character_book", {})
+    before = len(characterBook.get("entries", []))
+    original = {field: characterBook.get(field, default) for field, default in (("name", ""), ("description", ""), ("extensions", {}))}
+    added = skipped = updated = 0
+    for worldBook in worldBooks:
+        counts = import_worldbook(characterBook, worldBook, duplicates, copyEntries=True)
+        added, skipped, updated = added + counts[0], skipped + counts[1], updated + counts[2]
+    data["data"]["character_book"] = characterBook
+    changed = added or updated or any(characterBook.get(field, value) != value for field, value in original.items())
+    if changed and not dryRun:
+        write_character(path, data)
+    return before, added, skipped, updated
+
+_string_fields = ('name', 'description', 'personality', 'scenario', 'first_mes', 'mes_example', 'creator_notes',
+                  'system_prompt', 'post_history_instructions', 'creator', 'character_version')
+
+#Checks character data against the V2 spec. Returns a list of human-readable problems, empty if there are none.
+def validate_character(data):
+    problems = []
+    if not isinstance(data, dict) or not isinstance(data.get('data'), dict):
+        return ["not a character card"]
+    if data.get('spec') != 'chara_card_v2':
+        problems.append("spec is not chara_card_v2")
+    if data.get('spec_version') != '2.0':
+        problems.append("spec_version is not 2.0")
+    fields = data['data']
+    for field in _string_fields:
+        if not isinstance(fields.get(field), str):
+            problems.append("%s is missing or not a string" % field)
+    for field in ('alternate_greetings', 'tags'):
+        value = fields.get(field)
+        if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+            problems.append("%s is missing or not a list of strings" % field)
+    if not isinstance(fields.get('extensions'), dict):
+        problems.append("extensions is missing or not an object")
+    characterBook = fields.get('character_book')
+    if characterBook is None:
+        return problems
+    if not isinstance(characterBook, dict):
+        problems.append("character_book is not an object")
+        return problems
+    if not isinstance(characterBook.get('extensions', {}), dict):
+        problems.append("character_book extensions is not an object")
+    entries = characterBook.get('entries')
+    if not isinstance(entries, list):
+        problems.append("character_book entries is missing or not a list")
+        return problems
+    for position, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            problems.append("character_book entry %d is not an object" % position)
+            continue
+        keys = entry.get('keys')
+        if not isinstance(keys, list) or not all(isinstance(key, str) for key in keys):
+            problems.append("character_book entry %d keys is missing or not a list of strings" % position)
+        if not isinstance(entry.get('content'), str):
+            problems.append("character_book entry %d content is missing or not a string" % position)
+        if not isinstance(entry.get('enabled'), bool):
+            problems.append("character_book entry %d enabled is missing or not a boolean" % position)
+        if not isinstance(entry.get('insertion_order'), (int, float)) or isinstance(entry.get('insertion_order'), bool):
+            problems.append("character_book entry %d insertion_order is missing or not a number" % position)
+        if not isinstance(entry.get('extensions'), dict):
+            problems.append("character_book entry %d extensions is missing or not an object" % position)
+    return problems
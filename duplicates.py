@@ -0,0 +1,338 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+from array import array
+
+from app_paths import cache_directory
+from card_index import CardIndex
+from character_card import read_character
+from profiling import timed
+
+# Finds cards that are copies or forks of each other, and character book entries that have been pasted
+# into several cards. Exact copies are found by hashing, near copies by comparing MinHash signatures of
+# the cards' descriptions and greetings and of the entries' content, with locality sensitive hashing
+# so only likely pairs are compared. Nothing in here depends on Qt.
+#
+# Signatures are cached by the hash of each card's character data, and entry signatures by the hash of
+# their content, so a rescan only reads cards that changed since the last one and an entry shared by
+# dozens of cards is only hashed once.
+#
+#   python cardtool.py duplicates cards/ --summary duplicates.json
+
+SIGNATURE_SCHEMA_VERSION = 1
+# Values in a MinHash signature
+MINHASH_BINS = 32
+# The signature is split into LSH_BANDS bands of LSH_ROWS values, texts that agree on a whole band
+# are compared. With 8 bands of 4, texts more than about 60% alike are almost always compared.
+LSH_BANDS = 8
+LSH_ROWS = MINHASH_BINS // LSH_BANDS
+# Bits of each shingle's hash kept in a signature value, the bits above them record how far an empty
+# bin had to look for a value to borrow
+MINHASH_VALUE_BITS = 26
+# Texts are compared as sets of overlapping runs of this many words
+SHINGLE_WORDS = 3
+# Texts with fewer distinct shingles than this are too short to compare reliably, only exact copies of them are found
+MIN_SHINGLES = 8
+# Estimated fraction of shingles two texts must share to be reported as near duplicates
+NEAR_DUPLICATE_THRESHOLD = 0.7
+# The card fields compared between cards. Character book entries are compared separately.
+CARD_TEXT_FIELDS = ("description", "personality", "scenario", "first_mes", "alternate_greetings")
+ENTRY_PREVIEW_LENGTH = 80
+# SQLite limits how many values a query can take
+QUERY_BATCH_SIZE = 500
+
+_word = re.compile(r"\w+")
+
+# Lower case words separated by single spaces, so that changes to case, punctuation and spacing
+# don't stop texts matching
+def normalize_text(text):
+    return " ".join(_word.findall(str(text).lower()))
+
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8", "surrogatepass")).hexdigest()
+
+def shingles(text):
+    words = text.split()
+    return {" ".join(words[start:start + SHINGLE_WORDS]) for start in range(max(len(words) - SHINGLE_WORDS + 1, 1))} if words else set()
+
+# The MinHash signature of a normalized text, or None if it's too short. This is one permutation
+# hashing: each shingle is hashed once, the hash picks one of MINHASH_BINS bins and each bin keeps the
+# smallest value it gets. Bins nothing landed in borrow from the next bin along that has a value, so
+# that similar texts still agree on them. Hashing once rather than once per bin makes it many times faster.
+def minhash(text):
+    found = shingles(text)
+    if len(found) < MIN_SHINGLES:
+        return None
+    mask = (1 << MINHASH_VALUE_BITS) - 1
+    bins = [None] * MINHASH_BINS
+    for shingle in found:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8", "surrogatepass"), digest_size=8).digest(), "little")
+        number = value % MINHASH_BINS
+        value = (value // MINHASH_BINS) & mask
+        if bins[number] is None or value < bins[number]:
+            bins[number] = value
+    signature = array("I", [0] * MINHASH_BINS)
+    for number in range(MINHASH_BINS):
+        for distance in range(MINHASH_BINS):
+            value = bins[(number + distance) % MINHASH_BINS]
+            if value is not None:
+                signature[number] = value | (distance << MINHASH_VALUE_BITS)
+                break
+    return signature
+
+# The estimated fraction of shingles two texts share
+def similarity(first, second):
+    return sum(1 for a, b in zip(first, second) if a == b) / len(first)
+
+def _signatureFromBlob(blob):
+    return array("I", blob) if blob is not None else None
+
+# Returns (exact hash, signature, entries) for a card's data, where entries lists (content hash,
+# normalized content) for every character book entry with content
+def card_signature(data):
+    data = data["data"]
+    exact = text_hash(json.dumps(data, sort_keys=True, ensure_ascii=False))
+    parts = []
+    for field in CARD_TEXT_FIELDS:
+        value = data.get(field)
+        if isinstance(value, list):
+            parts += [str(item) for item in value]
+        elif value:
+            parts.append(str(value))
+    entries = []
+    characterBook = data.get("character_book")
+    if isinstance(characterBook, dict):
+        for entry in characterBook.get("entries", []):
+            content = normalize_text(entry.get("content") or "") if isinstance(entry, dict) else ""
+            entries.append((text_hash(content) if content else "", content))
+    return exact, minhash(normalize_text("\n".join(parts))), entries
+
+# Merges items into groups, for turning matching pairs into groups of duplicates
+class _Groups:
+    def __init__(self):
+        self.parents = {}
+
+    def find(self, item):
+        parent = self.parents.setdefault(item, item)
+        if parent != item:
+            parent = self.parents[item] = self.find(parent)
+        return parent
+
+    def join(self, first, second):
+        self.parents[self.find(first)] = self.find(second)
+
+    # Returns the groups of more than one item
+    def groups(self):
+        groups = {}
+        for item in self.parents:
+            groups.setdefault(self.find(item), []).append(item)
+        return [sorted(group) for group in groups.values() if len(group) > 1]
+
+# Finds the pairs of signatures that are at least NEAR_DUPLICATE_THRESHOLD alike. signatures maps
+# keys to signatures. Returns (groups, similarities): the groups of keys, and the lowest similarity
+# of the pairs that joined each group, keyed by the group's first key.
+def near_duplicate_groups(signatures):
+    buckets = {}
+    width = LSH_ROWS * array("I").itemsize
+    for key in sorted(signatures):
+        raw = signatures[key].tobytes()
+        for band in range(LSH_BANDS):
+            buckets.setdefault((band, raw[band * width:(band + 1) * width]), []).append(key)
+    groups = _Groups()
+    lowest = {}
+    for bucket in buckets.values():
+        for number, first in enumerate(bucket):
+            for second in bucket[number + 1:]:
+                # pairs already known to be in the same group don't need comparing again
+                if groups.find(first) == groups.find(second):
+                    continue
+                alike = similarity(signatures[first], signatures[second])
+                if alike >= NEAR_DUPLICATE_THRESHOLD:
+                    rootLowest = min(lowest.get(groups.find(first), 1.0), lowest.get(groups.find(second), 1.0), alike)
+                    groups.join(first, second)
+                    lowest[groups.find(first)] = rootLowest
+    result = groups.groups()
+    return result, {group[0]: round(lowest.get(groups.find(group[0]), 1.0), 3) for group in result}
+
+# Signatures of cards and entries, kept in the user's cache directory. Cards are keyed by the hash of
+# their character data (the content_hash in the card index) so renamed and copied cards are found too.
+class SignatureCache:
+    def __init__(self, path=None):
+        self.connection = sqlite3.connect(path or os.path.join(cache_directory("duplicates"), "signatures.sqlite3"))
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] != SIGNATURE_SCHEMA_VERSION:
+            self.connection.execute("DROP TABLE IF EXISTS cards")
+            self.connection.execute("DROP TABLE IF EXISTS entries")
+            self.connection.execute("PRAGMA user_version=%d" % SIGNATURE_SCHEMA_VERSION)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS cards (
+            content_hash TEXT PRIMARY KEY,
+            exact TEXT NOT NULL,
+            signature BLOB,
+            entries TEXT NOT NULL)""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS entries (
+            hash TEXT PRIMARY KEY,
+            signature BLOB,
+            preview TEXT NOT NULL)""")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def commit(self):
+        self.connection.commit()
+
+    def _select(self, query, keys):
+        keys = list(keys)
+        rows = []
+        for start in range(0, len(keys), QUERY_BATCH_SIZE):
+            batch = keys[start:start + QUERY_BATCH_SIZE]
+            rows += self.connection.execute(query % ", ".join("?" * len(batch)), batch).fetchall()
+        return rows
+
+    # Returns {content hash: (exact hash, signature, entry hashes)} for the cards that are cached
+    def cards(self, contentHashes):
+        return {row[0]: (row[1], _signatureFromBlob(row[2]), json.loads(row[3]))
+                for row in self._select("SELECT content_hash, exact, signature, entries FROM cards WHERE content_hash IN (%s)", contentHashes)}
+
+    # Returns {entry hash: (signature, preview)} for the entries that are cached
+    def entries(self, entryHashes):
+        return {row[0]: (_signatureFromBlob(row[1]), row[2])
+                for row in self._select("SELECT hash, signature, preview FROM entries WHERE hash IN (%s)", entryHashes)}
+
+    # Works out and stores the signatures of a card and of any of its entries that aren't cached yet.
+    # Returns the same (exact hash, signature, entry hashes) as cards().
+    def add(self, contentHash, data):
+        exact, signature, entries = card_signature(data)
+        entryHashes = [entryHash for entryHash, _content in entries]
+        known = self.entries(set(entryHash for entryHash in entryHashes if entryHash))
+        for entryHash, content in entries:
+            if entryHash and entryHash not in known:
+                entrySignature = minhash(content)
+                known[entryHash] = (entrySignature, content[:ENTRY_PREVIEW_LENGTH])
+                self.connection.execute("INSERT OR REPLACE INTO entries (hash, signature, preview) VALUES (?, ?, ?)",
+                                        (entryHash, entrySignature.tobytes() if entrySignature is not None else None, content[:ENTRY_PREVIEW_LENGTH]))
+        self.connection.execute("INSERT OR REPLACE INTO cards (content_hash, exact, signature, entries) VALUES (?, ?, ?, ?)",
+                                (contentHash, exact, signature.tobytes() if signature is not None else None, json.dumps(entryHashes)))
+        return exact, signature, entryHashes
+
+    # Stores signatures already worked out by read_signatures, returns the same as add()
+    def store(self, contentHash, signatures):
+        exact, signature, entries = signatures
+        for entryHash, entrySignature, preview in entries:
+            if entryHash:
+                self.connection.execute("INSERT OR IGNORE INTO entries (hash, signature, preview) VALUES (?, ?, ?)",
+                                        (entryHash, entrySignature.tobytes() if entrySignature is not None else None, preview))
+        entryHashes = [entryHash for entryHash, _signature, _preview in entries]
+        self.connection.execute("INSERT OR REPLACE INTO cards (content_hash, exact, signature, entries) VALUES (?, ?, ?, ?)",
+                                (contentHash, exact, signature.tobytes() if signature is not None else None, json.dumps(entryHashes)))
+        return exact, signature, entryHashes
+
+# A card that couldn't be read is reported the way cardtool reports failures
+def _error(e):
+    return "%s: %s" % (type(e).__name__, e)
+
+# Reads a card and works out all of its signatures, entries' included, without the cache so that it can
+# run in a worker process. Returns (signatures, error): signatures being (exact hash, signature, entries)
+# where entries lists (content hash, signature, preview), or None with the error if the card can't be read.
+def read_signatures(path, location=None):
+    try:
+        exact, signature, entries = card_signature(read_character(path, location))
+    except Exception as e:
+        return None, _error(e)
+    signatures = {}
+    for entryHash, content in entries:
+        if entryHash and entryHash not in signatures:
+            signatures[entryHash] = minhash(content)
+    return (exact, signature, [(entryHash, signatures.get(entryHash), content[:ENTRY_PREVIEW_LENGTH]) for entryHash, content in entries]), None
+# Looks for duplicates among the cards in a directory. summaries are the directory's CardSummary objects,
+# the card index is brought up to date for them if they aren't given. progress is called with (done, total)
+# as cards that aren't cached are read. Those cards are read one at a time unless mapper is given, a
+# function like an executor's map that read_signatures is run through. Returns a report:
+#   cards: how many cards were compared, rehashed: how many had to be read
+#   errors: {file, error} for cards that couldn't be read, which are left out of the comparison
+#   identical_cards: lists of filenames whose character data is the same
+#   similar_cards: {files, similarity} for cards whose descriptions and greetings are alike
+#   shared_entries: {files, entries, preview} for sets of cards that have entries with the same content,
+#     most shared entries first
+#   similar_entries: {entries, similarity, preview} for entries with alike content, entries being
+#     {file, entry} with the entry's position in the file's character book
+@timed("find_duplicates")
+def find_duplicates(directory, summaries=None, cache=None, progress=None, mapper=None):
+    if summaries is None:
+        cardIndex = CardIndex(directory)
+        try:
+            summaries = cardIndex.refresh()
+        finally:
+            cardIndex.close()
+    ownCache = cache is None
+    if ownCache:
+        cache = SignatureCache()
+    try:
+        summaries = [summary for summary in summaries if summary is not None and summary.content_hash]
+        records = cache.cards(set(summary.content_hash for summary in summaries))
+        missing = [summary for summary in summaries if summary.content_hash not in records]
+        errors = []
+        if mapper is None:
+            for number, summary in enumerate(missing):
+                try:
+                    data = read_character(os.path.join(directory, summary.filename), summary.charaLocation())
+                    records[summary.content_hash] = cache.add(summary.content_hash, data)
+                except Exception as e:
+                    errors.append({"file": summary.filename, "error": _error(e)})
+                if progress is not None:
+                    progress(number + 1, len(missing))
+        else:
+            found = mapper(read_signatures, [os.path.join(directory, summary.filename) for summary in missing],
+                           [summary.charaLocation() for summary in missing])
+            for number, (summary, (signatures, error)) in enumerate(zip(missing, found)):
+                if signatures is not None:
+                    records[summary.content_hash] = cache.store(summary.content_hash, signatures)
+                else:
+                    errors.append({"file": summary.filename, "error": error})
+                if progress is not None:
+                    progress(number + 1, len(missing))
+        cache.commit()
+        cards = {summary.filename: records[summary.content_hash] for summary in summaries if summary.content_hash in records}
+        occurrences = {} # entry hash: [(filename, position)]
+        for filename, (_exact, _signature, entryHashes) in cards.items():
+            for position, entryHash in enumerate(entryHashes):
+                if entryHash:
+                    occurrences.setdefault(entryHash, []).append((filename, position))
+        entries = cache.entries(occurrences)
+    finally:
+        if ownCache:
+            cache.close()
+
+    identical = {}
+    for filename, (exact, _signature, _entryHashes) in cards.items():
+        identical.setdefault(exact, []).append(filename)
+    identicalCards = sorted(sorted(files) for files in identical.values() if len(files) > 1)
+
+    similarCards = []
+    groups, lowest = near_duplicate_groups({filename: signature for filename, (_exact, signature, _entryHashes) in cards.items() if signature is not None})
+    for group in groups:
+        # groups that are only identical copies are already listed
+        if len(set(cards[filename][0] for filename in group)) > 1:
+            similarCards.append({"files": group, "similarity": lowest[group[0]]})
+
+    shared = {} # files sharing entries: entry hashes
+    for entryHash, places in occurrences.items():
+        files = tuple(sorted(set(filename for filename, _position in places)))
+        if len(files) > 1:
+            shared.setdefault(files, []).append(entryHash)
+    sharedEntries = sorted(({"files": list(files), "entries": len(entryHashes), "preview": entries.get(entryHashes[0], (None, ""))[1]}
+                            for files, entryHashes in shared.items()), key=lambda group: (-group["entries"], group["files"]))
+
+    similarEntries = []
+    groups, lowest = near_duplicate_groups({entryHash: signature for entryHash, (signature, _preview) in entries.items() if signature is not None})
+    for group in groups:
+        places = sorted(place for entryHash in group for place in occurrences[entryHash])
+        similarEntries.append({"entries": [{"file": filename, "entry": position} for filename, position in places],
+                               "similarity": lowest[group[0]], "preview": entries[group[0]][1]})
+    similarEntries.sort(key=lambda group: -len(group["entries"]))
+
+    return {"cards": len(cards), "rehashed": len(missing), "errors": errors, "identical_cards": identicalCards, "similar_cards": similarCards,
+            "shared_entries": sharedEntries, "similar_entries": similarEntries}
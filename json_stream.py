@@ -0,0 +1,155 @@
+import codecs
+import json
+import os
+
+# Reads a JSON document a piece at a time, handing over the items of one big array (or object) as they're
+# parsed instead of loading the whole document first. Used to import worldbooks and characters that are
+# far too big to json.load comfortably. Nothing in here depends on Qt.
+#
+#   stream = JSONItemStream(path, [("entries",), ("data", "character_book", "entries")])
+#   for batch in stream.batches(500):
+#       ...
+#   stream.document # everything else in the file, with the streamed container left empty
+
+# How much of the file is read at a time
+STREAM_CHUNK_SIZE = 1 << 20
+
+_decoder = json.JSONDecoder()
+_whitespace = " \t\n\r"
+
+class JSONItemStream:
+    # itemPaths are the key paths of the containers whose items are streamed, the first one found in
+    # the document is used. Items of an object are streamed as its values, like SillyTavern's entries.
+    def __init__(self, path, itemPaths):
+        self.path = path
+        self.itemPaths = [tuple(itemPath) for itemPath in itemPaths]
+        self.size = os.path.getsize(path)
+        self.bytesRead = 0
+        self.document = None
+        self.itemPath = None # which of itemPaths was found, once it has been
+        self.file = None
+        self.decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+
+    def _fill(self, size=STREAM_CHUNK_SIZE):
+        if self.eof:
+            return False
+        data = self.file.read(size)
+        self.bytesRead += len(data)
+        self.eof = not data
+        # what's been parsed already is dropped so the buffer only holds what's still to come
+        self.buffer = self.buffer[self.position:] + self.decoder.decode(data, final=self.eof)
+        self.position = 0
+        return not self.eof or bool(self.buffer)
+
+    def _peek(self):
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in _whitespace:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._fill():
+                raise ValueError("%s ends too soon" % self.path)
+
+    def _expect(self, characters):
+        character = self._peek()
+        if character not in characters:
+            raise ValueError("%s: expected %s, found %r" % (self.path, " or ".join(characters), character))
+        self.position += 1
+        return character
+
+    # Parses one complete value, reading more of the file until it's all there. The read size doubles
+    # each time so a huge value is still read in linear time.
+    def _value(self):
+        self._peek()
+        size = STREAM_CHUNK_SIZE
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.position)
+                # a number at the very end of the buffer might carry on in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill(size)
+            size *= 2
+
+    # Yields the items of the container at path, filling in container with everything else
+    def _walk(self, path, container):
+        opening = self._expect("{[")
+        closing = "}" if opening == "{" else "]"
+        if self._peek() == closing:
+            self.position += 1
+            return
+        number = 0
+        while True:
+            if opening == "{":
+                key = self._value()
+                if not isinstance(key, str):
+                    raise ValueError("%s: object keys must be strings" % self.path)
+                self._expect(":")
+            else:
+                key = number
+            itemPath = path + (key,)
+            if self.itemPath is None and path in self.itemPaths:
+                # the items of a streamed container are handed over rather than kept
+                yield self._value()
+            elif self.itemPath is None and self._peek() in "{[" and any(candidate[:len(itemPath)] == itemPath for candidate in self.itemPaths):
+                child = {} if self._peek() == "{" else []
+                self._store(container, key, child)
+                streamed = itemPath in self.itemPaths
+                yield from self._walk(itemPath, child)
+                if streamed:
+                    self.itemPath = itemPath
+                    # the document is left with an empty list where the items were
+                    if isinstance(container, dict):
+                        container[key] = []
+            else:
+                self._store(container, key, self._value())
+            number += 1
+            if self._expect("," + closing) == closing:
+                return
+
+    @staticmethod
+    def _store(container, key, value):
+        if isinstance(container, dict):
+            container[key] = value
+        else:
+            container.append(value)
+
+    # Yields every streamed item. Afterwards document holds the rest of the file.
+    def items(self):
+        with open(self.path, "rb") as self.file:
+            if self._peek() not in "{[":
+                self.document = self._value()
+                return
+            self.document = {} if self._peek() == "{" else []
+            yield from self._walk((), self.document)
+            if not self._atEnd():
+                raise ValueError("%s has more after the JSON document" % self.path)
+
+    def _atEnd(self):
+        try:
+            self._peek()
+        except ValueError:
+            return True
+        return False
+
+    # Yields the streamed items in lists of up to size
+    def batches(self, size):
+        batch = []
+        for item in self.items():
+            batch.append(item)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    # How far through the file reading has got, from 0 to 1
+    def progress(self):
+        return self.bytesRead / self.size if self.size else 1.0
@@ -0,0 +1,189 @@
+from itertools import accumulate
+
+from tokenizer import approximate_token_count
+
+# Works out which character book entries a chat would activate, following the V2 card spec: enabled
+# entries fire when one of their keys appears in the scanned messages (and, for selective entries,
+# one of their secondary keys too), constant entries always fire, and if the token budget is exceeded
+# the lowest priority entries are dropped. What's left is returned in insertion order.
+# Nothing in here depends on Qt.
+
+# How many times activated entries' own content is rescanned for more keys when recursive scanning is
+# on. Each rescan only looks at entries activated by the one before, so this bounds the work even for
+# books where every entry mentions another one.
+MAX_RECURSION_DEPTH = 8
+
+# Aho-Corasick automaton over a set of keys, for finding every key that occurs anywhere in a text in
+# a single pass, however many keys there are
+class KeywordAutomaton:
+    def __init__(self, keys):
+        self.transitions = [{}] # state: {character: state}
+        self.outputs = [[]] # state: indexes into keys of every key ending at this state
+        self.keys = list(keys)
+        for number, key in enumerate(self.keys):
+            state = 0
+            for character in key:
+                nextState = self.transitions[state].get(character)
+                if nextState is None:
+                    nextState = len(self.transitions)
+                    self.transitions[state][character] = nextState
+                    self.transitions.append({})
+                    self.outputs.append([])
+                state = nextState
+            self.outputs[state].append(number)
+        # breadth first, so each state's failure state is finished before its children need it
+        self.failures = [0] * len(self.transitions)
+        queue = list(self.transitions[0].values())
+        for state in queue:
+            for character, child in self.transitions[state].items():
+                failure = self.failures[state]
+                while failure and character not in self.transitions[failure]:
+                    failure = self.failures[failure]
+                failure = self.transitions[failure].get(character, 0)
+                self.failures[child] = failure if failure != child else 0
+                self.outputs[child] = self.outputs[child] + self.outputs[self.failures[child]]
+                queue.append(child)
+
+        # transitions with the failure links followed, filled in as characters are met so that
+        # searching takes one lookup per character
+        self.moves = [dict(transitions) for transitions in self.transitions]
+
+    def _move(self, state, character):
+        nextState = self.moves[state].get(character)
+        if nextState is None:
+            failure = state
+            while failure and character not in self.transitions[failure]:
+                failure = self.failures[failure]
+            nextState = self.moves[state][character] = self.transitions[failure].get(character, 0)
+        return nextState
+
+    # Returns the set of key indexes found in text
+    def search(self, text):
+        found = set()
+        # every state the text passes through, the keys are those ending at any of them
+        for state in set(accumulate(text, self._move, initial=0)):
+            found.update(self.outputs[state])
+        return found
+
+# Compiles a character book once so it can be tested against any number of chats. The book's entries
+# are read when the simulator is built, so build a new one after editing them.
+class LorebookSimulator:
+    def __init__(self, characterBook, countTokens=approximate_token_count):
+        self.book = characterBook or {}
+        self.countTokens = countTokens
+        self.entries = [entry if isinstance(entry, dict) else {} for entry in self.book.get("entries", [])]
+        self.tokenCounts = {} # entry position: token count of its content, filled in as entries fire
+        # (entry position, secondary) for every key, one list for each automaton
+        sensitiveKeys, sensitiveOwners = [], []
+        insensitiveKeys, insensitiveOwners = [], []
+        for position, entry in enumerate(self.entries):
+            if not entry.get("enabled", True):
+                continue
+            for secondary, field in ((False, "keys"), (True, "secondary_keys")):
+                keys = entry.get(field) or []
+                if not isinstance(keys, list):
+                    continue
+                for key in keys:
+                    key = str(key).strip()
+                    if not key:
+                        continue
+                    if entry.get("case_sensitive"):
+                        sensitiveKeys.append(key)
+                        sensitiveOwners.append((position, secondary))
+                    else:
+                        insensitiveKeys.append(key.lower())
+                        insensitiveOwners.append((position, secondary))
+        self.sensitive = KeywordAutomaton(sensitiveKeys) if sensitiveKeys else None
+        self.sensitiveOwners = sensitiveOwners
+        self.insensitive = KeywordAutomaton(insensitiveKeys) if insensitiveKeys else None
+        self.insensitiveOwners = insensitiveOwners
+
+    # Returns {entry position: (primary key found, secondary key found)} for the keys in text
+    def _matches(self, text):
+        matches = {}
+        for automaton, owners, searched in ((self.sensitive, self.sensitiveOwners, text),
+                                            (self.insensitive, self.insensitiveOwners, text.lower())):
+            if automaton is None:
+                continue
+            for number in automaton.search(searched):
+                position, secondary = owners[number]
+                primary, secondaryKey = matches.get(position, (None, None))
+                if secondary:
+                    secondaryKey = secondaryKey or automaton.keys[number]
+                else:
+                    primary = primary or automaton.keys[number]
+                matches[position] = (primary, secondaryKey)
+        return matches
+
+    def _triggered(self, text, activated):
+        triggered = {}
+        for position, (primary, secondary) in self._matches(text).items():
+            if position in activated or primary is None:
+                continue
+            if self.entries[position].get("selective") and secondary is None:
+                continue
+            triggered[position] = primary
+        return triggered
+
+    # messages is the chat, oldest first. scanDepth, tokenBudget and recursiveScanning default to the
+    # book's own settings. Returns (included, cut): the activated entries that fit in the budget in
+    # insertion order, and those dropped for going over it. Each is a dict with the entry's position,
+    # the entry itself, its token count, why it fired ("constant", "key" or "recursion") and the key.
+    def activate(self, messages, scanDepth=None, tokenBudget=None, recursiveScanning=None):
+        if isinstance(messages, str):
+            messages = [messages]
+        if scanDepth is None:
+            scanDepth = self.book.get("scan_depth")
+        if tokenBudget is None:
+            tokenBudget = self.book.get("token_budget")
+        if recursiveScanning is None:
+            recursiveScanning = self.book.get("recursive_scanning", False)
+        if scanDepth is not None:
+            messages = messages[-int(scanDepth):] if int(scanDepth) > 0 else []
+
+        activated = {} # position: (reason, key)
+        for position, entry in enumerate(self.entries):
+            if entry.get("enabled", True) and entry.get("constant"):
+                activated[position] = ("constant", None)
+        newlyActivated = self._triggered("\n".join(messages), activated)
+        for position, key in newlyActivated.items():
+            activated[position] = ("key", key)
+        depth = 0
+        while recursiveScanning and newlyActivated and depth < MAX_RECURSION_DEPTH:
+            text = "\n".join(str(self.entries[position].get("content") or "") for position in sorted(newlyActivated))
+            newlyActivated = self._triggered(text, activated)
+            for position, key in newlyActivated.items():
+                activated[position] = ("recursion", key)
+            depth += 1
+
+        results = []
+        for position, (reason, key) in activated.items():
+            entry = self.entries[position]
+            tokens = self.tokenCounts.get(position)
+            if tokens is None:
+                tokens = self.tokenCounts[position] = self.countTokens(str(entry.get("content") or ""))
+            results.append({"position": position, "entry": entry, "tokens": tokens, "reason": reason, "key": key})
+        included, cut = results, []
+        if tokenBudget is not None:
+            included, cut = [], []
+            used = 0
+            # highest priority first, the lowest priority entries are the ones that don't fit
+            for result in sorted(results, key=lambda result: (-_number(result["entry"].get("priority")), _number(result["entry"].get("insertion_order")), result["position"])):
+                if used + result["tokens"] <= tokenBudget:
+                    used += result["tokens"]
+                    included.append(result)
+                else:
+                    cut.append(result)
+        # a lower insertion order is inserted higher up in the prompt
+        order = lambda result: (_number(result["entry"].get("insertion_order")), result["position"])
+        return sorted(included, key=order), sorted(cut, key=order)
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+# Convenience for one-off checks: compiles the book and activates it against messages
+def activate_entries(characterBook, messages, **settings):
+    return LorebookSimulator(characterBook).activate(messages, **settings)
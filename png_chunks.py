@@ -0,0 +1,210 @@
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+
+# Low-level access to the chunk stream of a PNG file. Character cards keep their data in a text
+# chunk, so none of this ever needs to decode (or even read) the image data itself.
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+TEXT_CHUNK_TYPES = (b'tEXt', b'zTXt', b'iTXt')
+# Files at least this big are read through mmap rather than seek/read
+MMAP_THRESHOLD = 4 * 1024 * 1024
+
+_chunk_header = struct.Struct('>I4s')
+
+# Yields (type, offset, length) for each chunk in a file-like object, where offset is the position of
+# the chunk's length field. The chunk data itself is skipped over with a seek, so the caller only pays
+# for the data of chunks it actually reads.
+def iter_chunks(f):
+    if f.read(8) != PNG_SIGNATURE:
+        raise ValueError("not a PNG file")
+    offset = 8
+    while True:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            return # truncated file, nothing further to find
+        length, chunk_type = _chunk_header.unpack(header)
+        yield chunk_type, offset, length
+        if chunk_type == b'IEND':
+            return
+        offset += 12 + length # length, type, data and crc
+
+# Same as iter_chunks but for a bytes-like buffer, such as an mmap
+def iter_chunks_in_buffer(buffer):
+    if buffer[:8] != PNG_SIGNATURE:
+        raise ValueError("not a PNG file")
+    offset = 8
+    end = len(buffer)
+    while offset + 8 <= end:
+        length, chunk_type = _chunk_header.unpack_from(buffer, offset)
+        yield chunk_type, offset, length
+        if chunk_type == b'IEND':
+            return
+        offset += 12 + length
+
+# Returns the chunk's data after checking it against the chunk's crc
+def _checked_data(chunk_type, data, crc_bytes):
+    if len(crc_bytes) < 4 or zlib.crc32(data, zlib.crc32(chunk_type)) != struct.unpack('>I', crc_bytes)[0]:
+        raise ValueError("broken PNG file, bad crc in %s chunk" % chunk_type.decode('latin-1'))
+    return data
+
+# Splits a tEXt, zTXt or iTXt chunk's data into its keyword and text
+def decode_text_chunk(chunk_type, data):
+    keyword, _, rest = data.partition(b'\x00')
+    keyword = keyword.decode('latin-1')
+    if chunk_type == b'tEXt':
+        return keyword, rest.decode('latin-1')
+    if chunk_type == b'zTXt':
+        # first byte is the compression method, zlib is the only one defined
+        return keyword, zlib.decompress(rest[1:]).decode('latin-1')
+    if chunk_type == b'iTXt':
+        compressed = rest[0:1] == b'\x01'
+        rest = rest[2:]
+        _language, _, rest = rest.partition(b'\x00')
+        _translatedKeyword, _, text = rest.partition(b'\x00')
+        if compressed:
+            text = zlib.decompress(text)
+        return keyword, text.decode('utf-8')
+    raise ValueError("not a text chunk: %r" % chunk_type)
+
+# Only the keyword prefix of a text chunk is needed to tell whether it's the one we're after
+def _keyword_matches(prefix, keyword):
+    return prefix.startswith(keyword + b'\x00')
+
+# Finds the first text chunk with the given keyword. Returns (offset, length, text), where offset and
+# length describe the whole chunk including its header and crc, or None if there's no such chunk.
+# Reading stops as soon as the chunk is found and IDAT chunks are stepped over by their length fields.
+def find_text_chunk(path, keyword='chara', use_mmap=None):
+    keywordBytes = keyword.encode('latin-1')
+    with open(path, 'rb') as f:
+        if use_mmap is None:
+            use_mmap = os.fstat(f.fileno()).st_size >= MMAP_THRESHOLD
+        if use_mmap:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                for chunk_type, offset, length in iter_chunks_in_buffer(buffer):
+                    if chunk_type not in TEXT_CHUNK_TYPES:
+                        continue
+                    start = offset + 8
+                    if not _keyword_matches(buffer[start:start + len(keywordBytes) + 1], keywordBytes):
+                        continue
+                    data = _checked_data(chunk_type, buffer[start:start + length], buffer[start + length:start + length + 4])
+                    return offset, length + 12, decode_text_chunk(chunk_type, data)[1]
+            return None
+        for chunk_type, offset, length in iter_chunks(f):
+            if chunk_type not in TEXT_CHUNK_TYPES:
+                continue
+            if not _keyword_matches(f.read(min(length, len(keywordBytes) + 1)), keywordBytes):
+                continue
+            f.seek(offset + 8)
+            data = _checked_data(chunk_type, f.read(length), f.read(4))
+            return offset, length + 12, decode_text_chunk(chunk_type, data)[1]
+    return None
+
+# Reads a text chunk from where find_text_chunk said it was, without walking the chunks before it.
+# Returns None if there's no longer a matching chunk there, for instance because the file has been
+# rewritten since, so the caller can fall back to find_text_chunk.
+def read_text_chunk_at(path, offset, length, keyword='chara'):
+    keywordBytes = keyword.encode('latin-1')
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        chunk = f.read(length)
+    if len(chunk) != length or length < 12:
+        return None
+    dataLength, chunk_type = _chunk_header.unpack_from(chunk, 0)
+    if dataLength != length - 12 or chunk_type not in TEXT_CHUNK_TYPES or not _keyword_matches(chunk[8:9 + len(keywordBytes)], keywordBytes):
+        return None
+    try:
+        data = _checked_data(chunk_type, chunk[8:-4], chunk[-4:])
+    except ValueError:
+        return None
+    return decode_text_chunk(chunk_type, data)[1]
+
+# Returns the text of the first text chunk with the given keyword, or None if there isn't one
+def read_text_chunk(path, keyword='chara', use_mmap=None):
+    found = find_text_chunk(path, keyword, use_mmap)
+    if found is None:
+        return None
+    return found[2]
+
+# Builds a complete chunk, header and crc included. Text that can't be stored in latin-1 goes into an
+# iTXt chunk, everything else into a plain tEXt chunk.
+def build_text_chunk(keyword, text):
+    try:
+        chunk_type = b'tEXt'
+        data = keyword.encode('latin-1') + b'\x00' + text.encode('latin-1')
+    except UnicodeEncodeError:
+        chunk_type = b'iTXt'
+        data = keyword.encode('latin-1') + b'\x00\x00\x00\x00\x00' + text.encode('utf-8')
+    crc = zlib.crc32(data, zlib.crc32(chunk_type))
+    return struct.pack('>I4s', len(data), chunk_type) + data + struct.pack('>I', crc)
+
+def _copy_range(source, destination, offset, length, blockSize=1024 * 1024):
+    source.seek(offset)
+    while length > 0:
+        block = source.read(min(length, blockSize))
+        if not block:
+            raise ValueError("truncated PNG file")
+        destination.write(block)
+        length -= len(block)
+
+# Replaces the text chunk with the given keyword, or adds one if the file doesn't have it. Every other
+# chunk is copied byte-for-byte so the image data is never decoded or recompressed, and ancillary
+# chunks such as iCCP, pHYs and other text keys are kept. The new chunk goes just before the first
+# IDAT so that find_text_chunk can stop before reaching the image data.
+# The result is written to a temporary file in the same directory, fsynced and then renamed over the
+# original, so a crash part way through leaves the original file untouched.
+def write_text_chunk(path, keyword, text):
+    newChunk = build_text_chunk(keyword, text)
+    keywordBytes = keyword.encode('latin-1')
+    directory = os.path.dirname(os.path.abspath(path))
+    with open(path, 'rb') as source:
+        # Work out what to copy before writing anything, iter_chunks seeks around the source file
+        copies = []
+        for chunk_type, offset, length in iter_chunks(source):
+            if chunk_type in TEXT_CHUNK_TYPES and _keyword_matches(source.read(min(length, len(keywordBytes) + 1)), keywordBytes):
+                continue
+            copies.append((chunk_type, offset, length))
+        if not copies or copies[-1][0] != b'IEND':
+            raise ValueError("truncated PNG file")
+        fd, tempPath = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as destination:
+                destination.write(PNG_SIGNATURE)
+                written = False
+                for chunk_type, offset, length in copies:
+                    if not written and chunk_type in (b'IDAT', b'IEND'):
+                        destination.write(newChunk)
+                        written = True
+                    _copy_range(source, destination, offset, length + 12)
+                destination.flush()
+                os.fsync(destination.fileno())
+        except BaseException:
+            _remove_quietly(tempPath)
+            raise
+    # The original has to be closed before it's replaced, Windows won't replace a file that's open
+    try:
+        os.chmod(tempPath, os.stat(path).st_mode & 0o7777)
+        os.replace(tempPath, path)
+    except BaseException:
+        _remove_quietly(tempPath)
+        raise
+    _fsync_directory(directory)
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+# Makes the rename itself durable. Not possible (or needed) on Windows.
+def _fsync_directory(directory):
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,173 @@
+import atexit
+import functools
+import json
+import os
+import random
+import threading
+import time
+
+# Opt-in timing of the editor's hot paths. Functions are wrapped with @timed and code blocks with
+# span(). Until enable() is called the wrappers only check a flag, so leaving them in costs next to
+# nothing. Nothing in here depends on Qt.
+#
+# Programs that call configure() at startup turn recording on when TAVERNAI_EDITOR_PROFILE is set or
+# they're given --profile. If the value is a filename rather than "1", statistics are written there
+# when the program exits, along with a Chrome trace (loadable in chrome://tracing or Perfetto) next to it.
+
+PROFILE_ENVIRONMENT_VARIABLE = "TAVERNAI_EDITOR_PROFILE"
+# Durations kept per name for working out percentiles. Past this a uniform random sample is kept.
+SAMPLE_LIMIT = 10000
+# Trace events kept for the Chrome trace, later events are dropped
+TRACE_EVENT_LIMIT = 200000
+PERCENTILES = (50, 90, 99)
+
+_enabled = False
+_lock = threading.Lock()
+_timings = {} # name: _Timing
+_traceEvents = []
+_origin = time.perf_counter()
+
+class _Timing:
+    __slots__ = ("count", "total", "maximum", "samples")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.samples = []
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+        if len(self.samples) < SAMPLE_LIMIT:
+            self.samples.append(seconds)
+        else:
+            # reservoir sampling, every duration so far has the same chance of being in samples
+            slot = random.randrange(self.count)
+            if slot < SAMPLE_LIMIT:
+                self.samples[slot] = seconds
+
+def enabled():
+    return _enabled
+
+def enable(on=True):
+    global _enabled
+    _enabled = on
+
+def reset():
+    with _lock:
+        _timings.clear()
+        del _traceEvents[:]
+
+# Adds a measurement. started is a time.perf_counter() value, used for the trace.
+def record(name, started, seconds):
+    with _lock:
+        timing = _timings.get(name)
+        if timing is None:
+            timing = _timings[name] = _Timing()
+        timing.add(seconds)
+        if len(_traceEvents) < TRACE_EVENT_LIMIT:
+            _traceEvents.append((name, started, seconds, threading.get_ident()))
+
+# Decorator that records how long each call takes under the given name
+def timed(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, started, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+class _Span:
+    __slots__ = ("name", "started")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, self.started, time.perf_counter() - self.started)
+        return False
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_noSpan = _NoSpan()
+
+# Context manager that records how long its block takes under the given name
+def span(name):
+    return _Span(name) if _enabled else _noSpan
+
+def _percentile(ordered, percent):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+# Returns {name: {count, total, mean, max, p50, p90, p99}}, times in seconds
+def statistics():
+    with _lock:
+        timings = [(name, timing.count, timing.total, timing.maximum, sorted(timing.samples)) for name, timing in _timings.items()]
+    result = {}
+    for name, count, total, maximum, ordered in sorted(timings):
+        result[name] = {"count": count, "total": total, "mean": total / count, "max": maximum}
+        for percent in PERCENTILES:
+            result[name]["p%d" % percent] = _percentile(ordered, percent)
+    return result
+
+def write_statistics(path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(statistics(), f, indent=1)
+
+# Writes the recorded calls in the Chrome trace event format
+def write_chrome_trace(path):
+    with _lock:
+        events = list(_traceEvents)
+    pid = os.getpid()
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": [{"name": name, "ph": "X", "ts": round((started - _origin) * 1e6, 3), "dur": round(seconds * 1e6, 3),
+                                    "pid": pid, "tid": tid} for name, started, seconds, tid in events],
+                   "displayTimeUnit": "ms"}, f)
+
+# Where the trace goes when statistics are written to path
+def trace_path(path):
+    root, extension = os.path.splitext(path)
+    return root + ".trace" + (extension or ".json")
+
+def _writeAtExit(path):
+    try:
+        write_statistics(path)
+        write_chrome_trace(trace_path(path))
+    except OSError as e:
+        print("unable to write profile", path, e)
+
+# Turns recording on if the environment variable or a --profile command-line option asks for it.
+# Returns args with the option removed. "--profile=statistics.json" also writes the results there on exit.
+def configure(args=()):
+    setting = os.environ.get(PROFILE_ENVIRONMENT_VARIABLE)
+    remaining = []
+    for arg in args:
+        if arg == "--profile":
+            setting = setting or "1"
+        elif arg.startswith("--profile="):
+            setting = arg[len("--profile="):]
+        else:
+            remaining.append(arg)
+    if setting:
+        enable()
+        if setting != "1":
+            atexit.register(_writeAtExit, setting)
+    return remaining
@@ -1,109 +1,59 @@
-from PIL import Image
-from PIL.PngImagePlugin import PngImageFile, PngInfo
-import base64
+from character_card import CharacterEncoder, read_character, write_character, load_worldbook, merge_worldbooks_into_card
+from character_card import DUPLICATES_SKIP, DUPLICATES_REPLACE, DUPLICATES_KEEP_BOTH, WorldbookMerger, WorldbookStream
+from json_stream import JSONItemStream
+import undo_history
+from undo_history import UndoHistory
+from autosave_journal import AutosaveJournal, apply_record, changed_on_disk
 import json
 
-base = {
-    'spec': 'chara_card_v2',
-    'spec_version': '2.0',
-    'data': {
-        'name': '',
-        'description': "",
-        'personality': '',
-        'scenario': "",
-        'first_mes': '',
-        'mes_example': '',
-        'creator_notes': '',
-        'system_prompt': '',
-        'post_history_instructions': '',
-        'alternate_greetings': [],
-        'tags': [],
-        'creator': '',
-        'character_version': '',
-        'extensions': {}
-    }
-}
-
 PLAINTEXT_EDITOR_MAX_HEIGHT = 50
-DIRTY_CHARACTER_COLOUR = "background-color: #FFFF00;"
-
-# Various global methods
-
-# Extract JSON character data from an image. Handles both V1 and V2 TavernAI format, returns V2.
-# Creates a new character data dict if the image doesn't have one.
-def read_character(path):
-    image = PngImageFile(path)
-    user_comment = image.text.get('chara', None)
-    if user_comment == None:
-        return json.loads(json.dumps(base)) # deep copy of an empty character dictionary
-    base64_bytes = user_comment.encode('utf-8')  # Convert the base64 string to bytes
-    json_bytes = base64.b64decode(base64_bytes)  # Decode the base64 bytes to JSON bytes
-    json_str = json_bytes.decode('utf-8')  # Convert the JSON bytes to a string
-    data = json.loads(json_str)  # Convert the string to JSON data
-
-    if data.get('spec') != 'chara_card_v2':
-        newData = json.loads(json.dumps(base)) # deep copy of an empty character dictionary
-        newData["data"] = data
-        data = newData
-    if not isinstance(data["data"].get("tags", []), list):
-        data["data"]["tags"] = []
-    if not isinstance(data["data"].get("alternate_greetings", []), list):
-        data["data"]["alternate_greetings"] = []
-    if "character_book" in data["data"] and "entries" in data["data"]["character_book"]:
-        for entry in data["data"]["character_book"]["entries"]:
-            if not isinstance(entry.get("secondary_keys"), list):
-                entry["secondary_keys"] = []
-    return data
-
-#Writes character data back to the image
-def write_character(path, data):
-    json_str = json.dumps(data)
-    base64_str = base64.b64encode(json_str.encode('utf-8')).decode('utf-8')
-    image = Image.open(path)
-    metadata = PngInfo()
-    metadata.add_text('chara', base64_str)
-    image.save(path, 'PNG', pnginfo=metadata)
-
-#ensures that agnai, sillytavern, and tavernai characterbooks all come out in the same
-#format, ready for insertion into a tavernai character
-def process_worldbook(data):
-    if not isinstance(data, dict):
-        return None
-    if not "entries" in data:
-        if "spec" in data and data["spec"] =='chara_card_v2' and "data" in data and "character_book" in data["data"]:
-            return data["data"]["character_book"]        
-        return None
-    if isinstance(data["entries"], dict):
-        entries = list(data["entries"].values())
-        data["entries"] = entries
-    for entry in data["entries"]:
-        if "entry" in entry and entry.get("content") == entry.get("entry"):
-            del entry["entry"]
-            #The agnai worldbooks I've looked at have duplicte contents, I'm making an executive decision here
-            #to pare that down since the spec for tavernai characters would ignore this data anyway
-    return data
-
-#merges worldBook into characterBook
-def import_worldbook(characterBook, worldBook):
-    desc = worldBook.get("description", "")
-    if desc != "" and characterBook.get("description", "") == "":
-        characterBook["description"] = desc
-    name = worldBook.get("name", "")
-    if name != "" and characterBook.get("name", "") == "":
-        characterBook["name"] = name
-    characterBook["entries"] = characterBook.get("entries", [])
-    characterBook["entries"] += worldBook["entries"]
-    worldExtensions = worldBook.get("extensions", {})
-    characterExtensions = characterBook.get("extensions", {})
-    characterBook["extensions"] = characterExtensions | worldExtensions
-    return characterBook
+# The choices offered for worldbook entries that are already in the character book, see import_worldbook
+DUPLICATE_POLICY_LABELS = ((DUPLICATES_SKIP, "Skip duplicate entries"), (DUPLICATES_REPLACE, "Replace duplicate entries"),
+                           (DUPLICATES_KEEP_BOTH, "Keep both copies"))
+DIRTY_CHARACTER_COLOUR = "#FFFF00"
+# How many clean EditorWidgets are kept alive after they've been shown. Editors with unsaved
+# changes are never evicted, so the pool can temporarily grow beyond this. This is the default, the
+# editorPoolSize setting or --editor-pool-size=N on the command line change it.
+EDITOR_POOL_SIZE = 10
+EDITOR_POOL_SIZE_SETTING = "editorPoolSize"
+EDITOR_POOL_SIZE_OPTION = "--editor-pool-size="
+# Where QSettings keeps the editor's settings
+SETTINGS_ORGANIZATION = "TavernAI"
+SETTINGS_APPLICATION = "Character Editor"
+# Number of worker threads used to read card metadata when scanning a directory
+SCAN_WORKER_COUNT = 8
+# Number of threads for tasks that hand their work out to the scan's threads and wait for it, like a
+# directory sync or a token report. They can't run on the scan's threads themselves, enough of them waiting
+# at once would leave no thread free to do the work they're waiting on.
+COORDINATOR_WORKER_COUNT = 4
+# Milliseconds to wait after the last edit before working out which fields differ from the saved card
+DIRTY_CHECK_DEBOUNCE_MS = 300
+# Stands in for a field name when a change can't be compared against the saved card, like importing
+# JSON over the whole card. The card stays dirty until it's saved.
+UNTRACKED_CHANGE = "*"
+# Milliseconds to wait after the last edit before recounting the tokens of the edited fields
+TOKEN_COUNT_DEBOUNCE_MS = 500
+# Entries are read from big JSON files and added to the character book this many at a time
+IMPORT_BATCH_SIZE = 500
+# Where the character book entries are in an exported character's JSON, they're streamed rather than loaded in one go
+CHARACTER_ENTRY_PATHS = (("data", "character_book", "entries"),)
+# Milliseconds to wait after the last keystroke in the search box before searching
+SEARCH_DEBOUNCE_MS = 250
+# When watching a directory, changes are applied once it has been quiet for this many milliseconds so
+# that a burst of events (like a big copy) turns into a single update
+WATCH_DEBOUNCE_MS = 500
 
 import sys
+import threading
+import time
+import profiling
+from profiling import timed
 from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QListWidget, QLabel, QListWidgetItem, QStackedWidget, QSplitter
 from PyQt5.QtWidgets import QLineEdit, QPlainTextEdit, QListWidget, QPushButton, QFormLayout, QTabWidget, QHBoxLayout, QFileDialog
-from PyQt5.QtWidgets import QCheckBox, QSizePolicy, QComboBox, QGridLayout, QAbstractItemView
-from PyQt5.QtGui import QIntValidator, QDoubleValidator
-from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QCheckBox, QSizePolicy, QComboBox, QGridLayout, QAbstractItemView, QProgressBar, QTableView, QHeaderView, QShortcut
+from PyQt5.QtGui import QIntValidator, QDoubleValidator, QColor, QKeySequence, QTextCursor
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, QTimer, QEvent, pyqtSignal
+from tokenizer import default_counter, PROMPT_FIELDS, NOTE_FIELDS
 import os
 import traceback
 
@@ -141,6 +91,19 @@ def safeNumberConversion(stringVal, default=None):
     except ValueError:
         return default
 
+# Qt counts positions in UTF-16 code units, Python in code points
+def utf16Length(text):
+    return len(text) if text.isascii() else len(text.encode("utf-16-le")) // 2
+
+# Replaces the span of a document that a splice changed, so only that part is laid out again rather than
+# the whole text. value is the text after the splice, inserted went in at start. The end of the old span
+# is found from the text after it, which the splice left alone.
+def spliceText(document, value, start, inserted):
+    cursor = QTextCursor(document)
+    cursor.setPosition(utf16Length(value[:start]))
+    cursor.setPosition(document.characterCount() - 1 - utf16Length(value[start + len(inserted):]), QTextCursor.KeepAnchor)
+    cursor.insertText(inserted)
+
 # For handling keys that are optional. If the value is equal to the nullvalue
 # it gets removed from the dict entirely.
 def updateOrDeleteKey(dictionary, key, value, nullvalue=None):
@@ -165,7 +128,7 @@ class AlternateGreetingWidget(QWidget):
         self.layout.addWidget(self.delete_button)
 
     def setDirty(self):
-        self.parentEditor.setDirty()
+        self.parentEditor.fieldChanged("alternate_greetings")
 
 #CharacterBook entry.
 class EntryWidget(QWidget):
@@ -173,6 +136,7 @@ class EntryWidget(QWidget):
         super().__init__(parent)
 
         self.characterBookParent = parent
+        self.loading = False
         
         self.layout = QVBoxLayout(self)
         self.setLayout(self.layout)
@@ -315,15 +279,22 @@ indicate that this particular data parameter is optional and may be absent entir
             self.setStyleSheet("")  # Reset to default style
         self.setDirty()
 
+    # Changes made by setData aren't edits, so they're ignored
     def setDirty(self):
-        self.characterBookParent.setDirty()
+        if not self.loading:
+            self.characterBookParent.entryEdited()
 
     # Takes an entry dict and updates the UI's contents to match
     def setData(self, entry):
+        self.loading = True
+        try:
+            self._setData(entry)
+        finally:
+            self.loading = False
+
+    def _setData(self, entry):
         if not entry:
-            self.enabled_checkbox.setChecked(True) #default new entries to enabled
-            self.extensions_edit.setPlainText("{}")
-            return
+            entry = newEntry()
         self.content_field.setPlainText(entry.get("content"))
         self.keys_field.setText(", ".join(entry.get("keys", [])))
         self.name_edit.setText(entry.get("name"))
@@ -372,6 +343,114 @@ indicate that this particular data parameter is optional and may be absent entir
             entry_dict["position"] = "after_char"
         return entry_dict
 
+# What a freshly added entry looks like
+def newEntry():
+    return {"keys": [], "content": "", "extensions": {}, "enabled": True, "insertion_order": 0}
+
+ENTRY_PREVIEW_LENGTH = 200
+DISABLED_ENTRY_COLOUR = "#D3D3D3"
+
+# The character book's entries as a read-only table. Rows only show a one-line summary of each entry,
+# the actual editing is done by a single EntryWidget bound to the selected row.
+class CharacterBookEntryModel(QAbstractTableModel):
+    COLUMNS = ("Keys", "Content", "Insertion Order", "Tokens")
+    TOKENS_COLUMN = 3
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.entries = []
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.entries)
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.COLUMNS[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        entry = self.entries[index.row()]
+        column = index.column()
+        if role == Qt.DisplayRole:
+            if column == 0:
+                keys = entry.get("keys", [])
+                return ", ".join(str(key) for key in keys) if isinstance(keys, list) else str(keys)
+            if column == 1:
+                content = str(entry.get("content") or "")
+                return content[:ENTRY_PREVIEW_LENGTH].replace("\n", " ")
+            if column == 2:
+                return str(entry.get("insertion_order", ""))
+            if column == self.TOKENS_COLUMN:
+                # counted in the background by the EditorWidget, blank until then
+                tokens = default_counter().cached(str(entry.get("content") or ""))
+                return str(tokens) if tokens is not None else ""
+        elif role == Qt.ToolTipRole and column == 1:
+            return str(entry.get("content") or "")[:ENTRY_PREVIEW_LENGTH * 5]
+        elif role == Qt.BackgroundRole and not entry.get("enabled", True):
+            return QColor(DISABLED_ENTRY_COLOUR)
+        return None
+
+    # Called when entry token counts have been worked out, so they're shown
+    def tokenCountsChanged(self):
+        if self.entries:
+            self.dataChanged.emit(self.index(0, self.TOKENS_COLUMN), self.index(len(self.entries) - 1, self.TOKENS_COLUMN))
+
+    def setEntries(self, entries):
+        self.beginResetModel()
+        self.entries = list(entries)
+        self.endResetModel()
+
+    def setEntry(self, row, entry):
+        self.entries[row] = entry
+        self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.COLUMNS) - 1))
+
+    def appendEntries(self, entries):
+        if not entries:
+            return
+        row = len(self.entries)
+        self.beginInsertRows(QModelIndex(), row, row + len(entries) - 1)
+        self.entries.extend(entries)
+        self.endInsertRows()
+
+    def appendEntry(self, entry):
+        row = len(self.entries)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.entries.append(entry)
+        self.endInsertRows()
+        return row
+
+    def removeEntry(self, row):
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.entries[row]
+        self.endRemoveRows()
+
+    # Replaces count rows from start with entries. Rows that stay in place are updated rather than
+    # removed and inserted again.
+    def replaceEntries(self, start, count, entries):
+        kept = min(count, len(entries))
+        self.entries[start:start + kept] = entries[:kept]
+        if kept:
+            self.dataChanged.emit(self.index(start, 0), self.index(start + kept - 1, len(self.COLUMNS) - 1))
+        if count > kept:
+            self.beginRemoveRows(QModelIndex(), start + kept, start + count - 1)
+            del self.entries[start + kept:start + count]
+            self.endRemoveRows()
+        elif len(entries) > kept:
+            self.beginInsertRows(QModelIndex(), start + kept, start + len(entries) - 1)
+            self.entries[start + kept:start + kept] = entries[kept:]
+            self.endInsertRows()
+
+CHARACTER_BOOK_FIELDS = ("name", "description", "scan_depth", "token_budget", "recursive_scanning", "extensions", "entries")
+
 # Much more complicated than the main window's list of properties, so it gets its own widget
 class CharacterBookWidget(QWidget):
     def __init__(self, fullData, parent):
@@ -421,6 +500,7 @@ class CharacterBookWidget(QWidget):
         self.token_budget_editor.setToolTip("Sets how much of the context can be taken up by entries.")
         self.token_budget_editor.setValidator(intValidator)
         self.token_budget_editor.textChanged.connect(self.setDirty)
+        self.token_budget_editor.textChanged.connect(self.updateTokenSummary)
         self.complex_attributes_layout.addWidget(self.token_budget_editor)
         self.recursive_scanning = QCheckBox("Recursive Scanning", self)
         self.recursive_scanning.setToolTip("""whether entry content can trigger other entries.
@@ -439,12 +519,37 @@ indicate that this particular data parameter is optional and may be absent entir
         self.extensions_edit.textChanged.connect(self.setDirty)
         self.extensions_form_layout.addRow("Extensions", self.extensions_edit)
         self.layout.addWidget(self.extensions_form)
-        
-        # Add a list widget for the entries
-        self.entries_list = QListWidget(self)
-        self.entries_list.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
-        self.entries_list.setStyleSheet("QListWidget::item { border-bottom: 1px solid black; }")
-        self.layout.addWidget(self.entries_list)
+
+        # Maps the book's own fields to the names EditorWidget tracks their changes under
+        self.trackedWidgets = {self.name_field: "character_book.name", self.description_field: "character_book.description",
+                               self.scan_depth_editor: "character_book.scan_depth", self.token_budget_editor: "character_book.token_budget",
+                               self.recursive_scanning: "character_book.recursive_scanning", self.extensions_edit: "character_book.extensions"}
+
+        self.entryTokens = None # (enabled entry tokens, constant entry tokens) once they've been counted
+        self.token_summary_label = QLabel("Counting tokens...", self)
+        self.token_summary_label.setToolTip("""Tokens in the content of the enabled entries. Constant entries are always inserted, the rest
+only when their keys come up, and entries that don't fit in the token budget are dropped.""")
+        self.layout.addWidget(self.token_summary_label)
+
+        # A table of all the entries, and an editor for whichever one is selected
+        self.entries_model = CharacterBookEntryModel(self)
+        self.entries_table = QTableView(self)
+        self.entries_table.setModel(self.entries_model)
+        self.entries_table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.entries_table.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.entries_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.entries_table.setWordWrap(False)
+        self.entries_table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.entries_table.horizontalHeader().setSectionResizeMode(1, QHeaderView.Stretch)
+        self.entries_table.horizontalHeader().setSectionResizeMode(CharacterBookEntryModel.TOKENS_COLUMN, QHeaderView.ResizeToContents)
+        self.entries_table.selectionModel().currentRowChanged.connect(self.select_entry)
+        self.layout.addWidget(self.entries_table, 1)
+
+        self.entry_editor = EntryWidget(self)
+        self.entry_editor.delete_button.clicked.connect(self.delete_entry)
+        self.entry_editor.setEnabled(False)
+        self.current_entry_row = -1
+        self.layout.addWidget(self.entry_editor)
 
         self.buttonWidget = QWidget(self)
         self.buttonWidgetLayout = QHBoxLayout()
@@ -462,57 +567,136 @@ indicate that this particular data parameter is optional and may be absent entir
 character's characterbook, and appends them to the existing character book's entries.""")
         self.importWorldbookButton.clicked.connect(self.import_worldbook)
         self.buttonWidgetLayout.addWidget(self.importWorldbookButton)
+        self.duplicatesBox = QComboBox(self)
+        self.duplicatesBox.setToolTip("""What to do with worldbook entries that have the same keys, secondary keys and content as an entry
+the character book already has. Key order, capitalization and whitespace are ignored.""")
+        for policy, label in DUPLICATE_POLICY_LABELS:
+            self.duplicatesBox.addItem(label, policy)
+        self.buttonWidgetLayout.addWidget(self.duplicatesBox)
+        self.importResultLabel = QLabel(self)
+        self.importResultLabel.setToolTip("What the last worldbook import did")
+        self.buttonWidgetLayout.addWidget(self.importResultLabel)
+
+        self.testActivationButton = QPushButton("Test Activation", self)
+        self.testActivationButton.setToolTip("""Shows which entries a sample chat would activate, using this book's keys, scan depth,
+token budget and recursive scanning settings.""")
+        self.testActivationButton.clicked.connect(lambda: LorebookTestDialog(self).show())
+        self.buttonWidgetLayout.addWidget(self.testActivationButton)
 
         self.view_checkbox.setChecked(True)
 
     def add_entry(self, entry=None):
-        widget_item = QListWidgetItem(self.entries_list)
-        custom_widget = EntryWidget(self)
-        custom_widget.setData(entry)
-        custom_widget.complex_attributes.setVisible(not self.view_checkbox.isChecked())
-        widget_item.setSizeHint(custom_widget.sizeHint())
-        self.entries_list.addItem(widget_item)
-        self.entries_list.setItemWidget(widget_item, custom_widget)
-        custom_widget.delete_button.clicked.connect(lambda: self.delete_entry(widget_item))
-        self.setDirty()
+        row = self.entries_model.appendEntry(entry or newEntry())
+        self.entries_table.selectRow(row)
+        self.entries_table.scrollTo(self.entries_model.index(row, 0))
+        self.editorParent.fieldChanged("character_book.entries")
+
+    # Binds the entry editor to another row
+    def select_entry(self, current, previous=None):
+        self.current_entry_row = current.row() if current.isValid() else -1
+        self.entry_editor.setEnabled(self.current_entry_row >= 0)
+        if self.current_entry_row >= 0:
+            self.entry_editor.setData(self.entries_model.entries[self.current_entry_row])
+        else:
+            self.entry_editor.setData(None)
+
+    # Called by the entry editor whenever one of its fields changes
+    def entryEdited(self):
+        if self.current_entry_row >= 0:
+            self.entries_model.setEntry(self.current_entry_row, self.entry_editor.getData())
+        self.editorParent.fieldChanged("character_book.entries")
 
     def import_worldbook(self):
         options = QFileDialog.Options()
         options |= QFileDialog.ReadOnly
         filepath = self.window().global_filepath
         fileName, _ = QFileDialog.getOpenFileName(self, "QFileDialog.getOpenFileName()", filepath, "JSON Files (*.json)", options=options)
-        if fileName:
-            with open(fileName, "r", encoding="utf-8") as f:
-                worldBook = json.load(f)
-                worldBook = process_worldbook(worldBook)
-                if worldBook == None:
-                    return
-                characterBook = self.fullData["data"].get("character_book", {})
-                self.fullData["data"]["character_book"] = characterBook
-                import_worldbook(characterBook, worldBook)
-                self.updateUIFromData()
-                self.setDirty()
+        if not fileName:
+            return
+        self.editorParent.updateDataFromUI() # so that edits made since loading aren't lost
+        characterBook = self.fullData["data"].get("character_book", {})
+        self.fullData["data"]["character_book"] = characterBook
+        # Entries are read on another thread and merged into the book, and shown in the table, a batch at a time
+        merger = WorldbookMerger(characterBook, self.duplicatesBox.currentData())
+        stream = WorldbookStream(fileName)
+        def addBatch(batch, progress):
+            start = len(merger.entries)
+            replaced = merger.add(batch)
+            self.entries_model.appendEntries(merger.entries[start:])
+            for position in replaced:
+                self.entries_model.setEntry(position, merger.entries[position])
+        dialog = StreamingImportDialog("Importing Worldbook", stream.batches(IMPORT_BATCH_SIZE), stream.progress, self)
+        dialog.batchRead.connect(addBatch)
+        dialog.exec_()
+        worldBook = stream.worldbook() if dialog.succeeded() else None
+        if worldBook is None:
+            merger.rollback()
+            self.entries_model.setEntries(characterBook["entries"])
+            self.select_entry(QModelIndex())
+            self.importResultLabel.setText("Cancelled" if dialog.cancelled.is_set() else "Not a worldbook" if dialog.error is None else "Unable to read the file")
+            return
+        merger.finish(worldBook)
+        added, skipped, updated = merger.counts()
+        # changes to the book's own fields are picked up through their widgets' change signals
+        self.updateUIFromData()
+        if added or updated:
+            self.editorParent.fieldChanged("character_book.entries")
+        self.importResultLabel.setText("%d added, %d skipped, %d updated" % (added, skipped, updated))
     
-    def delete_entry(self, item):
-        row = self.entries_list.row(item)
-        self.entries_list.takeItem(row)
-        self.setDirty()
+    # Replaces count entries from start, for undo and redo. The entry editor is rebound in case its entry changed.
+    def replace_entries(self, start, count, entries):
+        self.entries_model.replaceEntries(start, count, entries)
+        self.select_entry(self.entries_table.currentIndex())
+
+    # Selects an entry by its position, for jumping to a search hit
+    def show_entry(self, row):
+        if 0 <= row < self.entries_model.rowCount():
+            self.entries_table.selectRow(row)
+            self.entries_table.scrollTo(self.entries_model.index(row, 0))
+
+    def delete_entry(self):
+        row = self.current_entry_row
+        if row < 0:
+            return
+        self.entries_model.removeEntry(row)
+        # removing the row moves the table's current index, which rebinds the entry editor
+        if self.entries_model.rowCount() == 0:
+            self.select_entry(QModelIndex())
+        self.editorParent.fieldChanged("character_book.entries")
 
     def toggle_view(self, state):
         # Toggle the visibility of certain fields based on the checkbox state
         self.complex_attributes.setVisible(state == Qt.Unchecked)
         self.extensions_form.setVisible(state == Qt.Unchecked)
-        for i in range(self.entries_list.count()):
-            item = self.entries_list.item(i)
-            widget = self.entries_list.itemWidget(item)
-            widget.complex_attributes.setVisible(state == Qt.Unchecked)
-            sizeHint = widget.sizeHint()
-            item.setSizeHint(sizeHint)
-        self.entries_list.updateGeometry()
+        self.entry_editor.complex_attributes.setVisible(state == Qt.Unchecked)
 
+    # Connected to the textChanged and stateChanged signals of the fields in trackedWidgets
     def setDirty(self):
-        self.editorParent.setDirty()
+        self.editorParent.fieldChanged(self.trackedWidgets.get(self.sender(), UNTRACKED_CHANGE))
+
+    # Called by the EditorWidget with fresh counts of the entries' tokens
+    def showTokenCounts(self, entryTokens, constantTokens):
+        self.entryTokens = (entryTokens, constantTokens)
+        self.entries_model.tokenCountsChanged()
+        self.updateTokenSummary()
 
+    def updateTokenSummary(self):
+        if self.entryTokens is None:
+            return
+        entryTokens, constantTokens = self.entryTokens
+        text = "Entries: %d tokens, %d of them in constant entries" % (entryTokens, constantTokens)
+        # the validator lets half-typed values like "-" through, those count as no budget
+        try:
+            budget = int(self.token_budget_editor.text())
+        except ValueError:
+            budget = None
+        if budget is not None:
+            text += " - token budget %d" % budget
+            if constantTokens > budget:
+                text += ", constant entries alone go over it"
+        self.token_summary_label.setText(text)
+
+    @timed("CharacterBookWidget.updateUIFromData")
     def updateUIFromData(self):
         characterBook = self.fullData["data"].get("character_book", {})
         self.name_field.setText(characterBook.get("name", ""))
@@ -523,43 +707,91 @@ character's characterbook, and appends them to the existing character book's ent
         self.extensions_edit.setPlainText(json.dumps(characterBook.get("extensions", {})))
         
         #initialize entries
-        self.entries_list.clear()
-        for entry in characterBook.get("entries", []):
-            self.add_entry(entry)
+        self.entries_model.setEntries(characterBook.get("entries", []))
+        self.select_entry(QModelIndex())
 
-    def updateDataFromUI(self):
+    # Copies the given fields of the book from the widgets into fullData, all of them if fields is None.
+    # Field names are the ones in trackedWidgets without their "character_book." prefix, plus "entries".
+    def updateDataFromUI(self, fields=None):
         characterBook = self.fullData["data"].get("character_book", {})
         self.fullData["data"]["character_book"] = characterBook
-
-        updateOrDeleteKey(characterBook, "name", self.name_field.text(), "")
-        updateOrDeleteKey(characterBook, "description", self.description_field.toPlainText(), "")
-        if self.scan_depth_editor.text() != "":
-            characterBook["scan_depth"] = int(self.scan_depth_editor.text())
-        elif "scan_depth" in characterBook:
-            del characterBook["scan_depth"]
-        if self.token_budget_editor.text() != "":
-            characterBook["token_budget"] = int(self.token_budget_editor.text())
-        elif "token_budget" in characterBook:
-            del characterBook["token_budget"]
-        updateOrDeleteKey(characterBook, "recursive_scanning", convertTristateToBool(self.recursive_scanning.checkState()))
-        characterBook["extensions"] = safeJSONLoads(self.extensions_edit.toPlainText())
-        
-        entries = []
-        for i in range(self.entries_list.count()):
-            item = self.entries_list.item(i)
-            entry = self.entries_list.itemWidget(item)
-            entries.append(entry.getData())
-        characterBook["entries"] = entries
-
+        if fields is None:
+            fields = CHARACTER_BOOK_FIELDS
+
+        if "name" in fields:
+            updateOrDeleteKey(characterBook, "name", self.name_field.text(), "")
+        if "description" in fields:
+            updateOrDeleteKey(characterBook, "description", self.description_field.toPlainText(), "")
+        for key, editor in (("scan_depth", self.scan_depth_editor), ("token_budget", self.token_budget_editor)):
+            if key not in fields:
+                continue
+            if editor.text() == "":
+                characterBook.pop(key, None)
+                continue
+            # the validator lets half-typed values like "-" through, those keep the value the book had
+            try:
+                characterBook[key] = int(editor.text())
+            except ValueError:
+                pass
+        if "recursive_scanning" in fields:
+            updateOrDeleteKey(characterBook, "recursive_scanning", convertTristateToBool(self.recursive_scanning.checkState()))
+        if "extensions" in fields:
+            characterBook["extensions"] = safeJSONLoads(self.extensions_edit.toPlainText())
+        if "entries" in fields:
+            # the entries model is kept up to date as the entry editor is used
+            characterBook["entries"] = list(self.entries_model.entries)
+
+
+# The fields whose tokens are counted, the character book's entries are counted together
+TOKEN_COUNTED_FIELDS = PROMPT_FIELDS + NOTE_FIELDS + ("character_book.entries",)
 
 class EditorWidget(QWidget):
-    def __init__(self, fullData, filePath, itemLabel, parent=None):
+    # Emitted from tokenExecutor's thread, delivered on the GUI thread
+    tokensCounted = pyqtSignal(int, object)
+
+    # cardModel is the CardListModel that shows this card, it's told when the editor becomes dirty.
+    # Token counting runs on tokenExecutor.
+    @timed("EditorWidget.__init__")
+    def __init__(self, fullData, filePath, cardModel, tokenExecutor, journal, parent=None):
         super().__init__(parent)
         
         self.fullData = fullData
         self.filePath = filePath
-        self.itemLabel = itemLabel
+        self.cardModel = cardModel
+        # Every change that goes into the undo history also goes into the autosave journal
+        self.journal = journal
         self.initializing = True
+        # Edits are checked against originalValues once typing pauses, a card is only dirty if some
+        # field actually differs from what was loaded or last saved
+        self.dirty = False
+        self.dirtyFields = set()
+        self.pendingFields = set()
+        self.originalValues = {}
+        self.dirtyTimer = QTimer(self)
+        self.dirtyTimer.setSingleShot(True)
+        self.dirtyTimer.setInterval(DIRTY_CHECK_DEBOUNCE_MS)
+        self.dirtyTimer.timeout.connect(self.checkDirty)
+        # Fields edited since fullData was last brought up to date by updateDataFromUI
+        self.staleFields = set()
+        # Remembers the JSON of the parts of the card that haven't changed between saves
+        self.encoder = CharacterEncoder()
+        # Only the fields edited since the last count are recounted, once typing pauses. Counts come back
+        # tagged with the generation they were started in so a slow, older count can't overwrite a newer one.
+        self.tokenExecutor = tokenExecutor
+        self.tokenCounter = default_counter()
+        self.tokenCounts = {}
+        self.tokenGeneration = 0
+        self.tokenGenerations = {} # field: generation of its latest count
+        self.tokenPendingFields = set()
+        self.tokenTimer = QTimer(self)
+        self.tokenTimer.setSingleShot(True)
+        self.tokenTimer.setInterval(TOKEN_COUNT_DEBOUNCE_MS)
+        self.tokenTimer.timeout.connect(self.countTokens)
+        self.tokensCounted.connect(self.showTokenCounts)
+        # Undo steps are recorded when the dirty check runs, as the difference between each edited field's
+        # value and its value at the last step
+        self.history = UndoHistory()
+        self.historyValues = {}
         
         self.tab_widget = QTabWidget(self)
 
@@ -703,12 +935,30 @@ to get the best experience from the bot.""")
 Doesn't update the character card PNG, you'll need to click "Save" after importing to do that.""")
         self.importButton.root = self
         self.importButton.clicked.connect(self.importClicked)
+        self.undoButton = QPushButton("Undo", self)
+        self.undoButton.setToolTip("""Undoes the last change to this card, including imports and changes to the character book's entries.
+Changes are grouped by pauses in typing. Shortcut: Ctrl+Z""")
+        self.undoButton.clicked.connect(self.undo)
+        self.redoButton = QPushButton("Redo", self)
+        self.redoButton.setToolTip("Redoes the last change that was undone. Shortcut: Ctrl+Y or Ctrl+Shift+Z")
+        self.redoButton.clicked.connect(self.redo)
+        # The platform's undo and redo keys. Text fields handle those keys themselves, so for them they're
+        # caught by eventFilter instead, this covers everything else in the editor.
+        QShortcut(QKeySequence.Undo, self, self.undo, context=Qt.WidgetWithChildrenShortcut)
+        QShortcut(QKeySequence.Redo, self, self.redo, context=Qt.WidgetWithChildrenShortcut)
+
+        self.cardTokensLabel = QLabel("Counting tokens...", self)
+        self.cardTokensLabel.setToolTip("""Tokens in the fields that are sent to the model, plus the content of every enabled
+character book entry. Creator notes aren't included.""")
 
         # Create a horizontal layout for the buttons
         self.button_layout = QHBoxLayout()
+        self.button_layout.addWidget(self.cardTokensLabel)
         self.button_layout.addWidget(self.saveButton)
         self.button_layout.addWidget(self.exportButton)
         self.button_layout.addWidget(self.importButton)
+        self.button_layout.addWidget(self.undoButton)
+        self.button_layout.addWidget(self.redoButton)
 
         # Create a vertical layout for the root widget
         self.root_layout = QVBoxLayout(self)
@@ -718,8 +968,31 @@ Doesn't update the character card PNG, you'll need to click "Save" after importi
         # Set QVBoxLayout as the layout
         self.setLayout(self.root_layout)
 
+        self.trackedWidgets = {self.nameEdit: "name", self.descriptionEdit: "description", self.personalityEdit: "personality",
+                               self.scenarioEdit: "scenario", self.firstMesEdit: "first_mes", self.mesExampleEdit: "mes_example",
+                               self.systemPromptEdit: "system_prompt", self.postHistoryInstructionsEdit: "post_history_instructions",
+                               self.tagsList: "tags", self.characterVersionEdit: "character_version", self.creatorEdit: "creator",
+                               self.creatorNotesEdit: "creator_notes", self.extensionsEdit: "extensions"}
+        self.trackedFields = {field: widget for widget, field in self.trackedWidgets.items()}
+        self.trackedFields.update({field: widget for widget, field in self.characterBookEdit.trackedWidgets.items()})
+        self.markClean()
+        self.historyValues = dict(self.originalValues)
+        self.updateUndoButtons()
+        for widget in self.findChildren((QLineEdit, QPlainTextEdit)):
+            widget.installEventFilter(self)
+
+        # The labels that show each field's token count, with their text before the count was added
+        tokenLabels = {field: self.tabCommon_layout.labelForField(self.trackedFields[field])
+                       for field in ("name", "description", "personality", "scenario", "first_mes", "mes_example")}
+        tokenLabels.update({field: self.tabUncommon_layout.itemAtPosition(row, 0).widget() for field, row in
+                            (("alternate_greetings", 0), ("system_prompt", 2), ("post_history_instructions", 3), ("creator_notes", 6))})
+        self.tokenLabels = {field: (label, label.text()) for field, label in tokenLabels.items()}
+        self.tokenPendingFields.update(TOKEN_COUNTED_FIELDS)
+        self.countTokens()
+
         self.initializing = None
 
+    @timed("EditorWidget.updateUIFromData")
     def updateUIFromData(self):
         data = self.fullData["data"]
         self.nameEdit.setText(data.get("name"))
@@ -744,39 +1017,54 @@ Doesn't update the character card PNG, you'll need to click "Save" after importi
 
         self.characterBookEdit.updateUIFromData()
 
+    # Copies the fields edited since the last call from the widgets into fullData. Untouched fields keep
+    # their existing values, so they aren't re-parsed and the encoder can reuse their JSON.
     def updateDataFromUI(self):
-        fullData = self.fullData
-        data = fullData["data"]
-
-        data["name"] = str(self.nameEdit.text())
-        data["tags"] = [x.strip() for x in str(self.tagsList.text()).split(',')]
-        if "" in data["tags"]:
-            data["tags"].remove("")
-        data["character_version"] = str(self.characterVersionEdit.text())
-        data["description"] = str(self.descriptionEdit.toPlainText())
-        data["personality"] = str(self.personalityEdit.toPlainText())
-        data["scenario"] = str(self.scenarioEdit.toPlainText())
-        data["first_mes"] = str(self.firstMesEdit.toPlainText())
-        data["mes_example"] = str(self.mesExampleEdit.toPlainText())
-
-        alternateGreetings = []
-        for i in range(self.alternateGreetingsList.count()):
-            item = self.alternateGreetingsList.item(i)
-            greeting = self.alternateGreetingsList.itemWidget(item)
-            alternateGreetings.append(greeting.editor.toPlainText())
-        data["alternate_greetings"] = alternateGreetings
-        data["system_prompt"] = str(self.systemPromptEdit.toPlainText())
-        data["post_history_instructions"] = str(self.postHistoryInstructionsEdit.toPlainText())
-        data["creator"] = str(self.creatorEdit.text())
-        data["creator_notes"] = str(self.creatorNotesEdit.toPlainText())
-        data["extensions"] = safeJSONLoads(self.extensionsEdit.toPlainText())
-        
-        self.characterBookEdit.updateDataFromUI()
+        fields = self.staleFields
+        self.staleFields = set()
+        data = self.fullData["data"]
+
+        if "name" in fields:
+            data["name"] = str(self.nameEdit.text())
+        if "tags" in fields:
+            data["tags"] = [x.strip() for x in str(self.tagsList.text()).split(',')]
+            if "" in data["tags"]:
+                data["tags"].remove("")
+        if "character_version" in fields:
+            data["character_version"] = str(self.characterVersionEdit.text())
+        if "description" in fields:
+            data["description"] = str(self.descriptionEdit.toPlainText())
+        if "personality" in fields:
+            data["personality"] = str(self.personalityEdit.toPlainText())
+        if "scenario" in fields:
+            data["scenario"] = str(self.scenarioEdit.toPlainText())
+        if "first_mes" in fields:
+            data["first_mes"] = str(self.firstMesEdit.toPlainText())
+        if "mes_example" in fields:
+            data["mes_example"] = str(self.mesExampleEdit.toPlainText())
+
+        if "alternate_greetings" in fields:
+            data["alternate_greetings"] = self.fieldValue("alternate_greetings")
+        if "system_prompt" in fields:
+            data["system_prompt"] = str(self.systemPromptEdit.toPlainText())
+        if "post_history_instructions" in fields:
+            data["post_history_instructions"] = str(self.postHistoryInstructionsEdit.toPlainText())
+        if "creator" in fields:
+            data["creator"] = str(self.creatorEdit.text())
+        if "creator_notes" in fields:
+            data["creator_notes"] = str(self.creatorNotesEdit.toPlainText())
+        if "extensions" in fields:
+            data["extensions"] = safeJSONLoads(self.extensionsEdit.toPlainText())
+
+        bookFields = [field[len("character_book."):] for field in fields if field.startswith("character_book.")]
+        if bookFields:
+            self.characterBookEdit.updateDataFromUI(bookFields)
 
     def saveClicked(self):
         self.updateDataFromUI()
-        write_character(self.filePath, self.fullData)
-        self.itemLabel.setStyleSheet("")
+        write_character(self.filePath, self.fullData, self.encoder)
+        self.window().cardSaved(self.filePath)
+        self.markClean()
 
     def exportClicked(self):
         self.updateDataFromUI()
@@ -786,103 +1074,949 @@ Doesn't update the character card PNG, you'll need to click "Save" after importi
         fileName, _ = QFileDialog.getSaveFileName(self,"QFileDialog.getSaveFileName()", jsonFilepath, "JSON Files (*.json)", options=options)
         if fileName:
             with open(fileName, "w", encoding="utf-8") as f:
-                json.dump(self.fullData, f)
+                f.write(self.encoder.encode(self.fullData))
 
     def importClicked(self):
         options = QFileDialog.Options()
         options |= QFileDialog.ReadOnly
         filepath = self.window().global_filepath
         fileName, _ = QFileDialog.getOpenFileName(self, "QFileDialog.getOpenFileName()", filepath, "JSON Files (*.json)", options=options)
-        if fileName:
-            with open(fileName, "r", encoding="utf-8") as f:
-                self.fullData = json.load(f)
-        self.updateUIFromData()
-        self.setDirty()
+        if not fileName:
+            return
+        # The character book's entries are read a batch at a time on another thread, the rest of the
+        # character comes with the last batch
+        stream = JSONItemStream(fileName, CHARACTER_ENTRY_PATHS)
+        entries = []
+        dialog = StreamingImportDialog("Importing Character", stream.batches(IMPORT_BATCH_SIZE), stream.progress, self)
+        dialog.batchRead.connect(lambda batch, progress: entries.extend(batch))
+        dialog.exec_()
+        if not dialog.succeeded():
+            return
+        if stream.itemPath is not None:
+            stream.document["data"]["character_book"]["entries"] = entries
+        self.replaceCardData(stream.document)
+
+    # Brings a field into view, for jumping to a search hit. entry is the character book entry's
+    # position when field is "entry".
+    def showField(self, field, entry=-1):
+        if field == "entry":
+            self.tab_widget.setCurrentWidget(self.tabCharacterBook)
+            self.characterBookEdit.show_entry(entry)
+            return
+        if field == "alternate_greetings":
+            self.tab_widget.setCurrentWidget(self.tabUncommon)
+            return
+        widget = {"name": self.nameEdit, "description": self.descriptionEdit, "personality": self.personalityEdit,
+                  "scenario": self.scenarioEdit, "first_mes": self.firstMesEdit, "mes_example": self.mesExampleEdit}.get(field)
+        self.tab_widget.setCurrentWidget(self.tabCommon)
+        if widget is not None:
+            widget.setFocus()
 
     def add_alternate_greeting(self, text=None):
         widget_item = QListWidgetItem(self.alternateGreetingsList)
         custom_widget = AlternateGreetingWidget(self)
+        custom_widget.editor.installEventFilter(self)
         if text:
             custom_widget.editor.setPlainText(text)
         widget_item.setSizeHint(custom_widget.sizeHint())
         self.alternateGreetingsList.addItem(widget_item)
         self.alternateGreetingsList.setItemWidget(widget_item, custom_widget)
         custom_widget.delete_button.clicked.connect(lambda: self.delete_alternate_greeting(widget_item))
-        self.setDirty()
+        self.fieldChanged("alternate_greetings")
 
     def delete_alternate_greeting(self, item):
         row = self.alternateGreetingsList.row(item)
         self.alternateGreetingsList.takeItem(row)
-        self.setDirty()
+        self.fieldChanged("alternate_greetings")
 
+    # Connected to the textChanged signals of the fields in trackedWidgets
     def setDirty(self):
-        if not self.initializing:
-            self.itemLabel.setStyleSheet(DIRTY_CHARACTER_COLOUR)  # Light gray
+        self.fieldChanged(self.trackedWidgets.get(self.sender(), UNTRACKED_CHANGE))
+
+    # The current value of a tracked field, in a form that can be compared with its original value
+    def fieldValue(self, field):
+        if field == "alternate_greetings":
+            return [self.alternateGreetingsList.itemWidget(self.alternateGreetingsList.item(i)).editor.toPlainText()
+                    for i in range(self.alternateGreetingsList.count())]
+        if field == "character_book.entries":
+            # entries are replaced rather than modified when edited, so a shallow copy is a snapshot
+            return list(self.characterBookEdit.entries_model.entries)
+        widget = self.trackedFields[field]
+        if isinstance(widget, QLineEdit):
+            return widget.text()
+        if isinstance(widget, QPlainTextEdit):
+            return widget.toPlainText()
+        return widget.checkState()
+
+    # Takes the current contents of the editor as the saved state
+    def markClean(self):
+        self.dirtyTimer.stop()
+        self.recordHistory()
+        self.pendingFields.clear()
+        self.dirtyFields.clear()
+        self.originalValues = {field: self.fieldValue(field) for field in list(self.trackedFields) + ["alternate_greetings", "character_book.entries"]}
+        self.updateDirtyState()
+
+    # Records that a field was edited. The card is marked dirty straight away, the comparison against
+    # the original value waits until edits stop coming in.
+    def fieldChanged(self, field):
+        if self.initializing:
+            return
+        self.pendingFields.add(field)
+        self.staleFields.add(field)
+        if not self.dirty:
+            self.dirty = True
+            self.cardModel.setDirty(self.filePath, True)
+        self.dirtyTimer.start()
+        if field == UNTRACKED_CHANGE:
+            self.tokenPendingFields.update(TOKEN_COUNTED_FIELDS)
+        elif field in TOKEN_COUNTED_FIELDS:
+            self.tokenPendingFields.add(field)
+        if self.tokenPendingFields:
+            self.tokenTimer.start()
+
+    def checkDirty(self):
+        self.dirtyTimer.stop()
+        self.recordHistory()
+        for field in self.pendingFields:
+            if field == UNTRACKED_CHANGE or self.fieldValue(field) != self.originalValues.get(field):
+                self.dirtyFields.add(field)
+            else:
+                self.dirtyFields.discard(field)
+        self.pendingFields.clear()
+        self.updateDirtyState()
+
+    # Adds an undo step for the pending fields that differ from their values at the last step
+    def recordHistory(self):
+        changes = []
+        for field in self.pendingFields:
+            if field == UNTRACKED_CHANGE:
+                continue # recorded by whatever made the change
+            value = self.fieldValue(field)
+            change = undo_history.diff(self.historyValues.get(field), value)
+            if change is not None:
+                changes.append((field, change))
+                self.historyValues[field] = value
+                self.journal.record(self.filePath, field, change)
+        if changes:
+            self.history.record(changes)
+            self.updateUndoButtons()
+
+    # Installed on the editor's text fields so the undo and redo keys undo changes to the whole card rather
+    # than just the field's own typing
+    def eventFilter(self, watched, event):
+        if event.type() == QEvent.KeyPress:
+            if event.matches(QKeySequence.Undo):
+                self.undo()
+                return True
+            if event.matches(QKeySequence.Redo):
+                self.redo()
+                return True
+        return super().eventFilter(watched, event)
+
+    def updateUndoButtons(self):
+        self.undoButton.setEnabled(self.history.canUndo())
+        self.redoButton.setEnabled(self.history.canRedo())
+
+    def undo(self):
+        # edits still waiting for the dirty check become a step of their own first, so they're what gets undone
+        self.checkDirty()
+        self.applyHistory(self.history.undo())
+
+    def redo(self):
+        self.checkDirty()
+        self.applyHistory(self.history.redo())
+
+    def applyHistory(self, changes):
+        if changes is None:
+            return
+        for field, change in changes:
+            if field == UNTRACKED_CHANGE:
+                # the whole card was replaced, change holds the card data from before and after
+                self.updateDataFromUI()
+                self.setCardData(change[2])
+                self.journal.recordData(self.filePath, self.fullData)
+                continue
+            value = undo_history.apply(self.historyValues[field], change)
+            # the widgets report the change like any other edit, it matches historyValues so no new step is recorded
+            self.historyValues[field] = value
+            self.setFieldValue(field, value, (change[1], len(change[2]), change[3]) if change[0] == "splice" else None)
+            self.journal.record(self.filePath, field, change)
+        self.updateUndoButtons()
+
+    # Puts a new value into a field's widgets. splice is (start, count, inserted) if only that span of the
+    # field changed, so only those rows of the character book's entries, or that part of a text box's
+    # document, are updated.
+    def setFieldValue(self, field, value, splice=None):
+        if field == "alternate_greetings":
+            self.alternateGreetingsList.clear()
+            for greeting in value:
+                self.add_alternate_greeting(greeting)
+            self.fieldChanged(field)
+        elif field == "character_book.entries":
+            if splice is not None:
+                self.characterBookEdit.replace_entries(*splice)
+            else:
+                self.characterBookEdit.entries_model.setEntries(value)
+            self.fieldChanged(field)
+        else:
+            widget = self.trackedFields[field]
+            if isinstance(widget, QLineEdit):
+                widget.setText(value)
+            elif isinstance(widget, QPlainTextEdit):
+                if splice is not None:
+                    spliceText(widget.document(), value, splice[0], splice[2])
+                else:
+                    widget.setPlainText(value)
+            else:
+                widget.setCheckState(Qt.CheckState(value)) # a plain int when it comes from the journal
+
+    # Replays edits from the autosave journal that were never saved. They become one undo step and are
+    # journaled again as that step.
+    def restoreEdits(self, records):
+        for record in records:
+            if record[0] == "data":
+                self.replaceCardData(record[1])
+            elif record[1] in self.originalValues:
+                field = record[1]
+                self.setFieldValue(field, apply_record(self.fieldValue(field), record), tuple(record[2:]) if record[0] == "splice" else None)
+        self.checkDirty()
+
+    # Replaces the card's whole data as one undo step, keeping the card as it was whole for undoing it
+    def replaceCardData(self, fullData):
+        # brought up to date with the editor first so the undo step has everything
+        self.checkDirty()
+        self.updateDataFromUI()
+        previous = self.fullData
+        self.setCardData(fullData)
+        self.history.record([(UNTRACKED_CHANGE, ("replace", previous, self.fullData))])
+        self.journal.recordData(self.filePath, self.fullData)
+        self.updateUndoButtons()
+
+    # Shows different card data, like an imported character. Everything is compared against the saved card again.
+    def setCardData(self, fullData):
+        self.fullData = fullData
+        self.characterBookEdit.fullData = self.fullData
+        self.staleFields = set()
+        self.updateUIFromData()
+        self.fieldChanged(UNTRACKED_CHANGE)
+        # the widgets' change signals have queued up every field, there's nothing new for the history though
+        self.historyValues = {field: self.fieldValue(field) for field in self.historyValues}
+
+    def updateDirtyState(self):
+        dirty = bool(self.dirtyFields) or bool(self.pendingFields)
+        if dirty != self.dirty:
+            self.dirty = dirty
+            self.cardModel.setDirty(self.filePath, dirty)
+            if not dirty:
+                # saved, or every edit was undone, either way there's nothing left to recover
+                self.journal.clear(self.filePath)
+
+    # Takes a snapshot of the fields edited since the last count and counts them on tokenExecutor
+    def countTokens(self):
+        self.tokenTimer.stop()
+        if not self.tokenPendingFields:
+            return
+        self.tokenGeneration += 1
+        values = {field: self.fieldValue(field) for field in self.tokenPendingFields}
+        for field in values:
+            self.tokenGenerations[field] = self.tokenGeneration
+        self.tokenPendingFields.clear()
+        self.tokenExecutor.submit(self.countTokensInBackground, self.tokenGeneration, values)
+
+    # Runs on tokenExecutor's thread. Texts that were counted before come straight from the counter's cache.
+    def countTokensInBackground(self, generation, values):
+        try:
+            counts = {}
+            for field, value in values.items():
+                if field == "character_book.entries":
+                    counts[field] = self.tokenCounter.count_entries(value)[:2]
+                else:
+                    counts[field] = self.tokenCounter.count_field(value)
+            self.tokensCounted.emit(generation, counts)
+        except RuntimeError:
+            pass # the editor was closed while counting
+        except Exception:
+            print("unable to count tokens", self.filePath, traceback.format_exc())
+
+    def showTokenCounts(self, generation, counts):
+        for field, count in counts.items():
+            if self.tokenGenerations.get(field) != generation:
+                continue # a newer count is on its way
+            self.tokenCounts[field] = count
+            if field == "character_book.entries":
+                self.characterBookEdit.showTokenCounts(*count)
+            elif field in self.tokenLabels:
+                label, text = self.tokenLabels[field]
+                label.setText("%s\n(%d tokens)" % (text, count))
+        if all(field in self.tokenCounts for field in PROMPT_FIELDS + ("character_book.entries",)):
+            fieldTokens = sum(self.tokenCounts[field] for field in PROMPT_FIELDS)
+            entryTokens = self.tokenCounts["character_book.entries"][0]
+            self.cardTokensLabel.setText("%d tokens (%d in fields, %d in character book entries)" % (fieldTokens + entryTokens, fieldTokens, entryTokens))
 
 from PyQt5.QtGui import QPixmap, QPainter, QColor
-from PyQt5.QtCore import Qt, QSize, pyqtSignal
+from PyQt5.QtCore import Qt, QSize, pyqtSignal, QFileSystemWatcher, QTimer, QAbstractListModel, QModelIndex, QRect, QSettings
+from PyQt5.QtWidgets import QListView, QStyledItemDelegate, QStyle, QDialog, QRadioButton, QTableWidget, QTableWidgetItem
+from PyQt5.QtWidgets import QTreeWidget, QTreeWidgetItem, QMessageBox
+from collections import OrderedDict
+from thumbnail_cache import ThumbnailCache
+from card_index import CardIndex
+from lorebook import LorebookSimulator
+from duplicates import find_duplicates
+import re
+from concurrent.futures import ThreadPoolExecutor
+import bisect
+
+THUMBNAIL_SIZE = 64
+CARD_ROW_MARGIN = 4
+# How many thumbnails the card list keeps decoded in memory. Thumbnails of rows that haven't been
+# painted in a while are dropped and reloaded from the ThumbnailCache if they scroll back into view.
+THUMBNAIL_MEMORY_COUNT = 500
+# How many cards or entries the duplicate finder lists under each group, the rest are counted
+DUPLICATE_GROUP_DISPLAY_LIMIT = 200
+# How often edits are written to the autosave journal, see autosave_journal.py
+AUTOSAVE_INTERVAL_MS = 3000
+# How many card names the restore prompt lists, the rest are counted
+RESTORE_PROMPT_NAME_LIMIT = 20
+
+# The cards in the current directory, sorted by filepath. Only the CardIndex summary of each card is
+# held here and thumbnails are loaded on the scan's thread pool the first time a row is painted.
+class CardListModel(QAbstractListModel):
+    FilePathRole = Qt.UserRole
+    FilenameRole = Qt.UserRole + 1
+    DirtyRole = Qt.UserRole + 2
+
+    # Emitted from worker threads, delivered on the GUI thread
+    thumbnailLoaded = pyqtSignal(int, str, object)
+
+    def __init__(self, executor, thumbnailCache, parent=None):
+        super().__init__(parent)
+        self.executor = executor
+        self.thumbnailCache = thumbnailCache
+        self.devicePixelRatio = 1.0
+        self.generation = 0
+        self.imagePaths = []
+        self.summaries = {}
+        self.dirtyPaths = set()
+        self.pixmaps = OrderedDict() # least recently painted first
+        self.pendingThumbnails = set()
+        self.thumbnailLoaded.connect(self.storeThumbnail)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.imagePaths)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        imagePath = self.imagePaths[index.row()]
+        if role == Qt.DisplayRole:
+            return self.summaries[imagePath].name
+        if role == Qt.DecorationRole:
+            return self.thumbnail(imagePath)
+        if role == Qt.ToolTipRole or role == self.FilePathRole:
+            return imagePath
+        if role == self.FilenameRole:
+            return os.path.basename(imagePath)
+        if role == self.DirtyRole:
+            return imagePath in self.dirtyPaths
+        return None
 
-class AspectRatioLabel(QLabel):
-    def __init__(self, pixmap):
-        super().__init__()
-        self._pixmap = QPixmap(pixmap)
+    def row(self, imagePath):
+        row = bisect.bisect_left(self.imagePaths, imagePath)
+        if row < len(self.imagePaths) and self.imagePaths[row] == imagePath:
+            return row
+        return -1
+
+    def summary(self, imagePath):
+        return self.summaries.get(imagePath)
+
+    def clear(self):
+        self.beginResetModel()
+        self.generation += 1 # thumbnails still being loaded are for the old rows
+        self.imagePaths = []
+        self.summaries = {}
+        self.dirtyPaths = set()
+        self.pixmaps = OrderedDict()
+        self.pendingThumbnails = set()
+        self.endResetModel()
+
+    # Adds a batch of (imagePath, summary) pairs. Large batches are merged in with a single reset
+    # rather than a row insertion per card.
+    def addCards(self, cards):
+        if len(cards) == 1:
+            self.insertCard(*cards[0])
+            return
+        if not cards:
+            return
+        self.beginResetModel()
+        for imagePath, summary in cards:
+            self.summaries[imagePath] = summary
+        self.imagePaths = sorted(self.summaries)
+        self.endResetModel()
+
+    def insertCard(self, imagePath, summary):
+        if imagePath in self.summaries:
+            self.updateCard(imagePath, summary)
+            return
+        row = bisect.bisect(self.imagePaths, imagePath)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.imagePaths.insert(row, imagePath)
+        self.summaries[imagePath] = summary
+        self.endInsertRows()
+
+    # reloadThumbnail is False when only the card's text has changed
+    def updateCard(self, imagePath, summary, reloadThumbnail=True):
+        row = self.row(imagePath)
+        if row < 0:
+            return
+        self.summaries[imagePath] = summary
+        if reloadThumbnail:
+            self.pixmaps.pop(imagePath, None)
+        index = self.index(row)
+        self.dataChanged.emit(index, index)
+
+    def removeCard(self, imagePath):
+        row = self.row(imagePath)
+        if row < 0:
+            return
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.imagePaths[row]
+        del self.summaries[imagePath]
+        self.dirtyPaths.discard(imagePath)
+        self.pixmaps.pop(imagePath, None)
+        self.endRemoveRows()
+
+    def setDirty(self, imagePath, dirty):
+        if dirty == (imagePath in self.dirtyPaths):
+            return
+        if dirty:
+            self.dirtyPaths.add(imagePath)
+        else:
+            self.dirtyPaths.discard(imagePath)
+        row = self.row(imagePath)
+        if row >= 0:
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [self.DirtyRole])
+
+    # Returns the row's thumbnail if it's loaded, otherwise starts loading it and returns None
+    def thumbnail(self, imagePath):
+        pixmap = self.pixmaps.get(imagePath)
+        if pixmap is not None:
+            self.pixmaps.move_to_end(imagePath)
+            return pixmap
+        if imagePath not in self.pendingThumbnails:
+            self.pendingThumbnails.add(imagePath)
+            self.executor.submit(self.loadThumbnail, self.generation, imagePath, self.devicePixelRatio)
+        return None
 
-    def paintEvent(self, event):
-        size = self.size()
-        painter = QPainter(self)
-        painter.setBrush(QColor(Qt.white))
-        painter.drawRect(0, 0, size.width(), size.height())
-        scaledPix = self._pixmap.scaled(size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-        # Calculate the starting point (top left of the image)
-        startPointX = int((size.width() - scaledPix.width()) / 2)
-        startPointY = int((size.height() - scaledPix.height()) / 2)
-        painter.drawPixmap(startPointX, startPointY, scaledPix)
-
-class ImageThumbnail(QWidget):
-    def __init__(self, imagePath, data):
-        super().__init__()
-        layout = QHBoxLayout()
-        self.setLayout(layout)
-        imageLabel = AspectRatioLabel(imagePath)
-        imageLabel.setFixedSize(QSize(64, 64))
-        layout.addWidget(imageLabel)
-
-        text = QWidget(self)
-        text_layout = QVBoxLayout(text)
-        layout.addWidget(text)
-        
-        nameLabel = QLabel(data["data"].get("name", ""), text)
-        text_layout.addWidget(nameLabel)
-        textLabel = QLabel(os.path.basename(imagePath), text)
-        text_layout.addWidget(textLabel)
+    # Runs on a worker thread
+    @timed("CardListModel.loadThumbnail")
+    def loadThumbnail(self, generation, imagePath, ratio):
+        if generation != self.generation:
+            return
+        try:
+            image = self.thumbnailCache.thumbnail(imagePath)
+            if image is not None:
+                size = int(THUMBNAIL_SIZE * ratio)
+                image = image.scaled(size, size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+                image.setDevicePixelRatio(ratio)
+        except Exception:
+            print("unable to load thumbnail", imagePath, traceback.format_exc())
+            image = None
+        self.thumbnailLoaded.emit(generation, imagePath, image)
+
+    def storeThumbnail(self, generation, imagePath, image):
+        if generation != self.generation:
+            return
+        self.pendingThumbnails.discard(imagePath)
+        row = self.row(imagePath)
+        if row < 0:
+            return
+        # a null pixmap is kept for unreadable images so they aren't retried on every paint
+        self.pixmaps[imagePath] = QPixmap.fromImage(image) if image is not None else QPixmap()
+        while len(self.pixmaps) > THUMBNAIL_MEMORY_COUNT:
+            self.pixmaps.popitem(last=False)
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+# Paints a card row: the thumbnail fitted into a white box, then the character's name and the
+# card's filename
+class CardItemDelegate(QStyledItemDelegate):
+    def sizeHint(self, option, index):
+        return QSize(THUMBNAIL_SIZE * 4, THUMBNAIL_SIZE + 2 * CARD_ROW_MARGIN)
+
+    @timed("CardItemDelegate.paint")
+    def paint(self, painter, option, index):
+        painter.save()
+        rect = option.rect
+        if option.state & QStyle.State_Selected:
+            painter.fillRect(rect, option.palette.highlight())
+            painter.setPen(option.palette.highlightedText().color())
+        elif index.data(CardListModel.DirtyRole):
+            painter.fillRect(rect, QColor(DIRTY_CHARACTER_COLOUR))
+            painter.setPen(option.palette.text().color())
+        else:
+            painter.setPen(option.palette.text().color())
+        textPen = painter.pen()
 
-class ImageList(QListWidget):
+        iconRect = QRect(rect.left() + CARD_ROW_MARGIN, rect.top() + CARD_ROW_MARGIN, THUMBNAIL_SIZE, THUMBNAIL_SIZE)
+        painter.setPen(QColor(Qt.black))
+        painter.setBrush(QColor(Qt.white))
+        painter.drawRect(iconRect)
+        pixmap = index.data(Qt.DecorationRole)
+        if pixmap is not None and not pixmap.isNull():
+            pixmapSize = pixmap.size() / pixmap.devicePixelRatioF()
+            painter.drawPixmap(iconRect.left() + int((THUMBNAIL_SIZE - pixmapSize.width()) / 2),
+                               iconRect.top() + int((THUMBNAIL_SIZE - pixmapSize.height()) / 2), pixmap)
+
+        painter.setPen(textPen)
+        textLeft = iconRect.right() + 2 * CARD_ROW_MARGIN
+        textWidth = max(rect.right() - textLeft - CARD_ROW_MARGIN, 0)
+        halfHeight = int(rect.height() / 2)
+        metrics = option.fontMetrics
+        nameRect = QRect(textLeft, rect.top(), textWidth, halfHeight)
+        painter.drawText(nameRect, Qt.AlignLeft | Qt.AlignBottom, metrics.elidedText(index.data(Qt.DisplayRole), Qt.ElideRight, textWidth))
+        filenameRect = QRect(textLeft, rect.top() + halfHeight, textWidth, rect.height() - halfHeight)
+        painter.drawText(filenameRect, Qt.AlignLeft | Qt.AlignTop, metrics.elidedText(index.data(CardListModel.FilenameRole), Qt.ElideRight, textWidth))
+        painter.restore()
+
+# The thumbnail browser. Rows are painted by CardItemDelegate so only the visible ones cost anything,
+# however many cards the directory has.
+class ImageList(QListView):
     directoryChanged = pyqtSignal()
-    
-    def __init__(self, parent=None):
+    # Emitted from the scan's worker threads, delivered on the GUI thread
+    cardsRead = pyqtSignal(int, object)
+    scanStarted = pyqtSignal(int, int)
+    directorySynced = pyqtSignal(int, object, object)
+    cardReindexed = pyqtSignal(int, str, object)
+    restorableFound = pyqtSignal(int, object)
+
+    # editorPoolSize comes from the command line, otherwise it's the editorPoolSize setting
+    def __init__(self, parent=None, editorPoolSize=None):
         super().__init__(parent)
-        self.itemClicked.connect(self.showImage)
+        if editorPoolSize is None:
+            editorPoolSize = QSettings(SETTINGS_ORGANIZATION, SETTINGS_APPLICATION).value(EDITOR_POOL_SIZE_SETTING, EDITOR_POOL_SIZE, type=int)
+        self.editorPoolSize = max(editorPoolSize, 1)
+        self.setUniformItemSizes(True)
+        self.setSelectionMode(QAbstractItemView.ExtendedSelection) # for bulk operations
+        self.setItemDelegate(CardItemDelegate(self))
+        self.clicked.connect(self.showIndex)
+        self.cardsRead.connect(self.addCards)
+        self.scanStarted.connect(self.startScan)
+        self.directorySynced.connect(self.applySync)
+        self.cardReindexed.connect(self.applyReindex)
+        self.restorableFound.connect(self.offerRestore)
+        self.progressBar = QProgressBar()
+        self.progressBar.setFormat("Scanning %v/%m")
+        self.progressBar.hide()
+        self.scanExecutor = ThreadPoolExecutor(max_workers=SCAN_WORKER_COUNT)
+        self.coordinatorExecutor = ThreadPoolExecutor(max_workers=COORDINATOR_WORKER_COUNT)
+        # Editors count tokens on their own thread so counts don't queue up behind a directory scan
+        self.tokenExecutor = ThreadPoolExecutor(max_workers=1)
+        self.scanGeneration = 0
+        self.scanFutures = []
+        self.cardIndex = None
+        # CardIndex: how many of the tasks that were given it haven't finished, so an index that's been
+        # replaced is only closed once nothing is using it any more. Worker threads change it too.
+        self.indexTasks = {}
+        self.retiredIndexes = set() # replaced indexes waiting for their tasks
+        self.indexTasksLock = threading.Lock()
+        self.syncing = False
+        self.cardModel = CardListModel(self.scanExecutor, self.window().thumbnailCache, self)
+        self.setModel(self.cardModel)
+        # Watches the current directory for cards being added, removed or changed by other programs
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self.scheduleSync)
+        self.watching = True
+        self.syncTimer = QTimer(self)
+        self.syncTimer.setSingleShot(True)
+        self.syncTimer.setInterval(WATCH_DEBOUNCE_MS)
+        self.syncTimer.timeout.connect(self.syncDirectory)
+        # Edits are journaled on their own thread, so an fsync never holds up the GUI
+        self.journal = AutosaveJournal()
+        self.journalExecutor = ThreadPoolExecutor(max_workers=1)
+        self.journalTimer = QTimer(self)
+        self.journalTimer.setInterval(AUTOSAVE_INTERVAL_MS)
+        self.journalTimer.timeout.connect(self.flushJournal)
+        self.journalTimer.start()
         self.loadImages()
 
+    # Card summaries come from the directory's CardIndex, and only cards that changed since the last
+    # scan are parsed, on a thread pool. Rows are added as cards arrive. Starting a new scan cancels
+    # any scan still in progress.
+    @timed("ImageList.loadImages")
     def loadImages(self):
-        self.clear()
+        self.cancelScan()
+        # the editors are about to be dropped, edits made just now still need to reach the journal, where
+        # they're kept to be offered for restoring
+        for editor in getattr(self, "editors", {}).values():
+            editor.checkDirty()
+            self.journal.release(editor.filePath)
+        self.scanStartTime = time.perf_counter()
+        self.cardModel.clear()
+        self.cardModel.devicePixelRatio = self.devicePixelRatioF()
         self.stack = QStackedWidget()
-        filepath = self.window().global_filepath
-        for file in os.listdir(filepath):
-            if file.endswith(".png"):
-                item = QListWidgetItem(self)
-                self.addItem(item)
-                imagePath = os.path.join(filepath, file)
-                data = read_character(imagePath)
-                imageLabel = ImageThumbnail(imagePath, data)
-                item.setSizeHint(imageLabel.sizeHint())
-                self.setItemWidget(item, imageLabel)
-                self.stack.addWidget(EditorWidget(data, imagePath, imageLabel, self))
-
-    def showImage(self, item):
-        index = self.row(item)
-        self.stack.setCurrentIndex(index)
-        self.stack.currentWidget().show()
+        # EditorWidgets are only built when a card is selected. This maps filepaths to live editors,
+        # least recently shown first.
+        self.editors = OrderedDict()
+        if self.cardIndex is not None:
+            self.retireIndex(self.cardIndex)
+        self.cardIndex = CardIndex(self.window().global_filepath)
+        self.watchDirectory()
+        self.scanTotal = 0
+        self.scanDone = 0
+        self.progressBar.setRange(0, 0) # busy indicator until the directory has been listed
+        self.progressBar.show()
+        generation = self.scanGeneration
+        self.scanFutures = [self.submitIndexTask(self.scanExecutor, self.cardIndex, self.scanDirectory, generation, self.cardIndex)]
+        self.journalExecutor.submit(self.findRestorable, generation, self.cardIndex.directory)
+
+    def flushJournal(self):
+        if self.journal.needsFlush():
+            self.journalExecutor.submit(self.journal.flush)
+
+    # Runs on the journal's thread, which flushes the journal before reading it back
+    def findRestorable(self, generation, directory):
+        if generation != self.scanGeneration:
+            return
+        try:
+            restorable = self.journal.restorableIn(directory)
+        except Exception:
+            print("unable to read the autosave journal", traceback.format_exc())
+            return
+        self.restorableFound.emit(generation, restorable)
+
+    # Offers to restore edits to cards in this directory that were left unsaved when the editor last closed,
+    # or when it last moved to another directory. Cards opened since have had theirs applied by getEditor.
+    def offerRestore(self, generation, restorable):
+        if generation != self.scanGeneration:
+            return
+        restorable = {card: records for card, records in restorable.items()
+                      if os.path.join(self.cardIndex.directory, os.path.basename(card)) not in self.editors}
+        if not restorable:
+            return
+        names = sorted(os.path.basename(card) for card in restorable)
+        listed = "\n".join(names[:RESTORE_PROMPT_NAME_LIMIT])
+        if len(names) > RESTORE_PROMPT_NAME_LIMIT:
+            listed += "\n... and %d more" % (len(names) - RESTORE_PROMPT_NAME_LIMIT)
+        box = QMessageBox(QMessageBox.Question, "Restore Unsaved Edits",
+                          "These cards have edits that were never saved:\n\n%s\n\nRestored edits show up as unsaved changes to check and save." % listed,
+                          parent=self)
+        restoreButton = box.addButton("Restore", QMessageBox.AcceptRole)
+        discardButton = box.addButton("Discard", QMessageBox.DestructiveRole)
+        box.addButton("Later", QMessageBox.RejectRole)
+        box.exec_()
+        if box.clickedButton() is discardButton:
+            for card in restorable:
+                self.journal.clear(card)
+        if box.clickedButton() is not restoreButton:
+            return
+        changed = []
+        for card, records in restorable.items():
+            self.journal.clear(card)
+            # the edits were made against the card as it was then, on top of anything else they could garble it
+            if changed_on_disk(card, records):
+                changed.append(os.path.basename(card))
+                continue
+            self.getEditor(os.path.join(self.cardIndex.directory, os.path.basename(card))).restoreEdits(records[1:])
+        if changed:
+            QMessageBox.warning(self, "Restore Unsaved Edits", "These cards were changed by something else since, so their edits weren't restored:\n\n%s"
+                                % "\n".join(sorted(changed)[:RESTORE_PROMPT_NAME_LIMIT]))
+
+    # Submits a task that uses cardIndex. Safe to call from any thread.
+    def submitIndexTask(self, executor, cardIndex, function, *args):
+        with self.indexTasksLock:
+            self.indexTasks[cardIndex] = self.indexTasks.get(cardIndex, 0) + 1
+        try:
+            future = executor.submit(function, *args)
+        except RuntimeError:
+            self.finishIndexTask(cardIndex) # the executor has been shut down
+            raise
+        future.add_done_callback(lambda _future: self.finishIndexTask(cardIndex))
+        return future
+
+    # Called on whichever thread ran the task
+    def finishIndexTask(self, cardIndex):
+        with self.indexTasksLock:
+            self.indexTasks[cardIndex] -= 1
+            close = self.indexTasks[cardIndex] == 0 and cardIndex in self.retiredIndexes
+            if close:
+                del self.indexTasks[cardIndex]
+                self.retiredIndexes.discard(cardIndex)
+        if close:
+            cardIndex.close()
+
+    # Closes an index that's been replaced, straight away if no task is using it, otherwise once the last
+    # task that was given it finishes. Only those tasks submit more of them, so none can come after.
+    def retireIndex(self, cardIndex):
+        with self.indexTasksLock:
+            close = not self.indexTasks.get(cardIndex)
+            if close:
+                self.indexTasks.pop(cardIndex, None)
+            else:
+                self.retiredIndexes.add(cardIndex)
+        if close:
+            cardIndex.close()
+
+    # Runs on a worker thread. Cards the index already knows about go to the GUI thread in one batch.
+    def scanDirectory(self, generation, cardIndex):
+        if generation != self.scanGeneration:
+            return
+        try:
+            unchanged, changed = cardIndex.diff()
+        except Exception:
+            print("unable to scan", cardIndex.directory, traceback.format_exc())
+            unchanged, changed = {}, []
+        self.scanStarted.emit(generation, len(unchanged) + len(changed))
+        self.cardsRead.emit(generation, [(os.path.join(cardIndex.directory, filename), summary) for filename, summary in unchanged.items()])
+        for filename in sorted(changed):
+            self.submitIndexTask(self.scanExecutor, cardIndex, self.scanCard, generation, cardIndex, filename)
+
+    # Runs on a worker thread
+    def scanCard(self, generation, cardIndex, filename):
+        if generation != self.scanGeneration:
+            return
+        imagePath = os.path.join(cardIndex.directory, filename)
+        try:
+            summary, _data = cardIndex.update(filename)
+        except Exception:
+            print("unable to read", imagePath, traceback.format_exc())
+            summary = None
+        self.cardsRead.emit(generation, [(imagePath, summary)])
+
+    def cancelScan(self):
+        self.scanGeneration += 1
+        self.syncing = False
+        self.syncTimer.stop()
+        for future in self.scanFutures:
+            future.cancel()
+        self.scanFutures = []
+        self.progressBar.hide()
+
+    def startScan(self, generation, total):
+        if generation != self.scanGeneration:
+            return
+        self.scanTotal = total
+        self.progressBar.setRange(0, max(total, 1))
+        self.progressBar.setValue(self.scanDone)
+        self.checkScanFinished()
+
+    def checkScanFinished(self):
+        if self.scanDone >= self.scanTotal:
+            if self.scanFutures and profiling.enabled():
+                # loadImages returns straight away, this covers the whole scan up to the last card
+                profiling.record("ImageList.scan", self.scanStartTime, time.perf_counter() - self.scanStartTime)
+            self.progressBar.hide()
+            self.scanFutures = []
+            self.cardIndex.commit()
+
+    # cards is a list of (imagePath, summary), summary is None for cards that couldn't be read
+    def addCards(self, generation, cards):
+        if generation != self.scanGeneration:
+            return # left over from a cancelled scan
+        self.scanDone += len(cards)
+        self.progressBar.setValue(self.scanDone)
+        self.checkScanFinished()
+        self.cardModel.addCards([(imagePath, summary) for imagePath, summary in cards if summary is not None])
+
+    def removeCard(self, imagePath):
+        self.cardModel.removeCard(imagePath)
+        self.dropEditor(imagePath)
+
+    def setWatching(self, watching):
+        self.watching = watching
+        self.watchDirectory()
+
+    def watchDirectory(self):
+        if self.watcher.directories():
+            self.watcher.removePaths(self.watcher.directories())
+        if self.watching:
+            self.watcher.addPath(self.cardIndex.directory)
+
+    # Restarts the debounce timer on every change event, the sync only runs once things settle down
+    def scheduleSync(self):
+        self.syncTimer.start()
+
+    # Brings the list up to date with the directory without rebuilding it. Only rows and editors for
+    # cards that were added, removed or changed are touched.
+    def syncDirectory(self):
+        if self.scanDone < self.scanTotal or self.scanFutures or self.syncing:
+            self.syncTimer.start() # try again once the current scan or sync is done
+            return
+        self.syncing = True
+        self.progressBar.setRange(0, 0)
+        self.progressBar.show()
+        self.submitIndexTask(self.coordinatorExecutor, self.cardIndex, self.diffDirectory, self.scanGeneration, self.cardIndex)
+
+    # Runs on a coordinator thread. Changed cards are re-read in parallel on the scan's threads and
+    # everything is handed back to the GUI thread as one batch.
+    def diffDirectory(self, generation, cardIndex):
+        try:
+            unchanged, changed = cardIndex.diff()
+        except Exception:
+            print("unable to scan", cardIndex.directory, traceback.format_exc())
+            unchanged, changed = None, []
+        def readCard(filename):
+            if generation != self.scanGeneration:
+                return None
+            imagePath = os.path.join(cardIndex.directory, filename)
+            try:
+                summary, _data = cardIndex.update(filename)
+            except Exception:
+                print("unable to read", imagePath, traceback.format_exc())
+                return None
+            return imagePath, summary
+        updates = [update for update in self.scanExecutor.map(readCard, changed) if update is not None] if changed else []
+        present = None
+        if unchanged is not None:
+            present = set(os.path.join(cardIndex.directory, filename) for filename in list(unchanged) + changed)
+        self.directorySynced.emit(generation, updates, present)
+
+    def applySync(self, generation, updates, present):
+        if generation != self.scanGeneration:
+            return
+        self.syncing = False
+        self.progressBar.hide()
+        self.cardIndex.commit()
+        if present is not None:
+            for imagePath in [imagePath for imagePath in self.cardModel.imagePaths if imagePath not in present]:
+                editor = self.editors.get(imagePath)
+                if editor is not None and editor.dirty:
+                    continue # keep unsaved work around, saving will recreate the file
+                self.removeCard(imagePath)
+        # new cards go into the model in one batch
+        added = [(imagePath, summary) for imagePath, summary in updates if self.cardModel.summary(imagePath) is None]
+        self.cardModel.addCards(added)
+        added = set(imagePath for imagePath, _summary in added)
+        for imagePath, summary in updates:
+            if imagePath in added:
+                continue
+            self.cardModel.updateCard(imagePath, summary)
+            editor = self.editors.get(imagePath)
+            if editor is not None and editor.dirty:
+                continue # don't throw away unsaved edits, saving will overwrite the external change
+            if editor is not None:
+                showing = editor is self.stack.currentWidget()
+                self.dropEditor(imagePath)
+                if showing:
+                    self.showImage(imagePath)
+
+    # Called after an editor has written its card. Re-reading it for the index and its search text
+    # happens on a worker thread.
+    def cardSaved(self, imagePath):
+        if os.path.dirname(imagePath) != self.cardIndex.directory:
+            return
+        self.submitIndexTask(self.scanExecutor, self.cardIndex, self.reindexCard, self.scanGeneration, self.cardIndex, imagePath)
+
+    # Runs on a worker thread
+    def reindexCard(self, generation, cardIndex, imagePath):
+        try:
+            summary, _data = cardIndex.update(os.path.basename(imagePath))
+            cardIndex.commit()
+        except Exception:
+            print("unable to read", imagePath, traceback.format_exc())
+            return
+        self.cardReindexed.emit(generation, imagePath, summary)
+
+    def applyReindex(self, generation, imagePath, summary):
+        if generation != self.scanGeneration:
+            return
+        self.cardModel.updateCard(imagePath, summary, reloadThumbnail=False)
+
+    # Returns the editor for a card, building it if it isn't in the pool
+    def getEditor(self, imagePath):
+        editor = self.editors.get(imagePath)
+        if editor is None:
+            # Only the card's summary is kept while it's closed, the full data is decoded here and
+            # released again when the editor is dropped
+            summary = self.cardModel.summary(imagePath)
+            fullData = read_character(imagePath, summary.charaLocation() if summary is not None else None)
+            editor = EditorWidget(fullData, imagePath, self.cardModel, self.tokenExecutor, self.journal, self)
+            self.stack.addWidget(editor)
+            self.editors[imagePath] = editor
+            self.applyUnsavedEdits(editor)
+        self.editors.move_to_end(imagePath)
+        return editor
+
+    # Edits the journal still has for a card that were left for later, or made in an editor that has
+    # since been dropped, are applied as soon as the card is opened again. Anything recorded from here
+    # on starts the card over in the journal, so they'd be lost otherwise.
+    def applyUnsavedEdits(self, editor):
+        records = self.journal.unsavedRecords(editor.filePath)
+        if records is None:
+            return
+        if changed_on_disk(editor.filePath, records):
+            box = QMessageBox(QMessageBox.Warning, "Restore Unsaved Edits",
+                              "%s has edits that were never saved, but the card was changed by something else since. "
+                              "Restoring them on top of those changes could garble it, though they can be undone."
+                              % os.path.basename(editor.filePath), parent=self)
+            restoreButton = box.addButton("Restore Anyway", QMessageBox.AcceptRole)
+            box.addButton("Discard", QMessageBox.DestructiveRole)
+            box.exec_()
+            if box.clickedButton() is not restoreButton:
+                self.journal.clear(editor.filePath)
+                return
+        editor.restoreEdits(records[1:])
+
+    # Drops the least recently shown editors once the pool is over editorPoolSize. Editors with
+    # unsaved changes and the editor currently on display are kept.
+    def evictEditors(self):
+        excess = len(self.editors) - self.editorPoolSize
+        for imagePath, editor in list(self.editors.items()):
+            if excess <= 0:
+                break
+            if editor.dirty or editor is self.stack.currentWidget():
+                continue
+            # the editor is clean, so its data is what's on disk and can simply be read again later
+            self.dropEditor(imagePath)
+            excess -= 1
+
+    def dropEditor(self, imagePath):
+        editor = self.editors.pop(imagePath, None)
+        if editor is not None:
+            self.journal.release(imagePath)
+            self.stack.removeWidget(editor)
+            editor.deleteLater()
+
+    # Saves every open card that really differs from what's on disk, returns how many were saved
+    def saveAllModified(self):
+        saved = 0
+        for editor in list(self.editors.values()):
+            editor.checkDirty()
+            if editor.dirty:
+                editor.saveClicked()
+                saved += 1
+        return saved
+
+    def selectedImagePaths(self):
+        return sorted(index.data(CardListModel.FilePathRole) for index in self.selectionModel().selectedIndexes())
+
+    # Cards that have any of the given tags, compared case-insensitively
+    def imagePathsWithTags(self, tags):
+        tags = set(tag.strip().lower() for tag in tags if tag.strip())
+        return [imagePath for imagePath in self.cardModel.imagePaths
+                if tags & set(tag.lower() for tag in self.cardModel.summary(imagePath).tags)]
+
+    def showIndex(self, index):
+        self.showImage(index.data(CardListModel.FilePathRole))
+
+    # Opens the card a search hit came from and shows the field or entry that matched
+    def openSearchHit(self, hit):
+        imagePath = os.path.join(self.cardIndex.directory, hit["filename"])
+        row = self.cardModel.row(imagePath)
+        if row < 0:
+            return
+        self.setCurrentIndex(self.cardModel.index(row))
+        self.showImage(imagePath)
+        self.editors[imagePath].showField(hit["field"], hit["entry"])
+
+    def showImage(self, imagePath):
+        editor = self.getEditor(imagePath)
+        self.stack.setCurrentWidget(editor)
+        editor.show()
+        self.evictEditors()
 
     def changeDirectory(self):
         newDirpath = QFileDialog.getExistingDirectory(self, "Select Directory")
@@ -894,32 +2028,607 @@ class ImageList(QListWidget):
         self.loadImages()
         self.directoryChanged.emit()
 
+    # Refresh only rebuilds everything if a scan was interrupted, otherwise it's an incremental sync
+    def refreshDirectory(self):
+        if self.scanDone < self.scanTotal or self.scanFutures:
+            self.updateDirectory()
+        else:
+            self.syncTimer.stop()
+            self.syncDirectory()
+
+# Shows progress while a big JSON file is read on another thread, and lets the user cancel. batches is
+# a generator of lists of items, it's run on the reading thread. Connect to batchRead to receive them on
+# the GUI thread, exec_() returns once they've all been delivered or the import has been cancelled.
+class StreamingImportDialog(QDialog):
+    # Emitted from the reading thread with a batch and how far through the file it is, from 0 to 1
+    batchRead = pyqtSignal(object, float)
+    readFinished = pyqtSignal(object)
+
+    def __init__(self, title, batches, progress, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle(title)
+        self.batches = batches
+        self.progress = progress
+        self.cancelled = threading.Event()
+        self.error = None
+        self.readComplete = False
+        self.layout = QVBoxLayout(self)
+        self.label = QLabel("Reading...", self)
+        self.layout.addWidget(self.label)
+        self.progressBar = QProgressBar(self)
+        self.progressBar.setRange(0, 1000)
+        self.layout.addWidget(self.progressBar)
+        self.cancelButton = QPushButton("Cancel", self)
+        self.cancelButton.setToolTip("Stops reading, nothing that was read so far is kept")
+        self.cancelButton.clicked.connect(self.cancel)
+        self.layout.addWidget(self.cancelButton)
+        self.count = 0
+        self.batchRead.connect(self.showProgress)
+        self.readFinished.connect(self.readDone)
+        self.resize(400, 100)
+        self.readThread = threading.Thread(target=self.read, daemon=True)
+
+    def exec_(self):
+        self.readThread.start()
+        return super().exec_()
+
+    # Runs on the reading thread
+    def read(self):
+        error = None
+        try:
+            for batch in self.batches:
+                if self.cancelled.is_set():
+                    break
+                self.batchRead.emit(batch, self.progress())
+        except Exception as e:
+            print("unable to import", traceback.format_exc())
+            error = "%s: %s" % (type(e).__name__, e)
+        self.readFinished.emit(error)
+
+    def showProgress(self, batch, progress):
+        self.count += len(batch)
+        self.progressBar.setValue(int(progress * 1000))
+        self.label.setText("Read %d entries" % self.count)
+
+    def readDone(self, error):
+        self.readComplete = True
+        self.error = error
+        if error is not None and not self.cancelled.is_set():
+            # left open so the problem can be read
+            self.label.setText(error)
+            self.cancelButton.setText("Close")
+            return
+        self.accept()
+
+    def cancel(self):
+        if self.readComplete:
+            self.reject()
+            return
+        self.cancelled.set()
+        self.label.setText("Cancelling...")
+        self.cancelButton.setEnabled(False)
+
+    # Closing the window cancels too, the dialog stays up until the reading thread has stopped
+    def reject(self):
+        if not self.readComplete:
+            self.cancel()
+            return
+        super().reject()
+
+    def succeeded(self):
+        return self.readComplete and self.error is None and not self.cancelled.is_set()
+
+# Runs a sample chat against the character book being edited and lists the entries it would activate.
+# The book is compiled once and only recompiled when its entries have changed since the last run.
+class LorebookTestDialog(QDialog):
+    def __init__(self, characterBookWidget, parent=None):
+        super().__init__(parent or characterBookWidget)
+        self.characterBookWidget = characterBookWidget
+        self.simulator = None
+        self.simulatedEntries = None
+        self.setWindowTitle("Test Character Book Activation")
+        self.layout = QVBoxLayout(self)
+        self.layout.addWidget(QLabel("Sample chat, oldest message first. Separate messages with a blank line.", self))
+        self.chatEdit = QPlainTextEdit(self)
+        self.layout.addWidget(self.chatEdit)
+        self.runButton = QPushButton("Test", self)
+        self.runButton.clicked.connect(self.run)
+        self.layout.addWidget(self.runButton)
+        self.summaryLabel = QLabel(self)
+        self.layout.addWidget(self.summaryLabel)
+        self.results = QListWidget(self)
+        self.results.setToolTip("Activated entries in insertion order, click one to edit it")
+        self.results.itemClicked.connect(lambda item: self.characterBookWidget.show_entry(item.data(Qt.UserRole)))
+        self.layout.addWidget(self.results)
+        self.resize(600, 500)
+
+    def run(self):
+        self.characterBookWidget.editorParent.updateDataFromUI()
+        characterBook = self.characterBookWidget.fullData["data"].get("character_book", {})
+        entries = self.characterBookWidget.entries_model.entries
+        if self.simulator is None or self.simulatedEntries != tuple(map(id, entries)):
+            self.simulator = LorebookSimulator(dict(characterBook, entries=list(entries)), default_counter().count)
+            self.simulatedEntries = tuple(map(id, entries))
+        messages = [message for message in re.split(r"\n\s*\n", self.chatEdit.toPlainText()) if message.strip()]
+        included, cut = self.simulator.activate(messages, characterBook.get("scan_depth"), characterBook.get("token_budget"),
+                                                characterBook.get("recursive_scanning", False))
+        self.results.clear()
+        for result, overBudget in [(result, False) for result in included] + [(result, True) for result in cut]:
+            entry = result["entry"]
+            label = entry.get("name") or ", ".join(str(key) for key in entry.get("keys", []))
+            reason = "constant" if result["reason"] == "constant" else "%s \"%s\"" % (result["reason"], result["key"])
+            item = QListWidgetItem("%s [order %s] - %d tokens - %s%s" % (label, entry.get("insertion_order", ""), result["tokens"], reason,
+                                                                      " - cut, over the token budget" if overBudget else ""))
+            if overBudget:
+                item.setForeground(QColor(Qt.gray))
+            item.setData(Qt.UserRole, result["position"])
+            self.results.addItem(item)
+        budget = characterBook.get("token_budget")
+        self.summaryLabel.setText("%d entries activated, %d tokens%s%s" % (
+            len(included), sum(result["tokens"] for result in included),
+            " of a %d token budget" % budget if budget is not None else "",
+            ", %d cut" % len(cut) if cut else ""))
+
+# Merges one or more worldbooks into many cards at once. Each worldbook is processed once, then the cards
+# are merged and saved in parallel on the scan's thread pool. A dry run reports what would be added
+# without writing anything.
+class BulkWorldbookDialog(QDialog):
+    # Emitted from a worker thread, delivered on the GUI thread
+    mergeFinished = pyqtSignal(object, bool)
+
+    def __init__(self, imageList, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Bulk Import Worldbooks")
+        self.imageList = imageList
+        self.worldBookPaths = []
+        self.mergeFinished.connect(self.showResults)
+        self.layout = QVBoxLayout(self)
+
+        self.worldBookLabel = QLabel("No worldbooks chosen", self)
+        self.layout.addWidget(self.worldBookLabel)
+        self.chooseButton = QPushButton("Choose Worldbooks", self)
+        self.chooseButton.setToolTip("""SillyTavern or Agnai worldbooks, or exported TavernAI characters, whose entries
+will be appended to the character book of every chosen card.""")
+        self.chooseButton.clicked.connect(self.chooseWorldbooks)
+        self.layout.addWidget(self.chooseButton)
+
+        selected = len(self.imageList.selectedImagePaths())
+        self.selectedRadio = QRadioButton("Selected cards (%d)" % selected, self)
+        self.selectedRadio.setToolTip("Ctrl-click or shift-click in the thumbnail list to select several cards.")
+        self.layout.addWidget(self.selectedRadio)
+        self.tagRadio = QRadioButton("Cards with any of these tags:", self)
+        self.layout.addWidget(self.tagRadio)
+        self.tagEdit = QLineEdit(self)
+        self.tagEdit.setToolTip("comma, separated, list, of, tags. Not case sensitive.")
+        self.tagEdit.textChanged.connect(lambda: self.tagRadio.setChecked(True))
+        self.layout.addWidget(self.tagEdit)
+        if selected:
+            self.selectedRadio.setChecked(True)
+        else:
+            self.tagRadio.setChecked(True)
+
+        self.duplicatesBox = QComboBox(self)
+        self.duplicatesBox.setToolTip("""What to do with worldbook entries that have the same keys, secondary keys and content as an entry
+a card already has. With "Skip" merging the same worldbook again leaves the cards as they are.""")
+        for policy, label in DUPLICATE_POLICY_LABELS:
+            self.duplicatesBox.addItem(label, policy)
+        self.layout.addWidget(self.duplicatesBox)
+
+        self.report = QPlainTextEdit(self)
+        self.report.setReadOnly(True)
+        self.layout.addWidget(self.report)
+
+        self.buttonLayout = QHBoxLayout()
+        self.dryRunButton = QPushButton("Dry Run", self)
+        self.dryRunButton.setToolTip("Reports how many entries would be added to each card without changing anything.")
+        self.dryRunButton.clicked.connect(lambda: self.merge(True))
+        self.buttonLayout.addWidget(self.dryRunButton)
+        self.mergeButton = QPushButton("Merge and Save", self)
+        self.mergeButton.setToolTip("""Appends the worldbooks' entries to every chosen card and saves the cards.
+Cards with unsaved edits in the editor are skipped.""")
+        self.mergeButton.clicked.connect(lambda: self.merge(False))
+        self.buttonLayout.addWidget(self.mergeButton)
+        self.layout.addLayout(self.buttonLayout)
+        self.resize(600, 400)
+
+    def chooseWorldbooks(self):
+        options = QFileDialog.Options()
+        options |= QFileDialog.ReadOnly
+        fileNames, _ = QFileDialog.getOpenFileNames(self, "QFileDialog.getOpenFileNames()", self.imageList.cardIndex.directory, "JSON Files (*.json)", options=options)
+        if fileNames:
+            self.worldBookPaths = fileNames
+            self.worldBookLabel.setText("\n".join(os.path.basename(fileName) for fileName in fileNames))
+
+    def chosenCards(self):
+        if self.selectedRadio.isChecked():
+            return self.imageList.selectedImagePaths()
+        return self.imageList.imagePathsWithTags(self.tagEdit.text().split(","))
+
+    def merge(self, dryRun):
+        if not self.worldBookPaths:
+            self.report.setPlainText("Choose at least one worldbook first.")
+            return
+        worldBooks = []
+        for path in self.worldBookPaths:
+            try:
+                worldBook = load_worldbook(path)
+            except Exception:
+                worldBook = None
+            if worldBook is None:
+                self.report.setPlainText("%s isn't a worldbook." % os.path.basename(path))
+                return
+            worldBooks.append(worldBook)
+        imagePaths = self.chosenCards()
+        # Editors with unsaved changes would be out of step with the card on disk
+        skipped = [imagePath for imagePath in imagePaths if imagePath in self.imageList.editors and self.imageList.editors[imagePath].dirty]
+        imagePaths = [imagePath for imagePath in imagePaths if imagePath not in skipped]
+        self.dryRunButton.setEnabled(False)
+        self.mergeButton.setEnabled(False)
+        self.report.setPlainText("Merging into %d cards..." % len(imagePaths))
+        executor = self.imageList.scanExecutor
+        self.imageList.coordinatorExecutor.submit(self.mergeAll, executor, imagePaths, skipped, worldBooks, dryRun, self.duplicatesBox.currentData())
+
+    # Runs on a coordinator thread, the cards are merged on executor's threads
+    def mergeAll(self, executor, imagePaths, skipped, worldBooks, dryRun, duplicates):
+        def mergeOne(imagePath):
+            try:
+                return imagePath, merge_worldbooks_into_card(imagePath, worldBooks, dryRun, duplicates), None
+            except Exception as e:
+                return imagePath, None, "%s: %s" % (type(e).__name__, e)
+        results = list(executor.map(mergeOne, imagePaths))
+        results += [(imagePath, None, "has unsaved edits, skipped") for imagePath in skipped]
+        self.mergeFinished.emit(results, dryRun)
+
+    def showResults(self, results, dryRun):
+        self.dryRunButton.setEnabled(True)
+        self.mergeButton.setEnabled(True)
+        lines = []
+        total = totalSkipped = totalUpdated = 0
+        for imagePath, counts, error in sorted(results):
+            summary = self.imageList.cardModel.summary(imagePath)
+            name = summary.name if summary else ""
+            if error:
+                lines.append("%s (%s): %s" % (name, os.path.basename(imagePath), error))
+            else:
+                before, added, skipped, updated = counts
+                total += added
+                totalSkipped += skipped
+                totalUpdated += updated
+                lines.append("%s (%s): +%d entries (%d before), %d skipped, %d updated" % (name, os.path.basename(imagePath), added, before, skipped, updated))
+        verb = "Would add" if dryRun else "Added"
+        lines.insert(0, "%s %d entries across %d cards, %d duplicates skipped, %d updated%s" % (verb, total, len(results), totalSkipped, totalUpdated,
+                                                                                           " (dry run)" if dryRun else ""))
+        self.report.setPlainText("\n".join(lines))
+        if not dryRun:
+            # picks up the rewritten cards, and reloads any clean editors that have them open
+            self.imageList.refreshDirectory()
+
+# Counts the tokens of every card in the current directory and lists them heaviest first. Cards are read
+# on the scan's thread pool, texts the editors have already counted come from the token counter's cache.
+class TokenReportDialog(QDialog):
+    COLUMNS = ("Name", "File", "Tokens", "In Fields", "In Entries", "Entries")
+    # Emitted from a worker thread, delivered on the GUI thread
+    reportFinished = pyqtSignal(object)
+
+    def __init__(self, imageList, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Token Report")
+        self.imageList = imageList
+        self.reportFinished.connect(self.showResults)
+        self.layout = QVBoxLayout(self)
+        self.summaryLabel = QLabel("Counting the tokens of %d cards..." % len(self.imageList.cardModel.imagePaths), self)
+        self.layout.addWidget(self.summaryLabel)
+        self.table = QTableWidget(0, len(self.COLUMNS), self)
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.setToolTip("Counts are of the cards as saved, click a card to open it")
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.table.cellClicked.connect(lambda row, column: self.imageList.showImage(self.table.item(row, 1).data(Qt.UserRole)))
+        self.layout.addWidget(self.table)
+        self.resize(700, 500)
+        executor = self.imageList.scanExecutor
+        cards = [(imagePath, self.imageList.cardModel.summary(imagePath)) for imagePath in self.imageList.cardModel.imagePaths]
+        self.imageList.coordinatorExecutor.submit(self.countAll, executor, cards)
+
+    # Runs on a coordinator thread, the cards are counted on executor's threads
+    def countAll(self, executor, cards):
+        counter = default_counter()
+        def countOne(card):
+            imagePath, summary = card
+            try:
+                data = read_character(imagePath, summary.charaLocation() if summary is not None else None)
+                counts = counter.count_card(data)
+                counts["name"] = data["data"].get("name", "")
+                return imagePath, counts
+            except Exception:
+                print("unable to count tokens", imagePath, traceback.format_exc())
+                return imagePath, None
+        results = list(executor.map(countOne, cards))
+        try:
+            self.reportFinished.emit(results)
+        except RuntimeError:
+            pass # the dialog was closed first
+
+    def showResults(self, results):
+        counted = sorted(((imagePath, counts) for imagePath, counts in results if counts is not None), key=lambda result: -result[1]["total"])
+        self.table.setRowCount(len(counted))
+        for row, (imagePath, counts) in enumerate(counted):
+            fieldTokens = counts["total"] - counts["entries"]
+            values = [counts["name"], os.path.basename(imagePath), counts["total"], fieldTokens, counts["entries"], counts["entry_count"]]
+            for column, value in enumerate(values):
+                item = QTableWidgetItem(str(value))
+                if column > 1:
+                    item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.table.setItem(row, column, item)
+            self.table.item(row, 1).setData(Qt.UserRole, imagePath)
+        failed = len(results) - len(counted)
+        self.summaryLabel.setText("%d tokens across %d cards%s" % (sum(counts["total"] for _imagePath, counts in counted), len(counted),
+                                                                ", %d couldn't be read" % failed if failed else ""))
+
+# Lists cards and character book entries that are copies or near copies of each other, see duplicates.py.
+# Only cards that changed since the last search are read, on the scan's thread pool.
+class DuplicatesDialog(QDialog):
+    # Emitted from a worker thread, delivered on the GUI thread
+    progressChanged = pyqtSignal(int, int)
+    reportFinished = pyqtSignal(object)
+
+    def __init__(self, imageList, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Find Duplicates")
+        self.imageList = imageList
+        self.progressChanged.connect(self.showProgress)
+        self.reportFinished.connect(self.showReport)
+        self.layout = QVBoxLayout(self)
+        self.summaryLabel = QLabel("Looking for duplicates...", self)
+        self.layout.addWidget(self.summaryLabel)
+        self.progressBar = QProgressBar(self)
+        self.progressBar.setFormat("Reading %v/%m")
+        self.progressBar.setRange(0, 0)
+        self.layout.addWidget(self.progressBar)
+        self.tree = QTreeWidget(self)
+        self.tree.setHeaderHidden(True)
+        self.tree.setToolTip("Click a card or entry to open it")
+        self.tree.itemClicked.connect(self.openItem)
+        self.layout.addWidget(self.tree)
+        self.resize(700, 500)
+        directory = self.imageList.cardIndex.directory
+        summaries = [self.imageList.cardModel.summary(imagePath) for imagePath in self.imageList.cardModel.imagePaths]
+        self.imageList.scanExecutor.submit(self.findAll, directory, summaries)
+
+    # Runs on a worker thread
+    def findAll(self, directory, summaries):
+        try:
+            report = find_duplicates(directory, summaries, progress=lambda done, total: self.progressChanged.emit(done, total))
+        except RuntimeError:
+            return # the dialog was closed first
+        except Exception:
+            print("unable to find duplicates", directory, traceback.format_exc())
+            report = None
+        try:
+            self.reportFinished.emit(report)
+        except RuntimeError:
+            pass
+
+    def showProgress(self, done, total):
+        self.progressBar.setRange(0, total)
+        self.progressBar.setValue(done)
+
+    def cardName(self, filename):
+        summary = self.imageList.cardModel.summary(os.path.join(self.imageList.cardIndex.directory, filename))
+        return "%s (%s)" % (summary.name, filename) if summary is not None and summary.name else filename
+
+    # Adds a group under section, with a child for each of places, which are (filename, entry position or -1)
+    def addGroup(self, section, text, places):
+        group = QTreeWidgetItem(section, [text])
+        for filename, entry in places[:DUPLICATE_GROUP_DISPLAY_LIMIT]:
+            label = self.cardName(filename) if entry < 0 else "%s, entry %d" % (self.cardName(filename), entry + 1)
+            item = QTreeWidgetItem(group, [label])
+            item.setData(0, Qt.UserRole, (filename, entry))
+        if len(places) > DUPLICATE_GROUP_DISPLAY_LIMIT:
+            QTreeWidgetItem(group, ["...and %d more" % (len(places) - DUPLICATE_GROUP_DISPLAY_LIMIT)])
+
+    def showReport(self, report):
+        self.progressBar.hide()
+        if report is None:
+            self.summaryLabel.setText("Unable to look for duplicates, see the console for details.")
+            return
+        text = "%d cards compared, %d read" % (report["cards"], report["rehashed"])
+        if report["errors"]:
+            # the cards that couldn't be read are listed in the tooltip
+            text += ", %d couldn't be read" % len(report["errors"])
+            self.summaryLabel.setToolTip("\n".join("%s: %s" % (error["file"], error["error"]) for error in report["errors"][:DUPLICATE_GROUP_DISPLAY_LIMIT]))
+        self.summaryLabel.setText(text)
+        section = QTreeWidgetItem(self.tree, ["Identical cards (%d groups)" % len(report["identical_cards"])])
+        for files in report["identical_cards"]:
+            self.addGroup(section, "%d identical cards" % len(files), [(filename, -1) for filename in files])
+        section = QTreeWidgetItem(self.tree, ["Similar cards (%d groups)" % len(report["similar_cards"])])
+        for group in report["similar_cards"]:
+            self.addGroup(section, "%d cards, at least %d%% alike" % (len(group["files"]), group["similarity"] * 100),
+                          [(filename, -1) for filename in group["files"]])
+        section = QTreeWidgetItem(self.tree, ["Cards sharing entries (%d groups)" % len(report["shared_entries"])])
+        for group in report["shared_entries"]:
+            self.addGroup(section, "%d entries shared by %d cards, like \"%s\"" % (group["entries"], len(group["files"]), group["preview"]),
+                          [(filename, -1) for filename in group["files"]])
+        section = QTreeWidgetItem(self.tree, ["Similar entries (%d groups)" % len(report["similar_entries"])])
+        for group in report["similar_entries"]:
+            self.addGroup(section, "%d entries, at least %d%% alike, like \"%s\"" % (len(group["entries"]), group["similarity"] * 100, group["preview"]),
+                          [(place["file"], place["entry"]) for place in group["entries"]])
+
+    def openItem(self, item):
+        place = item.data(0, Qt.UserRole)
+        if place is None:
+            return
+        filename, entry = place
+        self.imageList.openSearchHit({"filename": filename, "field": "entry" if entry >= 0 else "name", "entry": entry})
+
+SEARCH_FIELD_LABELS = {"name": "Name", "description": "Description", "personality": "Personality", "scenario": "Scenario",
+                       "first_mes": "First Message", "mes_example": "Message Example",
+                       "alternate_greetings": "Alternate Greetings", "entry": "Character Book"}
+
+# Full-text search over every card in the current directory, backed by the CardIndex
+class SearchPanel(QWidget):
+    def __init__(self, imageList, parent=None):
+        super().__init__(parent)
+        self.imageList = imageList
+        self.layout = QVBoxLayout(self)
+        self.layout.setContentsMargins(0, 0, 0, 0)
+        self.searchEdit = QLineEdit(self)
+        self.searchEdit.setPlaceholderText("Search")
+        self.searchEdit.setToolTip("""Searches the names, descriptions, personalities, scenarios, messages and character book entries
+of every card in the current directory. Click a result to open it.""")
+        self.searchEdit.setClearButtonEnabled(True)
+        self.searchEdit.textChanged.connect(self.scheduleSearch)
+        self.layout.addWidget(self.searchEdit)
+        self.results = QListWidget(self)
+        self.results.itemClicked.connect(self.openResult)
+        self.results.hide()
+        self.layout.addWidget(self.results)
+        self.searchTimer = QTimer(self)
+        self.searchTimer.setSingleShot(True)
+        self.searchTimer.setInterval(SEARCH_DEBOUNCE_MS)
+        self.searchTimer.timeout.connect(self.search)
+
+    def scheduleSearch(self):
+        self.searchTimer.start()
+
+    def search(self):
+        self.results.clear()
+        hits = self.imageList.cardIndex.search(self.searchEdit.text())
+        for hit in hits:
+            snippet = " ".join(hit["snippet"].split())
+            item = QListWidgetItem("%s - %s: %s" % (hit["name"] or hit["filename"], SEARCH_FIELD_LABELS.get(hit["field"], hit["field"]), snippet))
+            item.setToolTip(hit["filename"])
+            item.setData(Qt.UserRole, hit)
+            self.results.addItem(item)
+        self.results.setVisible(self.searchEdit.text().strip() != "")
+
+    def openResult(self, item):
+        self.imageList.openSearchHit(item.data(Qt.UserRole))
+
+    # The results belong to the old directory
+    def directoryChanged(self):
+        self.searchEdit.clear()
+        self.results.clear()
+        self.results.hide()
+
+# Shows what profiling has recorded so far, only offered when the editor was started with profiling on
+class TimingStatisticsDialog(QDialog):
+    COLUMNS = ("Name", "Count", "Total ms", "Mean ms", "p50 ms", "p90 ms", "p99 ms", "Max ms")
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Timing Statistics")
+        self.layout = QVBoxLayout(self)
+        self.table = QTableWidget(0, len(self.COLUMNS), self)
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.layout.addWidget(self.table)
+
+        self.buttonLayout = QHBoxLayout()
+        self.recordCheckbox = QCheckBox("Record", self)
+        self.recordCheckbox.setToolTip("Pauses or resumes recording timings")
+        self.recordCheckbox.setChecked(profiling.enabled())
+        self.recordCheckbox.stateChanged.connect(lambda state: profiling.enable(state == Qt.Checked))
+        self.buttonLayout.addWidget(self.recordCheckbox)
+        self.refreshButton = QPushButton("Refresh", self)
+        self.refreshButton.clicked.connect(self.refresh)
+        self.buttonLayout.addWidget(self.refreshButton)
+        self.resetButton = QPushButton("Reset", self)
+        self.resetButton.clicked.connect(self.reset)
+        self.buttonLayout.addWidget(self.resetButton)
+        self.saveButton = QPushButton("Save...", self)
+        self.saveButton.setToolTip("Saves the statistics as JSON, and every recorded call as a Chrome trace next to it")
+        self.saveButton.clicked.connect(self.save)
+        self.buttonLayout.addWidget(self.saveButton)
+        self.layout.addLayout(self.buttonLayout)
+        self.resize(800, 400)
+        self.refresh()
+
+    def refresh(self):
+        statistics = profiling.statistics()
+        self.table.setRowCount(len(statistics))
+        for row, (name, timing) in enumerate(statistics.items()):
+            values = [name, str(timing["count"])] + ["%.3f" % (timing[key] * 1000) for key in ("total", "mean", "p50", "p90", "p99", "max")]
+            for column, value in enumerate(values):
+                item = QTableWidgetItem(value)
+                if column > 0:
+                    item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.table.setItem(row, column, item)
+
+    def reset(self):
+        profiling.reset()
+        self.refresh()
+
+    def save(self):
+        options = QFileDialog.Options()
+        options |= QFileDialog.DontUseNativeDialog
+        fileName, _ = QFileDialog.getSaveFileName(self, "QFileDialog.getSaveFileName()", "profile.json", "JSON Files (*.json)", options=options)
+        if fileName:
+            profiling.write_statistics(fileName)
+            profiling.write_chrome_trace(profiling.trace_path(fileName))
+
 class MainWindow(QWidget):
-    def __init__(self):
+    def __init__(self, editorPoolSize=None):
         super().__init__()
         self.setWindowTitle("TavernAI Character Editor")
         self.global_filepath = "."
+        self.thumbnailCache = ThumbnailCache()
         self.layout = QVBoxLayout()
         self.setLayout(self.layout)
         self.splitter = QSplitter(Qt.Horizontal)
         self.layout.addWidget(self.splitter)
-        self.imageList = ImageList(self)
+        self.imageList = ImageList(self, editorPoolSize)
         self.imageList.directoryChanged.connect(self.updateStack)
+        self.searchPanel = SearchPanel(self.imageList, self)
+        self.imageList.directoryChanged.connect(self.searchPanel.directoryChanged)
         self.changeDirButton = QPushButton("Change Directory", self)
         self.changeDirButton.setToolTip("""Switches thumbnail list to another directory.
-WARNING: Save your work first! Unsaved edits are discarded.""")
+Unsaved edits are closed, they're offered for restoring when you come back to this directory.""")
         self.changeDirButton.clicked.connect(self.imageList.changeDirectory)
         self.refreshDirButton = QPushButton("Refresh", self)
-        self.refreshDirButton.setToolTip("""Reloads the thumbnail list for the current directory.
-WARNING: Save your work first! Unsaved edits are discarded.""")
-        self.refreshDirButton.clicked.connect(self.imageList.updateDirectory)
+        self.refreshDirButton.setToolTip("""Updates the thumbnail list with cards that were added, removed or changed in the current directory.
+Cards with unsaved edits are left alone. If a scan is still in progress it's restarted instead.""")
+        self.refreshDirButton.clicked.connect(self.imageList.refreshDirectory)
+        self.watchCheckbox = QCheckBox("Watch Directory", self)
+        self.watchCheckbox.setToolTip("""Automatically updates the thumbnail list when other programs add, remove or change cards
+in the current directory. Cards with unsaved edits are left alone.""")
+        self.watchCheckbox.setChecked(self.imageList.watching)
+        self.watchCheckbox.stateChanged.connect(lambda state: self.imageList.setWatching(state == Qt.Checked))
+        self.saveAllButton = QPushButton("Save All Modified", self)
+        self.saveAllButton.setToolTip("""Saves every card with unsaved edits. Cards whose edits have all been undone by hand are left alone.""")
+        self.saveAllButton.clicked.connect(self.imageList.saveAllModified)
+        self.bulkWorldbookButton = QPushButton("Bulk Import Worldbooks", self)
+        self.bulkWorldbookButton.setToolTip("""Appends the entries of one or more worldbooks to the character books of the selected cards,
+or of every card with a given tag, and saves them.""")
+        self.bulkWorldbookButton.clicked.connect(self.bulkImportWorldbooks)
+        self.tokenReportButton = QPushButton("Token Report", self)
+        self.tokenReportButton.setToolTip("""Lists every card in the current directory by how many tokens it takes up, heaviest first.""")
+        self.tokenReportButton.clicked.connect(lambda: TokenReportDialog(self.imageList, self).show())
+        self.duplicatesButton = QPushButton("Find Duplicates", self)
+        self.duplicatesButton.setToolTip("""Lists cards in the current directory that are copies or forks of each other, and character book
+entries that appear in several cards. Only cards changed since the last search are read again.""")
+        self.duplicatesButton.clicked.connect(lambda: DuplicatesDialog(self.imageList, self).show())
 
         self.rightPanel = QWidget()
         self.rightPanelLayout = QVBoxLayout()
         self.rightPanel.setLayout(self.rightPanelLayout)
         self.rightPanelLayout.addWidget(self.changeDirButton)
         self.rightPanelLayout.addWidget(self.refreshDirButton)
+        self.rightPanelLayout.addWidget(self.watchCheckbox)
+        self.rightPanelLayout.addWidget(self.saveAllButton)
+        self.rightPanelLayout.addWidget(self.bulkWorldbookButton)
+        self.rightPanelLayout.addWidget(self.tokenReportButton)
+        self.rightPanelLayout.addWidget(self.duplicatesButton)
+        if profiling.enabled():
+            self.timingButton = QPushButton("Timing Statistics", self)
+            self.timingButton.setToolTip("Shows how long card reading, editor construction, painting and so on have taken")
+            self.timingButton.clicked.connect(lambda: TimingStatisticsDialog(self).show())
+            self.rightPanelLayout.addWidget(self.timingButton)
+        self.rightPanelLayout.addWidget(self.imageList.progressBar)
         self.rightPanelLayout.addWidget(self.imageList)
+        self.rightPanelLayout.addWidget(self.searchPanel)
         
         self.splitter.addWidget(self.imageList.stack)
         self.splitter.addWidget(self.rightPanel)
@@ -928,9 +2637,47 @@ WARNING: Save your work first! Unsaved edits are discarded.""")
         self.splitter.widget(0).deleteLater()
         self.splitter.insertWidget(0, self.imageList.stack)
 
+    def bulkImportWorldbooks(self):
+        BulkWorldbookDialog(self.imageList, self).exec_()
+
+    def cardSaved(self, imagePath):
+        self.thumbnailCache.invalidate(imagePath)
+        self.imageList.cardSaved(imagePath)
+
+    def closeEvent(self, event):
+        self.imageList.cancelScan()
+        self.imageList.scanExecutor.shutdown(wait=False)
+        self.imageList.coordinatorExecutor.shutdown(wait=False)
+        self.imageList.tokenExecutor.shutdown(wait=False)
+        # cards left unsaved stay in the journal and are offered for restoring next time
+        for editor in self.imageList.editors.values():
+            editor.checkDirty()
+        self.imageList.journalTimer.stop()
+        self.imageList.journalExecutor.shutdown(wait=True)
+        self.imageList.journal.close()
+        super().closeEvent(event)
+
+# Takes --editor-pool-size=N out of the command line. Returns the remaining arguments and N, or None
+# if it wasn't given.
+def editorPoolSizeOption(args):
+    remaining = []
+    size = None
+    for arg in args:
+        if not arg.startswith(EDITOR_POOL_SIZE_OPTION):
+            remaining.append(arg)
+            continue
+        try:
+            size = int(arg[len(EDITOR_POOL_SIZE_OPTION):])
+        except ValueError:
+            print("ignoring %s, the size must be a whole number" % arg, file=sys.stderr)
+    return remaining, size
+
 if __name__ == "__main__":
+    # --profile or TAVERNAI_EDITOR_PROFILE turns on timing, see profiling.py
+    sys.argv = profiling.configure(sys.argv)
+    sys.argv, editorPoolSize = editorPoolSizeOption(sys.argv)
     app = QApplication(sys.argv)
-    window = MainWindow()
+    window = MainWindow(editorPoolSize)
     window.show()
     sys.exit(app.exec_())
 
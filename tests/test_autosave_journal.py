@@ -0,0 +1,125 @@
+import os
+
+import undo_history
+from autosave_journal import AutosaveJournal, apply_record, changed_on_disk
+
+def write_card(directory, name="card.png"):
+    path = os.path.join(directory, name)
+    with open(path, "wb") as f:
+        f.write(b"not really a png")
+    return path
+
+# Records the edits an editor would make taking each field from its value on disk through values in turn
+def edit(journal, card, field, values):
+    for old, new in zip(values, values[1:]):
+        journal.record(card, field, undo_history.diff(old, new))
+
+# What restoring a card's records onto the values on disk gives
+def replay(records, values):
+    values = dict(values)
+    for record in records[1:]:
+        values[record[1]] = apply_record(values[record[1]], record)
+    return values
+
+def test_replay_after_crash(tmp_path):
+    card = write_card(str(tmp_path))
+    path = str(tmp_path / "journal")
+    journal = AutosaveJournal(path)
+    edit(journal, card, "description", ["hello", "hello world", "hello there world"])
+    edit(journal, card, "alternate_greetings", [["hi"], ["hi", "hey"]])
+    journal.flush()
+    # no close(), as if the editor crashed
+
+    restorable = AutosaveJournal(path).restorableIn(str(tmp_path))
+    assert not changed_on_disk(card, restorable[card])
+    assert replay(restorable[card], {"description": "hello", "alternate_greetings": ["hi"]}) == \
+        {"description": "hello there world", "alternate_greetings": ["hi", "hey"]}
+
+def test_saving_clears_and_compacts(tmp_path):
+    card = write_card(str(tmp_path))
+    other = write_card(str(tmp_path), "other.png")
+    path = str(tmp_path / "journal")
+    journal = AutosaveJournal(path)
+    edit(journal, card, "name", ["a", "ab"])
+    edit(journal, other, "name", ["x", "xy"])
+    journal.flush()
+    journal.clear(card)
+    journal.flush()
+    assert list(AutosaveJournal(path).restorableIn(str(tmp_path))) == [os.path.abspath(other)]
+    journal.clear(other)
+    journal.close()
+    assert not os.path.exists(path)
+
+def test_later_then_edit_again(tmp_path):
+    card = write_card(str(tmp_path))
+    path = str(tmp_path / "journal")
+    journal = AutosaveJournal(path)
+    edit(journal, card, "description", ["hello", "hello world"])
+    journal.close()
+
+    # the next run offers the edits and they're left for later, opening the card applies them before
+    # it's edited again
+    journal = AutosaveJournal(path)
+    assert card in journal.restorableIn(str(tmp_path))
+    records = journal.unsavedRecords(card)
+    assert replay(records, {"description": "hello"}) == {"description": "hello world"}
+    edit(journal, card, "description", ["hello", "hello world", "well hello world"])
+    assert journal.unsavedRecords(card) is None
+    journal.close()
+
+    restorable = AutosaveJournal(path).restorableIn(str(tmp_path))
+    assert not changed_on_disk(card, restorable[card])
+    assert replay(restorable[card], {"description": "hello"}) == {"description": "well hello world"}
+
+def test_released_editor_is_offered_again(tmp_path):
+    card = write_card(str(tmp_path))
+    journal = AutosaveJournal(str(tmp_path / "journal"))
+    edit(journal, card, "description", ["hello", "hello world"])
+    assert journal.restorableIn(str(tmp_path)) == {}
+    assert journal.unsavedRecords(card) is None
+    journal.release(card)
+    restorable = journal.restorableIn(str(tmp_path))
+    assert replay(restorable[card], {"description": "hello"}) == {"description": "hello world"}
+
+    # a new editor for the card carries on from those edits
+    assert journal.unsavedRecords(card) == restorable[card]
+    edit(journal, card, "description", ["hello", "hello world", "hello world again"])
+    journal.release(card)
+    restorable = journal.restorableIn(str(tmp_path))
+    assert replay(restorable[card], {"description": "hello"}) == {"description": "hello world again"}
+
+def test_unwritten_records_are_taken_over(tmp_path):
+    card = write_card(str(tmp_path))
+    path = str(tmp_path / "journal")
+    journal = AutosaveJournal(path)
+    edit(journal, card, "description", ["hello", "hello world"])
+    journal.flush()
+    edit(journal, card, "name", ["a", "ab"])
+    journal.release(card)
+    # the name edit hasn't been written, it comes from memory and isn't written afterwards
+    records = journal.unsavedRecords(card)
+    assert replay(records, {"description": "hello", "name": "a"}) == {"description": "hello world", "name": "ab"}
+    journal.clear(card)
+    journal.close()
+    assert not os.path.exists(path)
+
+def test_torn_last_line_is_ignored(tmp_path):
+    card = write_card(str(tmp_path))
+    path = str(tmp_path / "journal")
+    journal = AutosaveJournal(path)
+    edit(journal, card, "description", ["hello", "hello world"])
+    journal.close()
+    with open(path, "ab") as f:
+        f.write(b'"%s"\t["splice","descr' % card.encode())
+    restorable = AutosaveJournal(path).restorableIn(str(tmp_path))
+    assert replay(restorable[card], {"description": "hello"}) == {"description": "hello world"}
+
+def test_card_changed_on_disk(tmp_path):
+    card = write_card(str(tmp_path))
+    path = str(tmp_path / "journal")
+    journal = AutosaveJournal(path)
+    edit(journal, card, "description", ["hello", "hello world"])
+    journal.close()
+    with open(card, "ab") as f:
+        f.write(b"more")
+    assert changed_on_disk(card, AutosaveJournal(path).restorableIn(str(tmp_path))[card])
@@ -0,0 +1,41 @@
+import os
+import struct
+import zlib
+
+from card_index import CardIndex
+from character_card import write_character
+from png_chunks import PNG_SIGNATURE
+
+def chunk(chunkType, data):
+    return struct.pack(">I4s", len(data), chunkType) + data + struct.pack(">I", zlib.crc32(data, zlib.crc32(chunkType)))
+
+def write_card(path, name, description):
+    header = struct.pack(">IIBBBBB", 1, 1, 8, 0, 0, 0, 0)
+    with open(path, "wb") as f:
+        f.write(PNG_SIGNATURE + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(b"\x00\x00")) + chunk(b"IEND", b""))
+    write_character(path, {"spec": "chara_card_v2", "spec_version": "2.0", "data": {"name": name, "description": description}})
+
+def test_refresh_indexes_cards(tmp_path):
+    cards = tmp_path / "cards"
+    cards.mkdir()
+    write_card(str(cards / "a.png"), "Alice", "a lighthouse keeper")
+    write_card(str(cards / "b.png"), "Bob", "a sailor")
+    cardIndex = CardIndex(str(cards), str(tmp_path / "index.sqlite3"))
+    assert [summary.name for summary in cardIndex.refresh()] == ["Alice", "Bob"]
+    if cardIndex.searchAvailable:
+        assert [hit["filename"] for hit in cardIndex.search("lighthouse")] == ["a.png"]
+    cardIndex.close()
+
+def test_unreadable_card_is_dropped(tmp_path):
+    cards = tmp_path / "cards"
+    cards.mkdir()
+    path = str(cards / "a.png")
+    write_card(path, "Alice", "a lighthouse keeper")
+    cardIndex = CardIndex(str(cards), str(tmp_path / "index.sqlite3"))
+    cardIndex.refresh()
+    with open(path, "wb") as f:
+        f.write(b"no longer a card")
+    assert cardIndex.refresh() == []
+    assert cardIndex.summary("a.png") is None
+    assert cardIndex.search("lighthouse") == []
+    cardIndex.close()
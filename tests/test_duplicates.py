@@ -0,0 +1,59 @@
+from duplicates import NEAR_DUPLICATE_THRESHOLD, SignatureCache, card_signature, find_duplicates, minhash, near_duplicate_groups, \
+    normalize_text, read_signatures, similarity
+
+TEXT = ("The old lighthouse keeper lived alone on the rocky island for forty years, tending the lamp every night "
+        "and writing letters to a daughter who never answered them")
+DATA = {"data": {"description": TEXT, "character_book": {"entries": [{"content": TEXT}, {"content": ""}]}}}
+
+def test_minhash_similarity():
+    edited = TEXT.replace("forty years", "thirty years")
+    assert similarity(minhash(normalize_text(TEXT)), minhash(normalize_text(TEXT.upper()))) == 1.0
+    assert similarity(minhash(normalize_text(TEXT)), minhash(normalize_text(edited))) >= NEAR_DUPLICATE_THRESHOLD
+    assert minhash("too short") is None
+
+def test_near_duplicate_groups():
+    signatures = {"a": minhash(normalize_text(TEXT)), "b": minhash(normalize_text(TEXT + " again")),
+                  "c": minhash(normalize_text("a completely different story about a cat who sails the seven seas looking for fish"))}
+    groups, lowest = near_duplicate_groups(signatures)
+    assert groups == [["a", "b"]]
+    assert lowest["a"] >= NEAR_DUPLICATE_THRESHOLD
+
+def test_cache_round_trip(tmp_path):
+    cache = SignatureCache(str(tmp_path / "signatures.sqlite3"))
+    exact, signature, entryHashes = cache.add("hash", DATA)
+    assert signature is not None
+    cache.close()
+    cache = SignatureCache(str(tmp_path / "signatures.sqlite3"))
+    assert cache.cards(["hash", "other"]) == {"hash": (exact, signature, entryHashes)}
+    # the empty entry has no hash and isn't stored
+    assert entryHashes[1] == ""
+    assert cache.entries(entryHashes) == {entryHashes[0]: (signature, normalize_text(TEXT)[:80])}
+    cache.close()
+
+def test_cache_store_matches_add(tmp_path, monkeypatch):
+    monkeypatch.setattr("duplicates.read_character", lambda path, location=None: DATA)
+    first = SignatureCache(str(tmp_path / "first.sqlite3"))
+    second = SignatureCache(str(tmp_path / "second.sqlite3"))
+    assert first.add("hash", DATA) == second.store("hash", read_signatures("card.png")[0])
+    assert first.cards(["hash"]) == second.cards(["hash"])
+    entryHash = card_signature(DATA)[2][0][0]
+    assert first.entries([entryHash]) == second.entries([entryHash])
+    first.close()
+    second.close()
+
+def test_unreadable_cards_are_reported(tmp_path):
+    (tmp_path / "broken.png").write_bytes(b"not a png")
+    signatures, error = read_signatures(str(tmp_path / "broken.png"))
+    assert signatures is None and error.startswith("ValueError: ")
+
+    class Summary:
+        filename = "broken.png"
+        content_hash = "hash"
+        def charaLocation(self):
+            return None
+    cache = SignatureCache(str(tmp_path / "signatures.sqlite3"))
+    for mapper in (None, map):
+        report = find_duplicates(str(tmp_path), [Summary()], cache, mapper=mapper)
+        assert report["cards"] == 0
+        assert report["errors"] == [{"file": "broken.png", "error": error}]
+    cache.close()
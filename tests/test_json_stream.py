@@ -0,0 +1,37 @@
+import json
+
+import pytest
+
+import json_stream
+from json_stream import JSONItemStream
+
+DOCUMENT = {"name": "World", "entries": {str(number): {"keys": ["k%d" % number], "content": "é" * number} for number in range(50)},
+            "extensions": {"depth": 4, "numbers": [1.5, -2, 1e10]}}
+
+def write(tmp_path, document):
+    path = tmp_path / "book.json"
+    path.write_text(json.dumps(document), encoding="utf-8")
+    return str(path)
+
+@pytest.mark.parametrize("chunkSize", [7, 64, json_stream.STREAM_CHUNK_SIZE])
+def test_streamed_items_match_json_load(tmp_path, monkeypatch, chunkSize):
+    monkeypatch.setattr(json_stream, "STREAM_CHUNK_SIZE", chunkSize)
+    stream = JSONItemStream(write(tmp_path, DOCUMENT), [("entries",), ("data", "character_book", "entries")])
+    items = [item for batch in stream.batches(8) for item in batch]
+    assert items == list(DOCUMENT["entries"].values())
+    assert stream.itemPath == ("entries",)
+    assert stream.document == dict(DOCUMENT, entries=[])
+    assert stream.progress() == 1.0
+
+def test_nested_list(tmp_path):
+    card = {"spec": "chara_card_v2", "data": {"name": "A", "character_book": {"entries": [{"content": "x"}, {"content": "y"}]}}}
+    stream = JSONItemStream(write(tmp_path, card), [("entries",), ("data", "character_book", "entries")])
+    assert list(stream.items()) == [{"content": "x"}, {"content": "y"}]
+    assert stream.itemPath == ("data", "character_book", "entries")
+    assert stream.document["data"]["name"] == "A"
+
+def test_truncated_file_is_an_error(tmp_path):
+    path = tmp_path / "book.json"
+    path.write_text(json.dumps(DOCUMENT)[:-20], encoding="utf-8")
+    with pytest.raises(ValueError):
+        list(JSONItemStream(str(path), [("entries",)]).items())
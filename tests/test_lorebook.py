@@ -0,0 +1,34 @@
+from lorebook import KeywordAutomaton, LorebookSimulator
+
+def entry(keys, content, **fields):
+    return dict({"keys": keys, "content": content, "enabled": True, "insertion_order": 0}, **fields)
+
+def positions(results):
+    return [result["position"] for result in results]
+
+def test_automaton_finds_overlapping_keys():
+    automaton = KeywordAutomaton(["he", "she", "his", "hers"])
+    assert automaton.search("ushers") == {0, 1, 3}
+
+def test_activation_rules():
+    book = {"entries": [
+        entry(["dragon"], "Dragons breathe fire."),
+        entry(["castle"], "The castle.", selective=True, secondary_keys=["night"]),
+        entry([], "Always there.", constant=True),
+        entry(["Elf"], "Elves.", case_sensitive=True),
+        entry(["dragon"], "Disabled.", enabled=False),
+    ]}
+    included, cut = LorebookSimulator(book).activate(["A dragon flew over the castle", "an elf waved"])
+    assert positions(included) == [0, 2] and cut == []
+    included, _cut = LorebookSimulator(book).activate(["the castle at night, an Elf"])
+    assert positions(included) == [1, 2, 3]
+
+def test_recursion_and_budget():
+    book = {"entries": [entry(["sword"], "The sword was forged by the smith."), entry(["smith"], "word " * 50, priority=0),
+                        entry(["sword"], "Short.", priority=10)], "token_budget": 20}
+    simulator = LorebookSimulator(book)
+    included, cut = simulator.activate("a sword", recursiveScanning=True)
+    assert positions(included) == [0, 2]
+    assert positions(cut) == [1]
+    assert cut[0]["reason"] == "recursion"
+    assert positions(simulator.activate("a sword", tokenBudget=1000)[0]) == [0, 2]
@@ -0,0 +1,104 @@
+import os
+import struct
+import zlib
+
+import pytest
+
+from png_chunks import PNG_SIGNATURE, find_text_chunk, read_text_chunk, read_text_chunk_at, write_text_chunk
+
+def chunk(chunkType, data):
+    return struct.pack(">I4s", len(data), chunkType) + data + struct.pack(">I", zlib.crc32(data, zlib.crc32(chunkType)))
+
+IMAGE = chunk(b"IDAT", zlib.compress(b"\x00\x00"))
+
+def write_png(path, *chunks):
+    header = struct.pack(">IIBBBBB", 1, 1, 8, 0, 0, 0, 0)
+    path.write_bytes(PNG_SIGNATURE + chunk(b"IHDR", header) + chunk(b"tEXt", b"Comment\x00keep me") + b"".join(chunks) +
+                     IMAGE + chunk(b"IEND", b""))
+
+def test_read_text_chunk(tmp_path):
+    path = tmp_path / "card.png"
+    write_png(path, chunk(b"iTXt", b"chara\x00\x00\x00\x00\x00" + "ünïcode ☃".encode("utf-8")))
+    for useMmap in (False, True):
+        assert read_text_chunk(str(path), use_mmap=useMmap) == "ünïcode ☃"
+        assert read_text_chunk(str(path), "Comment", use_mmap=useMmap) == "keep me"
+        assert read_text_chunk(str(path), "Comm", use_mmap=useMmap) is None
+    offset, length, _text = find_text_chunk(str(path))
+    assert path.read_bytes()[offset + 4:offset + 8] == b"iTXt"
+    assert length == 12 + len(b"chara\x00\x00\x00\x00\x00" + "ünïcode ☃".encode("utf-8"))
+
+def test_bad_crc_is_an_error(tmp_path):
+    path = tmp_path / "card.png"
+    broken = bytearray(chunk(b"tEXt", b"chara\x00text"))
+    broken[-1] ^= 0xff
+    write_png(path, bytes(broken))
+    with pytest.raises(ValueError):
+        read_text_chunk(str(path))
+    path.write_bytes(b"GIF89a")
+    with pytest.raises(ValueError):
+        read_text_chunk(str(path))
+
+def test_write_text_chunk(tmp_path):
+    path = tmp_path / "card.png"
+    write_png(path)
+    assert read_text_chunk(str(path)) is None
+    write_text_chunk(str(path), "chara", "first")
+    write_text_chunk(str(path), "chara", "ünïcode second")
+    for useMmap in (False, True):
+        assert read_text_chunk(str(path), use_mmap=useMmap) == "ünïcode second"
+    assert read_text_chunk(str(path), "Comment") == "keep me"
+    data = path.read_bytes()
+    # the image data is copied untouched, with the one chara chunk before it
+    assert IMAGE in data
+    assert data.count(b"chara\x00") == 1
+    assert data.index(b"chara\x00") < data.index(IMAGE)
+
+def test_write_to_a_truncated_file_keeps_it(tmp_path):
+    path = tmp_path / "card.png"
+    write_png(path)
+    truncated = path.read_bytes()[:-12]
+    path.write_bytes(truncated)
+    with pytest.raises(ValueError):
+        write_text_chunk(str(path), "chara", "text")
+    assert path.read_bytes() == truncated
+    assert [item.name for item in tmp_path.iterdir()] == ["card.png"]
+
+def test_read_at_known_location(tmp_path):
+    path = tmp_path / "card.png"
+    write_png(path)
+    write_text_chunk(str(path), "chara", "text")
+    offset, length, text = find_text_chunk(str(path))
+    assert read_text_chunk_at(str(path), offset, length) == text == "text"
+    # a stale location is detected rather than misread
+    assert read_text_chunk_at(str(path), offset + 1, length) is None
+    assert read_text_chunk_at(str(path), offset, length, "Comment") is None
+
+def test_original_is_closed_before_it_is_replaced(tmp_path, monkeypatch):
+    path = tmp_path / "card.png"
+    write_png(path)
+    opened = []
+    realOpen, realReplace = open, os.replace
+    def trackingOpen(*args, **kwargs):
+        f = realOpen(*args, **kwargs)
+        opened.append(f)
+        return f
+    def checkingReplace(source, destination):
+        assert all(f.closed for f in opened)
+        realReplace(source, destination)
+    monkeypatch.setattr("builtins.open", trackingOpen)
+    monkeypatch.setattr(os, "replace", checkingReplace)
+    write_text_chunk(str(path), "chara", "text")
+    assert opened
+    assert read_text_chunk(str(path)) == "text"
+
+def test_failed_replace_removes_the_temporary_file(tmp_path, monkeypatch):
+    path = tmp_path / "card.png"
+    write_png(path)
+    original = path.read_bytes()
+    def failingReplace(source, destination):
+        raise PermissionError("file is in use")
+    monkeypatch.setattr(os, "replace", failingReplace)
+    with pytest.raises(PermissionError):
+        write_text_chunk(str(path), "chara", "text")
+    assert path.read_bytes() == original
+    assert [item.name for item in tmp_path.iterdir()] == ["card.png"]
@@ -0,0 +1,44 @@
+import undo_history
+from undo_history import UndoHistory
+
+def test_diff_and_apply_round_trip():
+    cases = [("hello world", "hello there world"), ("abc", ""), ("", "abc"), ("same", "same"),
+             ([1, 2, 3, 4], [1, 5, 4]), ([], [1]), (0, 2)]
+    for old, new in cases:
+        change = undo_history.diff(old, new)
+        if old == new:
+            assert change is None
+            continue
+        assert undo_history.apply(old, change) == new
+        assert undo_history.apply(new, undo_history.inverse(change)) == old
+
+def test_splice_holds_only_the_change():
+    entries = [{"content": str(number)} for number in range(5000)]
+    edited = entries[:100] + [{"content": "changed"}] + entries[101:]
+    kind, start, removed, inserted = undo_history.diff(entries, edited)
+    assert (kind, start, removed, inserted) == ("splice", 100, [entries[100]], [{"content": "changed"}])
+
+def test_undo_and_redo_steps():
+    history = UndoHistory()
+    values = ["", "a", "ab", "abc"]
+    for old, new in zip(values, values[1:]):
+        history.record([("name", undo_history.diff(old, new))])
+    value = values[-1]
+    while history.canUndo():
+        for _field, change in history.undo():
+            value = undo_history.apply(value, change)
+    assert value == ""
+    while history.canRedo():
+        for _field, change in history.redo():
+            value = undo_history.apply(value, change)
+    assert value == "abc"
+
+def test_recording_clears_redo_and_limit_drops_oldest():
+    history = UndoHistory(limit=2)
+    for number in range(3):
+        history.record([("name", ("replace", number, number + 1))])
+    assert len(history.undoSteps) == 2
+    history.undo()
+    assert history.canRedo()
+    history.record([("name", ("replace", 2, 5))])
+    assert not history.canRedo()
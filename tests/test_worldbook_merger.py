@@ -0,0 +1,49 @@
+import copy
+
+from character_card import DUPLICATES_KEEP_BOTH, DUPLICATES_REPLACE, DUPLICATES_SKIP, WorldbookMerger, import_worldbook
+
+def entry(keys, content, **fields):
+    return dict({"keys": keys, "secondary_keys": [], "content": content, "enabled": True}, **fields)
+
+def book():
+    return {"entries": [entry(["dragon"], "Dragons breathe fire.", id=1), entry(["castle"], "The castle is old.", id=2)]}
+
+def test_rollback_after_replacing_existing_entries():
+    characterBook = book()
+    original = copy.deepcopy(characterBook)
+    merger = WorldbookMerger(characterBook, DUPLICATES_REPLACE)
+    merger.add([entry(["Dragon"], "Dragons  breathe fire.", comment="changed"), entry(["elf"], "Elves are tall.")])
+    assert characterBook["entries"][0]["comment"] == "changed"
+    merger.rollback()
+    assert characterBook == original
+
+def test_rollback_after_duplicate_within_import():
+    characterBook = book()
+    original = copy.deepcopy(characterBook)
+    merger = WorldbookMerger(characterBook, DUPLICATES_REPLACE)
+    merger.add([entry(["elf"], "Elves are tall.")])
+    merger.add([entry(["elf"], "Elves are tall.", comment="second copy")])
+    merger.rollback()
+    assert characterBook == original
+
+def test_skip_and_keep_both():
+    worldBook = {"entries": [entry(["dragon"], "Dragons breathe fire."), entry(["elf"], "Elves are tall.")]}
+    assert import_worldbook(book(), copy.deepcopy(worldBook), DUPLICATES_SKIP) == (1, 1, 0)
+    characterBook = book()
+    assert import_worldbook(characterBook, copy.deepcopy(worldBook), DUPLICATES_KEEP_BOTH) == (2, 0, 0)
+    assert len(characterBook["entries"]) == 4
+
+def test_duplicate_within_worldbook_with_replace():
+    characterBook = book()
+    worldBook = {"entries": [entry(["elf"], "Elves are tall."), entry(["elf"], "Elves are tall.", comment="second copy")]}
+    # nothing that was already in the book changed, the second copy only takes the place of the first
+    assert import_worldbook(characterBook, worldBook, DUPLICATES_REPLACE) == (1, 1, 0)
+    assert len(characterBook["entries"]) == 3
+    assert characterBook["entries"][2]["comment"] == "second copy"
+
+def test_replace_existing_entry_keeps_its_id():
+    characterBook = book()
+    worldBook = {"entries": [entry(["dragon"], "Dragons breathe fire.", id=7, comment="changed")]}
+    assert import_worldbook(characterBook, worldBook, DUPLICATES_REPLACE) == (0, 0, 1)
+    assert characterBook["entries"][0]["id"] == 1
+    assert characterBook["entries"][0]["comment"] == "changed"
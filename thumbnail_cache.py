@@ -0,0 +1,139 @@
+import hashlib
+import os
+import threading
+
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QImage
+
+from app_paths import cache_directory
+
+# Pre-scaled thumbnails are kept on disk so that browsing a directory doesn't need to decode every
+# full-size card image on each launch. Entries are keyed by the card's absolute path, mtime and size,
+# so a card that changes on disk simply misses the cache.
+
+THUMBNAIL_CACHE_SIZE = 128 # pixels, large enough for the 64x64 list icons on a 2x display
+THUMBNAIL_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# When the cache grows past its limit the least recently used thumbnails are removed until it's
+# back under this fraction of the limit, so trimming doesn't happen on every single store
+THUMBNAIL_CACHE_TRIM_RATIO = 0.8
+
+class ThumbnailCache:
+    def __init__(self, directory=None, maxBytes=THUMBNAIL_CACHE_MAX_BYTES, size=THUMBNAIL_CACHE_SIZE):
+        self.directory = directory or cache_directory("thumbnails")
+        self.maxBytes = maxBytes
+        self.size = size
+        self.lock = threading.Lock()
+        # The directory is only listed once, on first use. After that the entries are tracked here:
+        # card prefix: {entry name: size}.
+        self.cardEntries = None
+        self.totalBytes = None
+
+    # All thumbnails of one card share a prefix so they can be invalidated without knowing the old
+    # mtime and size
+    def _prefix(self, imagePath):
+        return hashlib.sha1(os.path.abspath(imagePath).encode("utf-8")).hexdigest()
+
+    def _entryPath(self, imagePath, stat):
+        return os.path.join(self.directory, "%s_%d_%d.png" % (self._prefix(imagePath), stat.st_mtime_ns, stat.st_size))
+
+    # Returns a QImage no bigger than size x size for the card, decoding and caching the full image
+    # only if there's no up-to-date entry. Safe to call from worker threads. Returns None if the
+    # image can't be loaded.
+    def thumbnail(self, imagePath):
+        try:
+            stat = os.stat(imagePath)
+        except OSError:
+            return None
+        entryPath = self._entryPath(imagePath, stat)
+        image = QImage(entryPath)
+        if not image.isNull():
+            try:
+                os.utime(entryPath) # mark as recently used
+            except OSError:
+                pass
+            return image
+        image = QImage(imagePath)
+        if image.isNull():
+            return None
+        if image.width() > self.size or image.height() > self.size:
+            image = image.scaled(self.size, self.size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        self._store(imagePath, entryPath, image)
+        return image
+
+    # Entries for older versions of the card are left to be trimmed, they're never read again since the
+    # entry name includes the mtime and size
+    def _store(self, imagePath, entryPath, image):
+        tempPath = entryPath + ".%d.tmp" % threading.get_ident()
+        if not image.save(tempPath, "PNG"):
+            return
+        try:
+            os.replace(tempPath, entryPath)
+            written = os.path.getsize(entryPath)
+        except OSError:
+            return
+        name = os.path.basename(entryPath)
+        with self.lock:
+            self._load()
+            # if the listing was only just made it already has this entry
+            names = self.cardEntries.setdefault(self._prefix(imagePath), {})
+            self.totalBytes += written - names.get(name, 0)
+            names[name] = written
+            if self.totalBytes > self.maxBytes:
+                self._trim()
+
+    # Removes every cached thumbnail for the card, called when a card is saved
+    def invalidate(self, imagePath):
+        with self.lock:
+            self._load()
+            names = self.cardEntries.pop(self._prefix(imagePath), {})
+            self.totalBytes -= sum(names.values())
+        for name in names:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".png"):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    # Expects self.lock to be held
+    def _index(self, entries):
+        self.cardEntries = {}
+        self.totalBytes = 0
+        for _mtime, size, path in entries:
+            name = os.path.basename(path)
+            self.cardEntries.setdefault(name.partition("_")[0], {})[name] = size
+            self.totalBytes += size
+
+    # Expects self.lock to be held
+    def _load(self):
+        if self.cardEntries is None:
+            self._index(self._entries())
+
+    # Expects self.lock to be held. Trimming needs the last used times, so it's the one thing that lists
+    # the directory again.
+    def _trim(self):
+        entries = sorted(self._entries())
+        total = sum(size for _mtime, size, _path in entries)
+        target = self.maxBytes * THUMBNAIL_CACHE_TRIM_RATIO
+        kept = []
+        for number, (_mtime, size, path) in enumerate(entries):
+            if total <= target:
+                kept.extend(entries[number:])
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                kept.append(entries[number])
+                continue
+            total -= size
+        self._index(kept)
@@ -0,0 +1,164 @@
+import hashlib
+import math
+import os
+import re
+import threading
+from collections import OrderedDict
+
+# Estimates how much of a model's context a card takes up. Counting goes through a TokenCounter, which
+# remembers the count of every text it has seen by a hash of its content, so recounting a card after an
+# edit only tokenizes the text that actually changed. Nothing in here depends on Qt.
+#
+# The built-in ApproximateTokenizer works offline with no extra packages. A real model's tokenizer can
+# be loaded from a local file instead: a Hugging Face tokenizer.json (needs the tokenizers package) or
+# a SentencePiece .model file (needs the sentencepiece package). Programs that call default_counter()
+# use the file named by TAVERNAI_EDITOR_TOKENIZER if it's set.
+
+TOKENIZER_ENVIRONMENT_VARIABLE = "TAVERNAI_EDITOR_TOKENIZER"
+# How many distinct texts a TokenCounter remembers counts for, the least recently used are forgotten first
+TOKEN_CACHE_SIZE = 100000
+
+# The card fields that end up in the prompt, in the order they're shown. alternate_greetings is counted
+# as the sum of its greetings.
+PROMPT_FIELDS = ("name", "description", "personality", "scenario", "first_mes", "mes_example", "alternate_greetings",
+                 "system_prompt", "post_history_instructions")
+# Fields that are counted for the editor but aren't part of a card's total because they aren't sent to the model
+NOTE_FIELDS = ("creator_notes",)
+
+_word = re.compile(r"\w+|[^\w\s]")
+
+# A rough token count for when no tokenizer is given: most tokenizers split words of more than a few
+# letters into several tokens, and give punctuation tokens of its own
+def approximate_token_count(text):
+    return sum(math.ceil(len(word) / 4) for word in _word.findall(text))
+
+class ApproximateTokenizer:
+    name = "approximate"
+
+    def count(self, text):
+        return approximate_token_count(text)
+
+class HuggingFaceTokenizer:
+    def __init__(self, path):
+        try:
+            from tokenizers import Tokenizer
+        except ImportError:
+            raise ValueError("the tokenizers package is needed to load %s" % path)
+        self.tokenizer = Tokenizer.from_file(path)
+        self.name = os.path.basename(path)
+
+    def count(self, text):
+        return len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+
+class SentencePieceTokenizer:
+    def __init__(self, path):
+        try:
+            import sentencepiece
+        except ImportError:
+            raise ValueError("the sentencepiece package is needed to load %s" % path)
+        self.processor = sentencepiece.SentencePieceProcessor(model_file=path)
+        self.name = os.path.basename(path)
+
+    def count(self, text):
+        return len(self.processor.encode(text))
+
+# Tokenizer file extensions and the classes that load them. Anything with a count(text) method and a
+# name can be used as a tokenizer, this only covers the ones that can be loaded by filename.
+TOKENIZER_TYPES = {".json": HuggingFaceTokenizer, ".model": SentencePieceTokenizer}
+
+# Returns the tokenizer for a local tokenizer file, or the approximate one if path is empty or "approximate".
+# Raises ValueError if the file isn't a kind of tokenizer that can be loaded.
+def load_tokenizer(path=None):
+    if not path or path == ApproximateTokenizer.name:
+        return ApproximateTokenizer()
+    tokenizerType = TOKENIZER_TYPES.get(os.path.splitext(path)[1].lower())
+    if tokenizerType is None:
+        raise ValueError("%s isn't a tokenizer.json or SentencePiece .model file" % path)
+    return tokenizerType(path)
+
+# Counts tokens with a tokenizer, remembering the results. Safe to use from several threads at once.
+class TokenCounter:
+    def __init__(self, tokenizer=None, cacheSize=TOKEN_CACHE_SIZE):
+        self.tokenizer = tokenizer or ApproximateTokenizer()
+        self.cacheSize = cacheSize
+        self.counts = OrderedDict() # content hash: token count, least recently used first
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(text):
+        return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+    # The remembered count for text, or None if it hasn't been counted yet
+    def cached(self, text):
+        key = self._key(text)
+        with self.lock:
+            count = self.counts.get(key)
+            if count is not None:
+                self.counts.move_to_end(key)
+            return count
+
+    def count(self, text):
+        if not text:
+            return 0
+        key = self._key(text)
+        with self.lock:
+            count = self.counts.get(key)
+            if count is not None:
+                self.counts.move_to_end(key)
+                return count
+        # tokenized outside the lock so other threads aren't held up, at worst two threads count the same text
+        count = self.tokenizer.count(text)
+        with self.lock:
+            self.counts[key] = count
+            if len(self.counts) > self.cacheSize:
+                self.counts.popitem(last=False)
+        return count
+
+    # The count for one of the fields in PROMPT_FIELDS or NOTE_FIELDS as stored in a card
+    def count_field(self, value):
+        if isinstance(value, list):
+            return sum(self.count(str(item)) for item in value if item)
+        return self.count(str(value)) if value else 0
+
+    # Counts the content of character book entries. Returns (total, constant, counts): the tokens of every
+    # enabled entry, of those that are always inserted, and the count of each entry in order.
+    def count_entries(self, entries):
+        counts = []
+        total = constant = 0
+        for entry in entries:
+            if not isinstance(entry, dict):
+                counts.append(0)
+                continue
+            tokens = self.count(str(entry.get("content") or ""))
+            counts.append(tokens)
+            if entry.get("enabled", True):
+                total += tokens
+                if entry.get("constant"):
+                    constant += tokens
+        return total, constant, counts
+
+    # Counts a whole card's data. Returns {"fields": {field: tokens}, "entries": enabled entry tokens,
+    # "constant_entries": always inserted entry tokens, "entry_count": number of entries, "total": tokens
+    # of the prompt fields and every enabled entry}.
+    def count_card(self, data):
+        data = data.get("data", data)
+        fields = {field: self.count_field(data.get(field)) for field in PROMPT_FIELDS + NOTE_FIELDS}
+        characterBook = data.get("character_book") or {}
+        entries = characterBook.get("entries") or []
+        entryTokens, constantTokens, _counts = self.count_entries(entries if isinstance(entries, list) else [])
+        return {"fields": fields, "entries": entryTokens, "constant_entries": constantTokens, "entry_count": len(entries),
+                "total": sum(fields[field] for field in PROMPT_FIELDS) + entryTokens}
+
+_counters = {} # tokenizer path: TokenCounter
+_countersLock = threading.Lock()
+
+# A shared TokenCounter for a tokenizer file, so everything using the same tokenizer shares its cache.
+# The default is the file named by TAVERNAI_EDITOR_TOKENIZER, or the approximate tokenizer.
+def default_counter(path=None):
+    if path is None:
+        path = os.environ.get(TOKENIZER_ENVIRONMENT_VARIABLE, "")
+    with _countersLock:
+        counter = _counters.get(path)
+        if counter is None:
+            counter = _counters[path] = TokenCounter(load_tokenizer(path))
+        return counter
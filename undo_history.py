@@ -0,0 +1,103 @@
+# Multi-level undo and redo for a card's fields. A step holds only what changed: for text and lists,
+# the span that differs between the old and the new value, so a step that edits one entry of a 5,000
+# entry character book holds that one entry rather than a copy of the book. The items in a span are the
+# editor's own objects, not copies, which works because the editor replaces entries rather than
+# modifying them. Nothing in here depends on Qt.
+#
+# A change is either ("splice", start, removed, inserted) for a str or list where value[start:start +
+# len(removed)] was replaced by inserted, or ("replace", old, new) for anything else.
+
+# Steps kept per card, the oldest are dropped past this
+UNDO_LIMIT = 500
+
+# The length of the longest common prefix of two sequences. Slices are compared rather than single items
+# so that most of the work happens in C, the binary search keeps it linear overall.
+def _commonPrefix(first, second):
+    low, high = 0, min(len(first), len(second))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if first[low:middle] == second[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+# The length of the longest common suffix of two sequences, no longer than limit
+def _commonSuffix(first, second, limit):
+    low, high = 0, min(len(first), len(second), limit)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if first[len(first) - middle:len(first) - low] == second[len(second) - middle:len(second) - low]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+# The change that turns old into new, None if they're the same
+def diff(old, new):
+    if old is new:
+        return None
+    if type(old) is type(new) and isinstance(old, (str, list)):
+        prefix = _commonPrefix(old, new)
+        if prefix == len(old) == len(new):
+            return None
+        suffix = _commonSuffix(old, new, min(len(old), len(new)) - prefix)
+        return ("splice", prefix, old[prefix:len(old) - suffix], new[prefix:len(new) - suffix])
+    if old == new:
+        return None
+    return ("replace", old, new)
+
+# The value after change
+def apply(value, change):
+    if change[0] == "splice":
+        _kind, start, removed, inserted = change
+        return value[:start] + inserted + value[start + len(removed):]
+    return change[2]
+
+# The same change the other way round, for undoing it
+def inverse(change):
+    if change[0] == "splice":
+        _kind, start, removed, inserted = change
+        return ("splice", start, inserted, removed)
+    return ("replace", change[2], change[1])
+
+# A card's undo and redo stacks. Each step is a list of (field, change) made together.
+class UndoHistory:
+    def __init__(self, limit=UNDO_LIMIT):
+        self.limit = limit
+        self.undoSteps = []
+        self.redoSteps = []
+
+    def record(self, changes):
+        if not changes:
+            return
+        self.undoSteps.append(list(changes))
+        if len(self.undoSteps) > self.limit:
+            del self.undoSteps[:len(self.undoSteps) - self.limit]
+        self.redoSteps = []
+
+    def canUndo(self):
+        return bool(self.undoSteps)
+
+    def canRedo(self):
+        return bool(self.redoSteps)
+
+    # Returns the changes to undo, each already inverted so it can be applied as it is, or None
+    def undo(self):
+        if not self.undoSteps:
+            return None
+        step = self.undoSteps.pop()
+        self.redoSteps.append(step)
+        return [(field, inverse(change)) for field, change in reversed(step)]
+
+    # Returns the changes to redo, or None
+    def redo(self):
+        if not self.redoSteps:
+            return None
+        step = self.redoSteps.pop()
+        self.undoSteps.append(step)
+        return step
+
+    def clear(self):
+        self.undoSteps = []
+        self.redoSteps = []